@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Measures the offline batch mode (tools/batch.py): a Standard MIDI File with a played part of
+# notes and a track of DX7 CC automation gets written, then read back, run through the chord and
+# dx7 transforms and written out again.
+#
+# Usage: python3 benchmarks/batch_smf.py [event_count]
+
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+from batch import build_transforms, run
+from smf import MidiFile, from_messages, read_midi_file, write_midi_file
+
+def build_file(count):
+	notes = count // 2
+	note_ticks = []
+	note_messages = []
+	for i in range(notes // 2):
+		note = 36 + i * 7 % 60
+		note_ticks += [ i * 60, i * 60 + 50 ]
+		note_messages += [ bytes([ 0x90, note, 100 ]), bytes([ 0x80, note, 0 ]) ]
+	# Knob sweeps over the default bank controls, with a bank select every 512 CCs.
+	cc_ticks = []
+	cc_messages = []
+	for i in range(count - notes):
+		cc = 0 if i % 512 == 0 else 1 + i % 7
+		value = (i // 512) % 24 * 5 if cc == 0 else i // 7 % 128
+		cc_ticks.append(i * 30)
+		cc_messages.append(bytes([ 0xb0, cc, value ]))
+	return MidiFile(1, 480, [ from_messages(note_ticks, note_messages), from_messages(cc_ticks, cc_messages) ])
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	transforms = build_transforms([ "chord", "dx7" ])
+	with tempfile.TemporaryDirectory() as directory:
+		source = os.path.join(directory, "in.mid")
+		target = os.path.join(directory, "out.mid")
+		write_midi_file(source, build_file(count))
+
+		start = perf_counter()
+		midi_file = read_midi_file(source)
+		read = perf_counter()
+		result = run(transforms, midi_file)
+		transformed = perf_counter()
+		write_midi_file(target, result)
+		written = perf_counter()
+
+		print("events in:  {}".format(midi_file.event_count()))
+		print("events out: {}".format(result.event_count()))
+		print("read:       {:.1f} ms".format(1000 * (read - start)))
+		print("transform:  {:.1f} ms".format(1000 * (transformed - read)))
+		print("write:      {:.1f} ms".format(1000 * (written - transformed)))
+		print("total:      {:.1f} ms ({:.0f} events/s)".format(1000 * (written - start), count / (written - start)))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Compares the per-CC cost of dx7.py's compiled dispatch tables with the dict based lookups it
+# replaced. Both paths end up calling the same ParameterScheduler.set_parameter. The compiled tables
+# are measured again with 16 devices, each on its own MIDI channel, which should cost the same.
+#
+# Usage: python3 benchmarks/dx7_cc_dispatch.py [event_count]
+
+import os
+import sys
+from collections import defaultdict
+from time import perf_counter
+
+from fake_pimidipy import ControlChangeEvent, load_script
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples", "dx7.py")
+
+ENV = {
+	"DX7_PARAM_137": "0:20",
+	"DX7_PARAM_11": "0:21,1:21",
+}
+
+def quiet_print(*args, **kwargs):
+	pass
+
+def build_legacy_handle_cc(dx7):
+	DX7_PARAMETERS = dx7["DX7_PARAMETERS"]
+	CONTROL_BANKS = dx7["CONTROL_BANKS"]
+	remap_cc_value = dx7["remap_cc_value"]
+	set_parameter = dx7["set_parameter"]
+	switch_bank = dx7["switch_bank"]
+	device = dx7["devices"][0]
+	bank_cc_controls = dict(device.bank_cc_controls)
+	snapshot_cc_controls = dict(device.snapshot_cc_controls)
+	direct_cc_mappings = defaultdict(list, { key: list(param_ids) for key, param_ids in device.direct_cc_mappings.items() })
+
+	def handle_cc(cc_channel, cc_id, cc_value):
+		# No snapshot CCs are configured, only the lookup cost is kept.
+		snapshot_cc_controls.get((cc_channel, cc_id))
+
+		if cc_id in bank_cc_controls:
+			id = bank_cc_controls[cc_id]
+			if id == 0:
+				switch_bank(device, remap_cc_value(cc_value, 0, len(CONTROL_BANKS) - 1))
+			else:
+				bank = CONTROL_BANKS[device.bank]
+				id -= 1
+				if id < len(bank["parameters"]):
+					param_id = bank["parameters"][id]
+					param_value = remap_cc_value(cc_value, DX7_PARAMETERS[param_id]["min"], DX7_PARAMETERS[param_id]["max"])
+					set_parameter(device, param_id, param_value)
+
+		for param_id in direct_cc_mappings[(cc_channel, cc_id)]:
+			param_value = remap_cc_value(cc_value, DX7_PARAMETERS[param_id]["min"], DX7_PARAMETERS[param_id]["max"])
+			set_parameter(device, param_id, param_value)
+
+	return handle_cc, direct_cc_mappings
+
+# A mix of bank knob sweeps, direct mappings and unmapped CCs from a streaming controller.
+def build_stream(count):
+	stream = []
+	for i in range(count):
+		kind = i % 4
+		value = i % 128
+		if kind == 0:
+			stream.append(ControlChangeEvent(0, 1 + (i >> 2) % 7, value))
+		elif kind == 1:
+			stream.append(ControlChangeEvent(0, 20, value))
+		elif kind == 2:
+			stream.append(ControlChangeEvent(1, 21, value))
+		else:
+			stream.append(ControlChangeEvent((i >> 2) % 16, 64 + (i >> 6) % 64, value))
+	return stream
+
+def measure(handle_cc, stream):
+	start = perf_counter()
+	for event in stream:
+		handle_cc(event.channel, event.control, event.value)
+	return (perf_counter() - start) / len(stream)
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	dx7, pimidipy = load_script(SCRIPT, ENV, { "print": quiet_print })
+	legacy_handle_cc, legacy_mappings = build_legacy_handle_cc(dx7)
+	stream = build_stream(count)
+
+	# Warm up both paths, then take the best of a few runs.
+	measure(legacy_handle_cc, stream[:1000])
+	measure(dx7["handle_cc"], stream[:1000])
+	legacy = min(measure(legacy_handle_cc, stream) for i in range(3))
+	compiled = min(measure(dx7["handle_cc"], stream) for i in range(3))
+	scheduler_stats = dx7["devices"][0].scheduler.stats()
+
+	dx7, pimidipy = load_script(SCRIPT, { "DX7_DEVICES": "16" }, { "print": quiet_print })
+	measure(dx7["handle_cc"], stream[:1000])
+	devices = min(measure(dx7["handle_cc"], stream) for i in range(3))
+
+	print("events:             {}".format(count))
+	print("dict lookups:       {:.3f} us/event".format(legacy * 1e6))
+	print("compiled tables:    {:.3f} us/event".format(compiled * 1e6))
+	print("speedup:            {:.2f}x".format(legacy / compiled))
+	print("16 devices:         {:.3f} us/event".format(devices * 1e6))
+	print("legacy mapping dict grew to {} entries".format(len(legacy_mappings)))
+	print("scheduler:          {}".format(scheduler_stats))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Measures dx7.py's cartridge library (samples/common/dx7_library.py) on a generated set of 32-voice
+# cartridges, a quarter of the voices being copies of voices found in other cartridges:
+#
+# cold start - the first start, every cartridge gets memory-mapped, unpacked and indexed.
+# warm start - the following starts, the index is loaded and the cartridges only get stat()ed.
+# recall     - a Program Change, from the event to the VCED dump written out, compared with
+#              reading and unpacking the voice from its cartridge file on every Program Change.
+#
+# The generated cartridges are also unpacked back and checked against the voices they were made of.
+#
+# Usage: python3 benchmarks/dx7_library.py [cartridge_count]
+
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+from fake_pimidipy import ProgramChangeEvent, load_script
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples")
+SCRIPT = os.path.join(SAMPLES_DIR, "dx7.py")
+
+sys.path.insert(0, SAMPLES_DIR)
+
+from common.dx7_library import Library, VCED_SIZE, VOICE_DUMP_SIZE, find_vmem, unpack_voice
+
+def quiet_print(*args, **kwargs):
+	pass
+
+def pack_operator(vced):
+	return bytes(vced[0:11]) + bytes([
+		vced[11] | vced[12] << 2,
+		vced[13] | vced[20] << 3,
+		vced[14] | vced[15] << 2,
+		vced[16],
+		vced[17] | vced[18] << 1,
+		vced[19],
+	])
+
+# Packs the 155 VCED parameters of a voice into the 128 byte VMEM format of a cartridge.
+def pack_voice(vced):
+	packed = b"".join(pack_operator(vced[op * 21:op * 21 + 21]) for op in range(6))
+	packed += bytes(vced[126:134])
+	packed += bytes([ vced[134], vced[135] | vced[136] << 3 ])
+	packed += bytes(vced[137:141])
+	packed += bytes([ vced[141] | vced[142] << 1 | vced[143] << 4, vced[144] ])
+	packed += bytes(vced[145:155])
+	return packed
+
+def random_voice(rng, limits, number):
+	vced = bytearray(rng.randint(0, limit) for limit in limits)
+	vced[145:155] = "VOICE{:05}".format(number).encode()
+	return bytes(vced)
+
+def write_cartridge(file_name, voices):
+	vmem = b"".join(pack_voice(voice) for voice in voices)
+	with open(file_name, "wb") as f:
+		f.write(bytes([ 0xf0, 0x43, 0x00, 0x09, 0x20, 0x00 ]) + vmem + bytes([ -sum(vmem) & 0x7f, 0xf7 ]))
+
+def generate(folder, count, limits):
+	rng = random.Random(7)
+	voices = []
+	cartridges = []
+	for i in range(count):
+		cartridge = []
+		for j in range(32):
+			if voices and rng.random() < 0.25:
+				cartridge.append(rng.choice(voices))
+			else:
+				voice = random_voice(rng, limits, len(voices))
+				voices.append(voice)
+				cartridge.append(voice)
+		cartridges.append(cartridge)
+		write_cartridge(os.path.join(folder, "cart{:04}.syx".format(i)), cartridge)
+	return cartridges
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+	with tempfile.TemporaryDirectory() as folder:
+		cartridge_dir = os.path.join(folder, "cartridges")
+		index_dir = os.path.join(folder, "index")
+		os.makedirs(cartridge_dir)
+		# dx7.py is loaded a first time without the library, for the parameter limits to generate voices with.
+		env = { "DX7_LIBRARY_DIR": "", "DX7_LIBRARY_INDEX_DIR": index_dir, "DX7_OUTPUT_BYTES_PER_SEC": "1000000000", "PIMIDIPY_LOG_LEVEL": "error" }
+		dx7, pimidipy = load_script(SCRIPT, env, { "print": quiet_print })
+		limits = bytes(parameter["max"] for parameter in dx7["DX7_PARAMETERS"][:VCED_SIZE])
+		cartridges = generate(cartridge_dir, count, limits)
+
+		start = perf_counter()
+		library = Library(cartridge_dir, index_dir, limits)
+		library.open()
+		cold = perf_counter() - start
+
+		start = perf_counter()
+		warm_library = Library(cartridge_dir, index_dir, limits)
+		warm_library.open()
+		warm = perf_counter() - start
+
+		for cartridge, voices in enumerate(cartridges):
+			for program, voice in enumerate(voices):
+				if library.dump(library.voice_id(cartridge, program))[6:6 + VCED_SIZE] != voice:
+					raise AssertionError("Voice {} of cartridge {} differs".format(program, cartridge))
+
+		# Recall through dx7.py, which opens the library indexed above.
+		dx7, pimidipy = load_script(SCRIPT, { "DX7_LIBRARY_DIR": cartridge_dir }, { "print": quiet_print })
+		# Opened here in case the script left it to be opened later, see PIMIDIPY_OPEN_OUTPUTS.
+		output = pimidipy.open_output(pimidipy.get_output_port(0))
+		callback = pimidipy.inputs[pimidipy.get_input_port(0)].callbacks[0]
+		events = [ ProgramChangeEvent(0, program) for program in range(128) ] * 20
+		start = perf_counter()
+		for event in events:
+			callback(event)
+		recall = (perf_counter() - start) / len(events)
+		if dx7["devices"][0].scheduler.bulk_dumps != len(events) or output.bytes < len(events) * VOICE_DUMP_SIZE:
+			raise AssertionError("Program Changes didn't all send a voice dump")
+
+		files = sorted(os.listdir(cartridge_dir))
+		start = perf_counter()
+		for event in events:
+			with open(os.path.join(cartridge_dir, files[event.value // 32]), "rb") as f:
+				vmem = find_vmem(f.read())
+			unpack_voice(vmem[(event.value % 32) * 128:(event.value % 32 + 1) * 128], limits)
+		parse = (perf_counter() - start) / len(events)
+
+		print("cartridges:         {}".format(count))
+		print("distinct voices:    {} ({} duplicates)".format(library.voice_count(), library.duplicate_count()))
+		print("index size:         {} KiB".format(sum(os.path.getsize(os.path.join(index_dir, name)) for name in os.listdir(index_dir)) // 1024))
+		print("cold start:         {:.0f} ms".format(cold * 1000))
+		print("warm start:         {:.0f} ms".format(warm * 1000))
+		print("recall:             {:.1f} us per Program Change".format(recall * 1e6))
+		print("parse per recall:   {:.1f} us per Program Change".format(parse * 1e6))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# A stand-in for the pimidipy module, so the sample scripts can be loaded and benchmarked without
+# ALSA or any Pimidi hardware.
+#
+# load_script() runs a script with the fake module in place of pimidipy. The script's final
+# pimidipy.run() call returns immediately, leaving the opened ports and the registered callbacks
+# behind, so events can be fed to the callbacks directly.
+
+import os
+import runpy
+import sys
+import types
+
+class Event:
+	__slots__ = ()
+
+	def __repr__(self):
+		return "{}({})".format(type(self).__name__, ", ".join("{}={}".format(name, getattr(self, name)) for name in self.__slots__))
+
+class NoteOnEvent(Event):
+	__slots__ = ("channel", "note", "velocity")
+
+	def __init__(self, channel, note, velocity):
+		self.channel = channel
+		self.note = note
+		self.velocity = velocity
+
+class NoteOffEvent(Event):
+	__slots__ = ("channel", "note", "velocity")
+
+	def __init__(self, channel, note, velocity):
+		self.channel = channel
+		self.note = note
+		self.velocity = velocity
+
+class ControlChangeEvent(Event):
+	__slots__ = ("channel", "control", "value")
+
+	def __init__(self, channel, control, value):
+		self.channel = channel
+		self.control = control
+		self.value = value
+
+class AftertouchEvent(Event):
+	__slots__ = ("channel", "note", "value")
+
+	def __init__(self, channel, note, value):
+		self.channel = channel
+		self.note = note
+		self.value = value
+
+class ProgramChangeEvent(Event):
+	__slots__ = ("channel", "value")
+
+	def __init__(self, channel, program):
+		self.channel = channel
+		self.value = program
+
+class ChannelPressureEvent(Event):
+	__slots__ = ("channel", "value")
+
+	def __init__(self, channel, value):
+		self.channel = channel
+		self.value = value
+
+class PitchBendEvent(Event):
+	__slots__ = ("channel", "value")
+
+	def __init__(self, channel, value):
+		self.channel = channel
+		self.value = value
+
+class Control14BitChangeEvent(Event):
+	__slots__ = ("channel", "control", "value")
+
+	def __init__(self, channel, control, value):
+		self.channel = channel
+		self.control = control
+		self.value = value
+
+class NRPNChangeEvent(Event):
+	__slots__ = ("channel", "param", "value")
+
+	def __init__(self, channel, param, value):
+		self.channel = channel
+		self.param = param
+		self.value = value
+
+class RPNChangeEvent(NRPNChangeEvent):
+	__slots__ = ()
+
+class SongPositionPointerEvent(Event):
+	__slots__ = ("position",)
+
+	def __init__(self, position):
+		self.position = position
+
+class SongSelectEvent(Event):
+	__slots__ = ("song",)
+
+	def __init__(self, song):
+		self.song = song
+
+class StartEvent(Event):
+	__slots__ = ()
+
+class ContinueEvent(Event):
+	__slots__ = ()
+
+class StopEvent(Event):
+	__slots__ = ()
+
+class ClockEvent(Event):
+	__slots__ = ()
+
+class TuneRequestEvent(Event):
+	__slots__ = ()
+
+class ResetEvent(Event):
+	__slots__ = ()
+
+class ActiveSensingEvent(Event):
+	__slots__ = ()
+
+class SysExEvent(Event):
+	__slots__ = ("data",)
+
+	def __init__(self, data):
+		self.data = bytes(data)
+
+class MidiBytesEvent(Event):
+	__slots__ = ("data",)
+
+	def __init__(self, data):
+		self.data = bytes(data)
+
+EVENT_CLASSES = (
+	NoteOnEvent,
+	NoteOffEvent,
+	ControlChangeEvent,
+	AftertouchEvent,
+	ProgramChangeEvent,
+	ChannelPressureEvent,
+	PitchBendEvent,
+	Control14BitChangeEvent,
+	NRPNChangeEvent,
+	RPNChangeEvent,
+	SongPositionPointerEvent,
+	SongSelectEvent,
+	StartEvent,
+	ContinueEvent,
+	StopEvent,
+	ClockEvent,
+	TuneRequestEvent,
+	ResetEvent,
+	ActiveSensingEvent,
+	SysExEvent,
+	MidiBytesEvent,
+)
+
+class FakeInputPort:
+	def __init__(self, name):
+		self.name = name
+		self.callbacks = []
+
+	def add_callback(self, callback):
+		self.callbacks.append(callback)
+
+	def remove_callback(self, callback):
+		self.callbacks.remove(callback)
+
+	def close(self):
+		pass
+
+class FakeOutputPort:
+	def __init__(self, name):
+		self.name = name
+		self.events = 0
+		self.bytes = 0
+
+	# Only events are taken, like the samples are meant to write them, raw bytes are refused.
+	def write(self, event, drain=True):
+		if not isinstance(event, Event):
+			raise TypeError("Not a pimidipy event: {!r}".format(event))
+		self.events += 1
+		if isinstance(event, (SysExEvent, MidiBytesEvent)):
+			self.bytes += len(event.data)
+			return len(event.data)
+		return 0
+
+	def close(self):
+		pass
+
+class PimidiPy:
+	instances = []
+
+	def __init__(self, client_name="pimidipy"):
+		self.inputs = {}
+		self.outputs = {}
+		PimidiPy.instances.append(self)
+
+	@staticmethod
+	def get_port(id, input):
+		port = os.getenv("PORT_{}_{}".format("IN" if input else "OUT", id), None)
+		if port is not None:
+			return port
+		return "pimidi{}:{}".format(id // 2, id % 2)
+
+	@staticmethod
+	def get_input_port(id):
+		return PimidiPy.get_port(id, True)
+
+	@staticmethod
+	def get_output_port(id):
+		return PimidiPy.get_port(id, False)
+
+	def open_input(self, port):
+		if isinstance(port, int):
+			port = self.get_input_port(port)
+		return self.inputs.setdefault(port, FakeInputPort(port))
+
+	def open_output(self, port):
+		if isinstance(port, int):
+			port = self.get_output_port(port)
+		return self.outputs.setdefault(port, FakeOutputPort(port))
+
+	def drain_output(self):
+		pass
+
+	def quit(self):
+		pass
+
+	def run(self):
+		pass
+
+def build_module():
+	module = types.ModuleType("pimidipy")
+	module.PimidiPy = PimidiPy
+	for cls in EVENT_CLASSES:
+		setattr(module, cls.__name__, cls)
+	return module
+
+def load_script(script_path, env=None, init_globals=None):
+	if env is not None:
+		os.environ.update(env)
+	sys.modules["pimidipy"] = build_module()
+	PimidiPy.instances.clear()
+	# Like when running the script directly, its folder comes first in the module search path.
+	script_dir = os.path.dirname(os.path.abspath(script_path))
+	if sys.path[0] != script_dir:
+		sys.path.insert(0, script_dir)
+	namespace = runpy.run_path(script_path, init_globals=init_globals)
+	return namespace, PimidiPy.instances[-1]
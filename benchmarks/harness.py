@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Latency and throughput benchmark of the sample scripts, runs headless using the stand-in pimidipy.
+#
+# Each script is loaded and fed with event streams through its input callbacks:
+#
+# notes - a dense passage of 4 note chords.
+# cc    - knob sweeps over the first 8 CCs (dx7.py's default bank controls) on channel 1.
+# clock - 24 ppqn clock with start/stop and a note every beat.
+# sysex - bursts of DX7 voice dumps and parameter changes.
+#
+# A recorded stream can be used as well, either a file of raw MIDI bytes (as recorded by
+# 'amidi -p hw:... -r file.raw') or a .syx file.
+#
+# For every script and stream the p50/p99/max callback duration, events per second and the memory
+# allocated per event are reported. The memory is measured in a separate pass with tracemalloc:
+# the peak of the bytes allocated during a callback, and the memory blocks that remain allocated
+# after it. The results are appended to benchmarks/results.jsonl and compared with the previous run
+# of the same script and stream on the same machine.
+#
+# Usage: python3 benchmarks/harness.py [--scripts thru,chord,dx7] [--streams notes,cc,clock,sysex]
+#                                      [--record file.raw] [--events n] [--output results.jsonl]
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter_ns, time
+
+import fake_pimidipy
+from fake_pimidipy import (
+	ClockEvent,
+	ControlChangeEvent,
+	NoteOffEvent,
+	NoteOnEvent,
+	StartEvent,
+	StopEvent,
+	SysExEvent,
+	load_script,
+)
+
+# Keep the scripts' own logging out of the measurements and the report.
+os.environ.setdefault("PIMIDIPY_LOG_LEVEL", "error")
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLES_DIR = os.path.join(BENCHMARKS_DIR, "..", "samples")
+
+sys.path.insert(0, SAMPLES_DIR)
+
+from common.midi import decode_midi_bytes
+
+SCRIPTS = [ "thru", "chord", "dx7" ]
+STREAMS = [ "notes", "cc", "clock", "sysex" ]
+
+# The callbacks are timed, the events before that only warm up the caches and the tables.
+WARMUP_EVENTS = 1000
+
+# A run that's slower than the previous one by more than this is reported as a regression.
+REGRESSION_THRESHOLD = 0.2
+
+def quiet_print(*args, **kwargs):
+	pass
+
+def notes_stream(count):
+	events = []
+	chord = (0, 4, 7, 11)
+	i = 0
+	while len(events) < count:
+		root = 36 + i * 5 % 48
+		channel = i % 4
+		events.extend(NoteOnEvent(channel, root + n, 100) for n in chord)
+		events.extend(NoteOffEvent(channel, root + n, 0) for n in chord)
+		i += 1
+	return events[:count]
+
+def cc_stream(count):
+	sweep = list(range(128)) + list(range(127, -1, -1))
+	return [ ControlChangeEvent(0, i % 8, sweep[i // 8 % len(sweep)]) for i in range(count) ]
+
+def clock_stream(count):
+	events = [ StartEvent() ]
+	while len(events) < count:
+		events.append(ClockEvent())
+		if len(events) % 24 == 0:
+			events.append(NoteOnEvent(9, 36, 100))
+			events.append(NoteOffEvent(9, 36, 0))
+		if len(events) % (24 * 64) == 0:
+			events.append(StopEvent())
+			events.append(StartEvent())
+	return events[:count]
+
+def sysex_stream(count):
+	voice = bytes([ 0xf0, 0x43, 0x00, 0x00, 0x01, 0x1b ]) + bytes(i % 100 for i in range(155)) + bytes([ 0x00, 0xf7 ])
+	events = []
+	i = 0
+	while len(events) < count:
+		events.append(SysExEvent(voice))
+		events.extend(SysExEvent([ 0xf0, 0x43, 0x10, 0x01, n, i % 100, 0xf7 ]) for n in range(16))
+		i += 1
+	return events[:count]
+
+STREAM_BUILDERS = {
+	"notes": notes_stream,
+	"cc": cc_stream,
+	"clock": clock_stream,
+	"sysex": sysex_stream,
+}
+
+def load_recording(path, count):
+	with open(path, "rb") as f:
+		events = decode_midi_bytes(fake_pimidipy, f.read())
+	if not events:
+		raise ValueError("No events in {}".format(path))
+	# Loop the recording until there's enough events.
+	return (events * (count // len(events) + 1))[:count]
+
+def load(script):
+	namespace, pimidipy = load_script(os.path.join(SAMPLES_DIR, script + ".py"), init_globals={ "print": quiet_print })
+	callbacks = next(port.callbacks for port in pimidipy.inputs.values() if port.callbacks)
+	return namespace, callbacks
+
+def percentile(sorted_values, p):
+	return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+def measure_latency(callbacks, events):
+	durations = []
+	append = durations.append
+	for event in events:
+		start = perf_counter_ns()
+		for callback in callbacks:
+			callback(event)
+		append(perf_counter_ns() - start)
+	return durations
+
+def measure_allocations(callbacks, events):
+	peaks = 0
+	gc.collect()
+	tracemalloc.start()
+	blocks = sys.getallocatedblocks()
+	for event in events:
+		tracemalloc.reset_peak()
+		before = tracemalloc.get_traced_memory()[0]
+		for callback in callbacks:
+			callback(event)
+		peaks += tracemalloc.get_traced_memory()[1] - before
+	retained = sys.getallocatedblocks() - blocks
+	tracemalloc.stop()
+	return peaks / len(events), retained / len(events)
+
+def run(script, stream_name, events):
+	namespace, callbacks = load(script)
+	measure_latency(callbacks, events[:WARMUP_EVENTS])
+	durations = measure_latency(callbacks, events)
+	# A fresh copy of the script for the allocation pass, so it starts from the same state.
+	namespace, callbacks = load(script)
+	measure_latency(callbacks, events[:WARMUP_EVENTS])
+	alloc_bytes, retained_blocks = measure_allocations(callbacks, events[:min(len(events), 20000)])
+	durations.sort()
+	return {
+		"script": script,
+		"stream": stream_name,
+		"events": len(events),
+		"p50_us": percentile(durations, 50) / 1000,
+		"p99_us": percentile(durations, 99) / 1000,
+		"max_us": durations[-1] / 1000,
+		"events_per_sec": len(durations) * 1e9 / sum(durations),
+		"alloc_bytes_per_event": alloc_bytes,
+		"retained_blocks_per_event": retained_blocks,
+	}
+
+def git_revision():
+	try:
+		return subprocess.run([ "git", "rev-parse", "--short", "HEAD" ], cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def load_previous(path, host):
+	previous = {}
+	if os.path.exists(path):
+		with open(path) as f:
+			for line in f:
+				result = json.loads(line)
+				if result.get("host") == host:
+					previous[(result["script"], result["stream"])] = result
+	return previous
+
+def compare(result, previous):
+	if previous is None:
+		return ""
+	notes = []
+	if result["p99_us"] > previous["p99_us"] * (1 + REGRESSION_THRESHOLD):
+		notes.append("p99 {:+.0f}%".format(100 * (result["p99_us"] / previous["p99_us"] - 1)))
+	if result["events_per_sec"] < previous["events_per_sec"] / (1 + REGRESSION_THRESHOLD):
+		notes.append("events/s {:+.0f}%".format(100 * (result["events_per_sec"] / previous["events_per_sec"] - 1)))
+	if notes:
+		return "REGRESSION vs {}: {}".format(previous.get("revision"), ", ".join(notes))
+	return ""
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the sample scripts with synthetic or recorded MIDI streams.")
+	parser.add_argument("--scripts", default=",".join(SCRIPTS), help="comma separated scripts to run, default: %(default)s")
+	parser.add_argument("--streams", default=",".join(STREAMS), help="comma separated streams to feed, default: %(default)s")
+	parser.add_argument("--record", action="append", default=[], help="raw MIDI or .syx file to use as an additional stream")
+	parser.add_argument("--events", type=int, default=100000, help="events per stream, default: %(default)s")
+	parser.add_argument("--output", default=os.path.join(BENCHMARKS_DIR, "results.jsonl"), help="file to append the results to, default: %(default)s")
+	args = parser.parse_args()
+
+	streams = {}
+	for name in args.streams.split(","):
+		if name not in STREAM_BUILDERS:
+			parser.error("Unknown stream '{}'".format(name))
+		streams[name] = STREAM_BUILDERS[name](args.events)
+	for path in args.record:
+		streams[os.path.basename(path)] = load_recording(path, args.events)
+
+	host = platform.node()
+	previous = load_previous(args.output, host)
+	revision = git_revision()
+
+	print("{:<6} {:<12} {:>9} {:>9} {:>10} {:>12} {:>12} {:>10}".format("script", "stream", "p50 us", "p99 us", "max us", "events/s", "alloc B/ev", "kept/ev"))
+	results = []
+	for script in args.scripts.split(","):
+		if script not in SCRIPTS:
+			parser.error("Unknown script '{}'".format(script))
+		for name, events in streams.items():
+			result = run(script, name, events)
+			result.update({ "time": time(), "host": host, "machine": platform.machine(), "python": platform.python_version(), "revision": revision })
+			results.append(result)
+			print("{:<6} {:<12} {:>9.2f} {:>9.2f} {:>10.1f} {:>12.0f} {:>12.1f} {:>10.3f} {}".format(
+				script,
+				name,
+				result["p50_us"],
+				result["p99_us"],
+				result["max_us"],
+				result["events_per_sec"],
+				result["alloc_bytes_per_event"],
+				result["retained_blocks_per_event"],
+				compare(result, previous.get((script, name)))
+				))
+
+	with open(args.output, "a") as f:
+		for result in results:
+			f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+	main()
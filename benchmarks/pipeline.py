@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Measures the end-to-end latency and the throughput of a 3 stage pipeline (samples/pipeline.py):
+# chord.py -> dx7.py -> thru.py, each stage in its own process pinned to its own CPU where there
+# are enough of them. The benchmark feeds the ring of the first stage from a separate process and
+# reads the ring written by the last one.
+#
+# throughput - notes and CCs written to the first ring as fast as it takes them.
+# latency    - the same stream paced at --rate events per second, the time from the write to the
+#              first ring until the bytes come out of the last one.
+#
+# The output pacing of dx7.py and thru.py is disabled (set to an unreachable byte rate), so the
+# numbers show the cost of the stages and of the rings rather than of a DIN MIDI link.
+#
+# Usage: python3 benchmarks/pipeline.py [--events n] [--rate events/s] [--cpus 1,2,3]
+
+import argparse
+import os
+import sys
+from time import perf_counter_ns, sleep
+
+import fake_pimidipy
+from fake_pimidipy import ControlChangeEvent, NoteOffEvent, NoteOnEvent
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLES_DIR = os.path.join(BENCHMARKS_DIR, "..", "samples")
+
+SCRIPTS = [ "chord", "dx7", "thru" ]
+
+ENV = {
+	"PIMIDIPY_LOG_LEVEL": "error",
+	"DX7_OUTPUT_BYTES_PER_SEC": "1000000000",
+	"THRU_OUTPUT_BYTES_PER_SEC": "1000000000",
+	"THRU_QUEUE_SIZE": "1000000",
+}
+
+os.environ.update(ENV)
+sys.path.insert(0, SAMPLES_DIR)
+
+from common.midi import Decoder, build_encoders
+from common.pipeline import PIPELINE_RING_SIZE, Stage, start_stages, wait_stages
+from common.ring import Ring
+
+def quiet_print(*args, **kwargs):
+	pass
+
+# Notes for chord.py to turn into chords, with CCs in between for dx7.py to map to parameter changes.
+def build_stream(count):
+	stream = []
+	for i in range(count):
+		kind = i % 4
+		note = 36 + (i >> 2) % 48
+		if kind == 0:
+			event = NoteOnEvent(0, note, 100)
+		elif kind == 1:
+			event = ControlChangeEvent(0, 1 + (i >> 2) % 8, i % 128)
+		elif kind == 2:
+			event = NoteOffEvent(0, note, 0)
+		else:
+			event = ControlChangeEvent(1, 74, i % 128)
+		stream.append(event)
+	encoders = build_encoders(fake_pimidipy)
+	return [ encoders[type(event)](event) for event in stream ]
+
+def percentile(sorted_values, p):
+	return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+def feed(producer, stream, rate):
+	interval = int(1e9 / rate) if rate else 0
+	due = perf_counter_ns()
+	for data in stream:
+		if interval:
+			due += interval
+			delay = due - perf_counter_ns()
+			if delay > 0:
+				sleep(delay / 1e9)
+		producer.write(data)
+	producer.close()
+
+# Runs the stream through a fresh pipeline, returns the latency of every write coming out of it,
+# the number of events in them, and the time from the first write in to the last write out.
+def run(stream, rate, cpus):
+	rings = [ Ring(PIPELINE_RING_SIZE) for i in range(len(SCRIPTS) + 1) ]
+	stages = [
+		Stage(os.path.join(SAMPLES_DIR, script + ".py"), rings[i], rings[i + 1], SCRIPTS[i - 1] if i else "source", cpus[i] if i < len(cpus) else -1, { "print": quiet_print })
+		for i, script in enumerate(SCRIPTS)
+	]
+	pids = start_stages(stages, fake_pimidipy.build_module)
+
+	# A clock goes through first, to not count the time the stages take to start.
+	producer = rings[0].producer()
+	consumer = rings[-1].consumer()
+	producer.write(b"\xf8")
+	while consumer.read() is None:
+		sleep(0.001)
+
+	start = perf_counter_ns()
+	source = os.fork()
+	if source == 0:
+		feed(producer, stream, rate)
+		os._exit(0)
+
+	decoder = Decoder(fake_pimidipy)
+	events = []
+	latencies = []
+	end = start
+	while not consumer.finished():
+		record = consumer.read()
+		if record is None:
+			sleep(0.0001)
+			continue
+		end = perf_counter_ns()
+		latencies.append(end - record[0])
+		decoder.decode(record[1], events.append)
+	os.waitpid(source, 0)
+	wait_stages(pids)
+	return latencies, len(events), end - start
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark a chord.py -> dx7.py -> thru.py pipeline.")
+	parser.add_argument("--events", type=int, default=100000, help="events to feed, default: %(default)s")
+	parser.add_argument("--rate", type=int, default=1000, help="events per second for the latency run, default: %(default)s")
+	parser.add_argument("--cpus", default="1,2,3", help="CPUs to pin the stages to, default: %(default)s")
+	args = parser.parse_args()
+
+	cpu_count = os.cpu_count()
+	cpus = [ int(cpu) for cpu in args.cpus.split(",") ]
+	cpus = [ cpu if cpu < cpu_count else -1 for cpu in cpus ]
+	stream = build_stream(args.events)
+
+	print("stages:     {} (CPUs {} of {})".format(" -> ".join(SCRIPTS), ",".join(str(cpu) for cpu in cpus), cpu_count))
+
+	latencies, events_out, elapsed = run(stream, 0, cpus)
+	print("throughput: {} events in, {} events out, {:.0f} events/s in, {:.0f} events/s out".format(len(stream), events_out, len(stream) / elapsed * 1e9, events_out / elapsed * 1e9))
+
+	paced = stream[:max(1, min(len(stream), args.rate * 5))]
+	latencies, events_out, elapsed = run(paced, args.rate, cpus)
+	latencies.sort()
+	print("latency:    {} events at {}/s, p50 {:.1f} us, p99 {:.1f} us, max {:.1f} us".format(
+		len(paced),
+		args.rate,
+		percentile(latencies, 50) / 1000,
+		percentile(latencies, 99) / 1000,
+		latencies[-1] / 1000
+		))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Measures how long the sample scripts take to start, until the first event is handled. Every run
+# starts a fresh interpreter which loads the script with PIMIDIPY_STARTUP_PROFILE=1 using the
+# stand-in pimidipy, feeds a note to its input as soon as it is ready, and prints the profile
+# (see samples/common/startup.py). The process phase includes loading the stand-in pimidipy, the
+# import phase doesn't include importing the real one.
+#
+# Each script is run with every PIMIDIPY_OPEN_OUTPUTS mode, dx7.py with 16 devices also with its
+# configuration cache missing (cold) and filled by the previous run (warm).
+#
+# Usage: python3 benchmarks/startup.py [--runs n]
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+from fake_pimidipy import NoteOnEvent, load_script
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLES_DIR = os.path.join(BENCHMARKS_DIR, "..", "samples")
+
+ENV = {
+	"PIMIDIPY_STARTUP_PROFILE": "1",
+	"PIMIDIPY_METRICS": "0",
+}
+
+MODES = [ "startup", "background", "write" ]
+
+def child(script):
+	namespace, pimidipy = load_script(os.path.join(SAMPLES_DIR, script + ".py"))
+	input = next(iter(pimidipy.inputs.values()))
+	for callback in input.callbacks:
+		callback(NoteOnEvent(0, 60, 100))
+	for thread in threading.enumerate():
+		if thread.name == "startup-report":
+			thread.join()
+
+def run(script, env):
+	result = subprocess.run([ sys.executable, __file__, "--child", script ], env=dict(os.environ, **ENV, **env), capture_output=True, text=True, check=True)
+	for line in result.stdout.splitlines():
+		if line.startswith("Startup: "):
+			return line[len("Startup: "):]
+	raise RuntimeError("No startup profile printed by {}: {}".format(script, result.stdout + result.stderr))
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--runs", type=int, default=3)
+	parser.add_argument("--child", help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.child:
+		child(args.child)
+		return
+
+	with tempfile.TemporaryDirectory() as cache_dir:
+		for script in [ "thru", "chord", "dx7" ]:
+			for mode in MODES:
+				for i in range(args.runs):
+					print("{:6} {:11} {}".format(script, mode, run(script, { "PIMIDIPY_OPEN_OUTPUTS": mode, "PIMIDIPY_CACHE_DIR": cache_dir })))
+		for i in range(args.runs):
+			os.unlink(os.path.join(cache_dir, "dx7.marshal"))
+			for cache in [ "cold", "warm" ]:
+				print("{:6} {:11} {}".format("dx7x16", cache, run("dx7", { "DX7_DEVICES": "16", "PIMIDIPY_CACHE_DIR": cache_dir })))
+
+if __name__ == "__main__":
+	main()
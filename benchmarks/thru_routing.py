@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Measures the throughput of thru.py's routing across a full 4 unit Pimidi stack: events from all
+# 8 inputs on all 16 channels get routed through the compiled input x output x channel matrix.
+#
+# The output pacing is disabled (set to an unreachable byte rate), so the numbers show how many
+# events the script itself can route and write out.
+#
+# Usage: python3 benchmarks/thru_routing.py [event_count]
+
+import os
+import sys
+from time import perf_counter, sleep
+
+from fake_pimidipy import ClockEvent, ControlChangeEvent, NoteOffEvent, NoteOnEvent, load_script
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples", "thru.py")
+
+# Each input goes to 2 outputs, one of them only on its lower 8 channels.
+ENV = { "THRU_ROUTE_{}".format(i): "{},{}:0-7".format(i, (i + 1) % 8) for i in range(8) }
+ENV["THRU_OUTPUT_BYTES_PER_SEC"] = "1000000000"
+ENV["THRU_QUEUE_SIZE"] = "1000000"
+
+def quiet_print(*args, **kwargs):
+	pass
+
+def build_stream(count):
+	stream = []
+	for i in range(count):
+		channel = i % 16
+		kind = i % 6
+		if kind < 2:
+			event = NoteOnEvent(channel, 36 + i % 48, 100)
+		elif kind < 4:
+			event = NoteOffEvent(channel, 36 + i % 48, 0)
+		elif kind == 4:
+			event = ControlChangeEvent(channel, 1 + i % 8, i % 128)
+		else:
+			event = ClockEvent()
+		stream.append((i % 8, event))
+	return stream
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	thru, pimidipy = load_script(SCRIPT, ENV, { "print": quiet_print })
+	callbacks = [ pimidipy.inputs[pimidipy.get_input_port(i)].callbacks[0] for i in range(8) ]
+	stream = [ (callbacks[input_id], event) for input_id, event in build_stream(count) ]
+
+	start = perf_counter()
+	for callback, event in stream:
+		callback(event)
+	routed = perf_counter() - start
+
+	queues = thru["fan_out"].queues
+	while any(queues):
+		sleep(0.001)
+	delivered = perf_counter() - start
+	written = sum(output.events for output in pimidipy.outputs.values())
+
+	print("inputs x outputs:   8 x 8")
+	print("events:             {}".format(count))
+	print("callback cost:      {:.2f} us/event".format(routed / count * 1e6))
+	print("routed:             {:.0f} events/s".format(count / routed))
+	print("written to outputs: {} ({:.0f} writes/s incl. drain)".format(written, written / delivered))
+	print("CCs replaced:       {}".format(sum(queue.replaced for queue in queues)))
+	print("dropped:            {}".format(sum(queue.dropped for queue in queues)))
+	print("unrouted:           {}".format(thru["fan_out"].unrouted))
+
+if __name__ == "__main__":
+	main()
@@ -1,9 +1,28 @@
 #!/usr/bin/env python3
 
-from functools import partial
+from common.startup import first_event, mark, open_output
+from common.reload import hot_reload, keep
+hot_reload(__file__)
+
 from pimidipy import *
 pimidipy = PimidiPy()
 from os import getenv
+from time import perf_counter
+
+from common.log import Log, DEBUG
+from common.metrics import Metrics
+from common.realtime import RealTime
+
+mark('import')
+
+log = keep('log', Log)
+realtime = keep('realtime', lambda: RealTime(log))
+metrics = keep('metrics', lambda: Metrics('chord'))
+MSG_CHORD = log.message('chord', 'Producing chord, notes {data}', DEBUG)
+MSG_NOTE_OFFS = log.message('note_offs', 'Producing note offs, notes {data}', DEBUG)
+MSG_DISCARDED = log.message('discarded', '{b} chord note(s) for note {a} out of range, discarded', DEBUG)
+MSG_REPEATED = log.message('repeated', 'Note {a} on channel {b} is already held, note on ignored', DEBUG)
+MSG_RELEASED = log.message('released', 'Released {b} note(s) on channel {a}: {data}', DEBUG)
 
 # Get the semitones from the environment variable or use the default value.
 CHORD_SEMITONES = list(map(int, getenv('CHORD_SEMITONES', '0,4,7').split(',')))
@@ -11,32 +30,248 @@ CHORD_SEMITONES = list(map(int, getenv('CHORD_SEMITONES', '0,4,7').split(',')))
 # Eliminate duplicates, respecting the order.
 CHORD_SEMITONES = list(dict.fromkeys(CHORD_SEMITONES))
 
+# Set CHORD_NOTE_OFF_VELOCITY_0=1 in /etc/pimidipy.conf to send the note offs as note ons with
+# velocity 0, for devices that accept it. The note offs then share the status byte of the note ons,
+# so the MIDI encoder of the kernel can leave it out of the bytes sent (running status), the
+# velocity of the note offs is lost though. The number of status bytes it can leave out, counted
+# from the events written, is reported on exit.
+CHORD_NOTE_OFF_VELOCITY_0 = int(getenv('CHORD_NOTE_OFF_VELOCITY_0', 0)) != 0
+
+# The chord notes for every input note, out of range notes already discarded.
+CHORD_NOTES = [ tuple(note + semitone for semitone in CHORD_SEMITONES if 0 <= note + semitone <= 127) for note in range(128) ]
+
+CHORD_DISCARDED = [ len(CHORD_SEMITONES) - len(notes) for notes in CHORD_NOTES ]
+
+# A note on and a note off event is prebuilt for every note, only the channel and the velocity get
+# updated before writing them, so no event gets allocated per chord. The events are written without
+# draining the output, which is drained once the whole chord is written.
+NOTE_ONS = [ NoteOnEvent(0, note, 0) for note in range(128) ]
+NOTE_OFFS = [ NoteOffEvent(0, note, 0) for note in range(128) ]
+
+# Time to transmit a byte over the 31.25 kbaud DIN MIDI link.
+MIDI_BYTE_TIME = 10 / 31250
+
+# What goes out per chord. A note message repeating the status of the message before it can be sent
+# without its status byte, if the kernel applies running status, which is up to its MIDI driver.
+class BurstStats:
+	def __init__(self):
+		self.bursts = 0
+		self.messages = 0
+		self.repeated_status = 0
+		self.last_status = 0
+		self.write_time = 0.0
+		self.max_write_time = 0.0
+
+	def add(self, status, count, write_time):
+		if count == 0:
+			return
+		self.bursts += 1
+		self.messages += count
+		self.repeated_status += count - (status != self.last_status)
+		self.last_status = status
+		self.write_time += write_time
+		if write_time > self.max_write_time:
+			self.max_write_time = write_time
+
+	def report(self):
+		if self.bursts == 0:
+			return 'no chords sent'
+		return '{} chords, {} note messages, {} with the status of the message before ({:.1f} ms of {:.1f} ms on the wire), write and drain avg {:.0f} us max {:.0f} us'.format(
+			self.bursts,
+			self.messages,
+			self.repeated_status,
+			1000 * MIDI_BYTE_TIME * self.repeated_status,
+			1000 * MIDI_BYTE_TIME * 3 * self.messages,
+			1e6 * self.write_time / self.bursts,
+			1e6 * self.max_write_time
+			)
+
+stats = keep('stats', BurstStats)
+
+# The chord notes as logged.
+CHORD_DATA = [ bytes(notes) for notes in CHORD_NOTES ]
+
+mark('config')
+
 input = pimidipy.open_input(0)
-output = pimidipy.open_output(0)
+output = metrics.wrap_output(open_output(pimidipy, 0))
 
 print('Using input port {} and output port {}'.format(input.name, output.name))
 
-def produce_chord(event, semitones: list[int]):
-	if type(event) == NoteOnEvent:
-		print(f'Producing chord for {event}')
-		for semitone in semitones:
-			n = event.note + semitone
-			if n < 0 or n > 127:
-				print(f'Note {n} out of range, discarding')
-				continue
-			output.write(NoteOnEvent(event.channel, n, event.velocity))
-	elif type(event) == NoteOffEvent:
-		print(f'Producing note offs for {event}')
-		for semitone in semitones:
-			n = event.note + semitone
-			if n < 0 or n > 127:
-				print(f'Note {n} out of range, discarding')
-				continue
-			output.write(NoteOffEvent(event.channel, n, event.velocity))
+mark('ports')
+
+# Writes the note messages of the tones, 'status' being the note on or note off status byte of the
+# channel to write them on.
+def write_notes(status, tones, velocity):
+	if CHORD_NOTE_OFF_VELOCITY_0 and status & 0xf0 == 0x80:
+		status |= 0x10
+		velocity = 0
+	events = NOTE_ONS if status & 0xf0 == 0x90 else NOTE_OFFS
+	channel = status & 0x0f
+	start = perf_counter()
+	for tone in tones:
+		event = events[tone]
+		event.channel = channel
+		event.velocity = velocity
+		output.write(event, False)
+	pimidipy.drain_output()
+	stats.add(status, len(tones), perf_counter() - start)
+
+def write_chord(status, note, velocity):
+	write_notes(status, CHORD_NOTES[note], velocity)
+	return CHORD_DATA[note]
+
+# Writes the note messages of a part of a chord, when some of its tones were already sounding
+# (note ons) or are still held by other chords (note offs).
+def write_tones(status, tones, velocity):
+	write_notes(status, tones, velocity)
+	return bytes(tones)
+
+# The voice table, tracking what was actually sent, indexed by channel << 7 | note:
+#
+# tone_refs[i]      - the number of held chords the tone belongs to, a note off is only sent for
+#                     the tone once the last of them is released.
+# tone_sustained[i] - the tone was released while the sustain pedal was down and is still sounding.
+# held_chords[i]    - the chord tones the held input note turned on.
+#
+# A note on for a tone held by another chord is not sent again, a tone only sounding because of the
+# sustain pedal is ended and struck again, and a repeated note on for an input note that is still
+# held is ignored.
+tone_refs = keep('tone_refs', lambda: bytearray(16 << 7))
+tone_sustained = keep('tone_sustained', lambda: bytearray(16 << 7))
+held_chords = keep('held_chords', lambda: [ () ] * (16 << 7))
+sustain = keep('sustain', lambda: bytearray(16))
+
+NO_TONES = bytes(128)
+NO_CHORDS = [ () ] * 128
+
+SUSTAIN_PEDAL = 64
+
+# The channel mode messages that end all the notes of the channel: all sound off, all notes off,
+# omni off/on, mono and poly.
+ENDS_ALL_NOTES = bytes(1 if control in (120, 123, 124, 125, 126, 127) else 0 for control in range(128))
+
+def hold_chord(channel, note, velocity):
+	key = channel << 7 | note
+	if held_chords[key]:
+		log.log(MSG_REPEATED, 0, b'', note, channel)
+		return
+	tones = CHORD_NOTES[note]
+	held_chords[key] = tones
+	base = channel << 7
+	# The tones only left sounding by the sustain pedal are struck again, their note offs go first.
+	if tone_sustained.find(1, base, base + 128) >= 0:
+		retriggered = [ tone for tone in tones if tone_sustained[base | tone] ]
+		if retriggered:
+			log.log(MSG_NOTE_OFFS, 0, write_tones(0x80 | channel, retriggered, 0))
+	sounding = 0
+	for tone in tones:
+		if tone_refs[base | tone]:
+			sounding += 1
+	if sounding == 0:
+		log.log(MSG_CHORD, 0, write_chord(0x90 | channel, note, velocity))
+	elif sounding < len(tones):
+		log.log(MSG_CHORD, 0, write_tones(0x90 | channel, [ tone for tone in tones if not tone_refs[base | tone] ], velocity))
+	for tone in tones:
+		tone_refs[base | tone] += 1
+		tone_sustained[base | tone] = 0
+	if CHORD_DISCARDED[note]:
+		log.log(MSG_DISCARDED, 0, b'', note, CHORD_DISCARDED[note])
+
+def release_chord(status, channel, note, velocity):
+	key = channel << 7 | note
+	tones = held_chords[key]
+	if not tones:
+		return
+	held_chords[key] = ()
+	base = channel << 7
+	pedal = sustain[channel]
+	silenced = 0
+	for tone in tones:
+		refs = tone_refs[base | tone] - 1
+		tone_refs[base | tone] = refs
+		if refs == 0:
+			if pedal:
+				tone_sustained[base | tone] = 1
+			else:
+				silenced += 1
+	if silenced == len(tones) and tones is CHORD_NOTES[note]:
+		log.log(MSG_NOTE_OFFS, 0, write_chord(status | channel, note, velocity))
+	elif silenced:
+		log.log(MSG_NOTE_OFFS, 0, write_tones(status | channel, [ tone for tone in tones if tone_refs[base | tone] == 0 and not tone_sustained[base | tone] ], velocity))
+
+# Sends the note offs of the tones left sounding by the sustain pedal.
+def release_sustained(channel):
+	base = channel << 7
+	if tone_sustained.find(1, base, base + 128) < 0:
+		return
+	tones = [ tone for tone in range(128) if tone_sustained[base | tone] ]
+	tone_sustained[base:base + 128] = NO_TONES
+	log.log(MSG_NOTE_OFFS, 0, write_tones(0x80 | channel, tones, 0))
+
+# Sends the note offs of every tone sounding on the channel in a single write and clears its voices.
+def release_channel(channel):
+	base = channel << 7
+	if tone_refs[base:base + 128] == NO_TONES and tone_sustained[base:base + 128] == NO_TONES:
+		return
+	tones = [ tone for tone in range(128) if tone_refs[base | tone] or tone_sustained[base | tone] ]
+	tone_refs[base:base + 128] = NO_TONES
+	tone_sustained[base:base + 128] = NO_TONES
+	held_chords[base:base + 128] = NO_CHORDS
+	log.log(MSG_RELEASED, 0, write_tones(0x80 | channel, tones, 0), channel, len(tones))
+
+def produce_note_on(event):
+	if event.velocity:
+		hold_chord(event.channel, event.note, event.velocity)
 	else:
-		print(f'Passing event {event}')
-		output.write(event)
+		release_chord(0x90, event.channel, event.note, 0)
 
-input.add_callback(partial(produce_chord, semitones=CHORD_SEMITONES))
+def produce_note_off(event):
+	release_chord(0x80, event.channel, event.note, event.velocity)
+
+def pass_through(event):
+	output.write(event)
+	stats.last_status = 0
+
+def handle_control_change(event):
+	channel = event.channel
+	if event.control == SUSTAIN_PEDAL:
+		pass_through(event)
+		pedal = 1 if event.value >= 64 else 0
+		if sustain[channel] and not pedal:
+			release_sustained(channel)
+		sustain[channel] = pedal
+	elif ENDS_ALL_NOTES[event.control]:
+		release_channel(channel)
+		pass_through(event)
+	else:
+		pass_through(event)
+
+def handle_reset(event):
+	for channel in range(16):
+		release_channel(channel)
+	sustain[:] = bytes(16)
+	pass_through(event)
+
+EVENT_HANDLERS = {
+	NoteOnEvent: produce_note_on,
+	NoteOffEvent: produce_note_off,
+	ControlChangeEvent: handle_control_change,
+	ResetEvent: handle_reset,
+}
+
+def produce_chord(event):
+	EVENT_HANDLERS.get(type(event), pass_through)(event)
+
+metrics.gauge('repeated note status', lambda: stats.repeated_status)
+metrics.gauge('sounding tones', lambda: len(tone_refs) - tone_refs.count(0) + len(tone_sustained) - tone_sustained.count(0))
+
+input.add_callback(first_event(realtime.wrap(metrics.wrap(produce_chord, input.name))))
+
+realtime.start()
+
+mark('setup')
 
 pimidipy.run()
+
+print(stats.report())
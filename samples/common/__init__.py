@@ -0,0 +1,4 @@
+# Helpers shared by the sample scripts.
+#
+# This is a package rather than a .py file next to the scripts, so it does not show up as a script
+# to run. The scripts in the samples folder can import it directly, e.g. 'from common.log import Log'.
@@ -0,0 +1,49 @@
+# Cache of the tables the scripts compile from their configuration at startup.
+#
+# The scripts are configured through environment variables, set from /etc/pimidipy.conf. Turning
+# them into the tables a script works with, such as dx7.py's CC dispatch of every device and bank,
+# takes a while, and Patchbox restarts the script on every change of its file. cached() stores the
+# compiled tables in PIMIDIPY_CACHE_DIR along with the values of the variables they were compiled
+# from and the size and modification time of the script, and returns them as long as none of those
+# changed. The tables have to be plain data (dicts, lists, tuples, numbers, strings and bytes),
+# they're stored using marshal, which unlike pickle or json loads without importing anything.
+#
+# PIMIDIPY_CACHE_DIR=~/.pimidipy/cache  # Set to an empty value to not cache anything.
+
+import marshal
+import os
+import sys
+from os import getenv, path
+
+PIMIDIPY_CACHE_DIR = path.expanduser(getenv("PIMIDIPY_CACHE_DIR", "~/.pimidipy/cache"))
+
+# Returns the environment variables starting with any of the prefixes.
+def environment(prefixes):
+	return { name: value for name, value in os.environ.items() if name.startswith(prefixes) }
+
+# Returns build() as it was returned on a previous start if the script and the variables starting
+# with the prefixes are still the same, otherwise calls it and caches the result.
+def cached(script_file, prefixes, build):
+	if not PIMIDIPY_CACHE_DIR:
+		return build()
+	st = os.stat(script_file)
+	key = (sys.hexversion, st.st_size, st.st_mtime_ns, sorted(environment(prefixes).items()))
+	cache_file = path.join(PIMIDIPY_CACHE_DIR, path.splitext(path.basename(script_file))[0] + ".marshal")
+	try:
+		# marshal.load() reads the file in small pieces, which takes much longer.
+		with open(cache_file, "rb") as f:
+			cached_key, result = marshal.loads(f.read())
+		if cached_key == key:
+			return result
+	except (OSError, EOFError, ValueError, TypeError):
+		pass
+	result = build()
+	try:
+		os.makedirs(PIMIDIPY_CACHE_DIR, exist_ok=True)
+		temporary = "{}.{}.tmp".format(cache_file, os.getpid())
+		with open(temporary, "wb") as f:
+			f.write(marshal.dumps((key, result)))
+		os.replace(temporary, cache_file)
+	except (OSError, ValueError) as e:
+		print("Not caching the configuration in {}: {}".format(cache_file, e))
+	return result
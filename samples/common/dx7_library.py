@@ -0,0 +1,204 @@
+# Library of DX7 32-voice cartridges, for instant program recall by dx7.py.
+#
+# The cartridges (.syx files holding a 32 voice VMEM bulk dump, or the bare 4096 bytes of one) are
+# looked for in a folder and its subfolders. Parsing thousands of them on every start, or reading a
+# file on every program change, is too slow on an SD card, so they are indexed once:
+#
+# voices.syx - every distinct voice, unpacked into a ready to send 163 byte VCED single voice dump.
+#              Identical voices found in several cartridges are stored once. Being a plain series of
+#              dumps, other DX7 tools can load it as well.
+# index.json - the cartridges in the order they are selected in, each with its size and
+#              modification time and the voices.syx entries of its 32 voices, and the hash of every
+#              voice in voices.syx.
+#
+# On start, only the cartridges that are new or have changed since the index was written get
+# memory-mapped and parsed, their new voices are appended to voices.syx. A voices.syx shorter than
+# the index says gets rebuilt from all the cartridges. voices.syx is then memory-mapped, and
+# recalling a voice is an offset into it, the name of a voice is read from the dump when it's
+# needed.
+
+import hashlib
+import json
+import os
+from mmap import ACCESS_READ, mmap
+from os import path
+
+INDEX_VERSION = 1
+
+VMEM_SIZE = 4096
+VMEM_VOICE_SIZE = 128
+VOICES_PER_CARTRIDGE = 32
+VMEM_HEADER = bytes([ 0x09, 0x20, 0x00 ])
+
+VCED_SIZE = 155
+VOICE_DUMP_SIZE = 163
+VOICE_DUMP_HEADER = bytes([ 0xf0, 0x43, 0x00, 0x00, 0x01, 0x1b ])
+NAME_OFFSET = 145
+NAME_SIZE = 10
+
+# Unpacks the 17 bytes of an operator in a VMEM voice into its 21 VCED parameters.
+def unpack_operator(packed, vced):
+	vced += packed[0:11]
+	vced.append(packed[11] & 0x03)
+	vced.append(packed[11] >> 2 & 0x03)
+	vced.append(packed[12] & 0x07)
+	vced.append(packed[13] & 0x03)
+	vced.append(packed[13] >> 2 & 0x07)
+	vced.append(packed[14])
+	vced.append(packed[15] & 0x01)
+	vced.append(packed[15] >> 1 & 0x1f)
+	vced.append(packed[16])
+	vced.append(packed[12] >> 3 & 0x0f)
+
+# Unpacks a 128 byte VMEM voice into the 155 VCED parameters, clamped to 'limits'.
+def unpack_voice(packed, limits):
+	vced = bytearray()
+	for op in range(6):
+		unpack_operator(packed[op * 17:op * 17 + 17], vced)
+	vced += packed[102:110]
+	vced.append(packed[110] & 0x1f)
+	vced.append(packed[111] & 0x07)
+	vced.append(packed[111] >> 3 & 0x01)
+	vced += packed[112:116]
+	vced.append(packed[116] & 0x01)
+	vced.append(packed[116] >> 1 & 0x07)
+	vced.append(packed[116] >> 4 & 0x07)
+	vced.append(packed[117])
+	vced += packed[118:128]
+	return bytes(min(value & 0x7f, limit) for value, limit in zip(vced, limits))
+
+def build_voice_dump(vced):
+	return VOICE_DUMP_HEADER + vced + bytes([ -sum(vced) & 0x7f, 0xf7 ])
+
+# Returns the 4096 bytes of voice data of a cartridge file, or None if it isn't one.
+def find_vmem(data):
+	if len(data) == VMEM_SIZE:
+		return data
+	start = data.find(b"\xf0\x43")
+	if start >= 0 and data[start + 3:start + 6] == VMEM_HEADER and len(data) >= start + 6 + VMEM_SIZE:
+		return data[start + 6:start + 6 + VMEM_SIZE]
+	return None
+
+def voice_hash(vced):
+	return hashlib.blake2b(vced, digest_size=8).hexdigest()
+
+def find_cartridges(folder):
+	found = []
+	for root, dirs, files in os.walk(folder):
+		dirs.sort()
+		found += [ path.join(root, name) for name in sorted(files) if name.lower().endswith(".syx") ]
+	return found
+
+class Library:
+	def __init__(self, folder, index_dir, limits):
+		self.folder = folder
+		self.index_dir = index_dir
+		self.limits = limits
+		# Per cartridge, in selection order: the voice ids of its 32 voices.
+		self.cartridges = []
+		self.names = []
+		self.hashes = []
+		self.indexed = 0
+		self.skipped = 0
+		self._ids = {}
+		self._voices = None
+
+	def voice_count(self):
+		return len(self.hashes)
+
+	def duplicate_count(self):
+		return sum(len(voices) for voices in self.cartridges) - len(set(voice for voices in self.cartridges for voice in voices))
+
+	# Loads the index, indexes the new and changed cartridges and maps the voices.
+	def open(self):
+		index_file = path.join(self.index_dir, "index.json")
+		voices_file = path.join(self.index_dir, "voices.syx")
+		try:
+			with open(index_file) as f:
+				index = json.load(f)
+			if index.get("version") != INDEX_VERSION:
+				raise ValueError("Unknown index version")
+		except (OSError, ValueError):
+			index = { "version": INDEX_VERSION, "cartridges": {}, "hashes": [] }
+		self.hashes = index["hashes"]
+		self._ids = { voice: i for i, voice in enumerate(self.hashes) }
+		known = index["cartridges"]
+
+		os.makedirs(self.index_dir, exist_ok=True)
+		cartridges = {}
+		with open(voices_file, "ab+") as voices:
+			# voices.syx lost some of the indexed voices, index all the cartridges again.
+			if os.fstat(voices.fileno()).st_size < len(self.hashes) * VOICE_DUMP_SIZE:
+				self.hashes = []
+				self._ids = {}
+				known = {}
+			# Drop the voices appended by an update that didn't get to write its index.
+			voices.truncate(len(self.hashes) * VOICE_DUMP_SIZE)
+			for cartridge in find_cartridges(self.folder):
+				try:
+					st = os.stat(cartridge)
+				except OSError:
+					continue
+				name = path.relpath(cartridge, self.folder)
+				entry = known.get(name)
+				if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+					ids = self._index_cartridge(cartridge, voices)
+					if ids is None:
+						self.skipped += 1
+						continue
+					entry = { "size": st.st_size, "mtime_ns": st.st_mtime_ns, "voices": ids }
+					self.indexed += 1
+				cartridges[name] = entry
+
+		if self.indexed or len(cartridges) != len(known):
+			index = { "version": INDEX_VERSION, "cartridges": cartridges, "hashes": self.hashes }
+			temporary = index_file + ".tmp"
+			with open(temporary, "w") as f:
+				json.dump(index, f)
+			os.replace(temporary, index_file)
+
+		self.cartridges = [ entry["voices"] for entry in cartridges.values() ]
+		self.names = list(cartridges)
+		if self.hashes:
+			with open(voices_file, "rb") as f:
+				self._voices = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+	def _index_cartridge(self, cartridge, voices):
+		try:
+			with open(cartridge, "rb") as f:
+				if os.fstat(f.fileno()).st_size < VMEM_SIZE:
+					return None
+				with mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+					vmem = find_vmem(data)
+					if vmem is None:
+						return None
+					ids = []
+					for i in range(VOICES_PER_CARTRIDGE):
+						vced = unpack_voice(vmem[i * VMEM_VOICE_SIZE:(i + 1) * VMEM_VOICE_SIZE], self.limits)
+						ids.append(self._add_voice(vced, voices))
+					return ids
+		except OSError:
+			return None
+
+	def _add_voice(self, vced, voices):
+		key = voice_hash(vced)
+		voice_id = self._ids.get(key)
+		if voice_id is None:
+			voice_id = self._ids[key] = len(self.hashes)
+			self.hashes.append(key)
+			voices.write(build_voice_dump(vced))
+		return voice_id
+
+	# The voice id of a program of a cartridge, or None if there is no such cartridge.
+	def voice_id(self, cartridge, program):
+		if cartridge >= len(self.cartridges):
+			return None
+		return self.cartridges[cartridge][program % VOICES_PER_CARTRIDGE]
+
+	# The VCED dump of the voice, a view into the mapped voices.syx.
+	def dump(self, voice_id):
+		return memoryview(self._voices)[voice_id * VOICE_DUMP_SIZE:(voice_id + 1) * VOICE_DUMP_SIZE]
+
+	def name(self, voice_id):
+		offset = voice_id * VOICE_DUMP_SIZE + len(VOICE_DUMP_HEADER) + NAME_OFFSET
+		return self._voices[offset:offset + NAME_SIZE].decode("ascii", "replace").rstrip()
@@ -0,0 +1,166 @@
+# Logging for the MIDI event callbacks.
+#
+# Printing from a callback can block for milliseconds when stdout goes to journald or a slow tty.
+# Instead, log() stores a fixed-size record (timestamp, port, message id, two integer arguments and
+# up to RECORD_DATA_SIZE bytes of the event) into a preallocated ring buffer. A background thread
+# formats the records and writes them out in batches. When the ring buffer is full, new records are
+# dropped and counted.
+#
+# Messages are registered up front, each with a name, a verbosity level and a format, which is
+# either a string using the {port}, {data}, {a} and {b} fields, or a function taking a Record and
+# returning the text. A hot reloaded script registers its messages again on the same Log, which
+# replaces their format and level and keeps their ids. The level can be set in /etc/pimidipy.conf:
+#
+# PIMIDIPY_LOG_LEVEL=info  # One of error, warning, info or debug. Per-event messages are logged at debug.
+
+import atexit
+import sys
+from array import array
+from os import getenv
+from threading import Lock, Thread
+from time import localtime, sleep, strftime, time
+
+ERROR = 0
+WARNING = 1
+INFO = 2
+DEBUG = 3
+
+LEVEL_NAMES = { "error": ERROR, "warning": WARNING, "info": INFO, "debug": DEBUG }
+
+RECORD_DATA_SIZE = 16
+
+def level_from_env(default=INFO):
+	name = getenv("PIMIDIPY_LOG_LEVEL", None)
+	if name is None:
+		return default
+	level = LEVEL_NAMES.get(name.lower())
+	if level is None:
+		raise ValueError(f"Invalid PIMIDIPY_LOG_LEVEL '{name}', use one of {', '.join(LEVEL_NAMES)}")
+	return level
+
+class Record:
+	__slots__ = ("time", "port", "data", "length", "a", "b")
+
+	def __init__(self, time, port, data, length, a, b):
+		self.time = time
+		self.port = port
+		# The stored bytes, 'length' is the size of the logged data, which may have been longer.
+		self.data = data
+		self.length = length
+		self.a = a
+		self.b = b
+
+	def hex(self):
+		text = self.data.hex(" ")
+		if self.length > len(self.data):
+			text += " ... ({} bytes)".format(self.length)
+		return text
+
+class Log:
+	def __init__(self, size=4096, level=None, stream=None, interval=0.1):
+		if size & (size - 1):
+			raise ValueError("The ring buffer size must be a power of 2")
+		self.level = level_from_env() if level is None else level
+		self.stream = stream if stream is not None else sys.stdout
+		self.interval = interval
+		self.dropped = 0
+		self._size = size
+		self._mask = size - 1
+		self._ids_by_name = {}
+		self._formats = []
+		self._levels = bytearray()
+		self._times = array("d", [ 0.0 ]) * size
+		self._ids = array("H", [ 0 ]) * size
+		self._ports = array("h", [ 0 ]) * size
+		self._a = array("i", [ 0 ]) * size
+		self._b = array("i", [ 0 ]) * size
+		self._lengths = array("I", [ 0 ]) * size
+		self._data = bytearray(size * RECORD_DATA_SIZE)
+		self._head = 0
+		self._tail = 0
+		self._reported_dropped = 0
+		self._lock = Lock()
+		self._write_lock = Lock()
+		self._thread = Thread(target=self._run, name="log-writer", daemon=True)
+		self._thread.start()
+		atexit.register(self.flush)
+
+	# Registers a message and returns its id, to be passed to log().
+	def message(self, name, format, level=DEBUG):
+		message_id = self._ids_by_name.get(name)
+		if message_id is None:
+			self._formats.append(format)
+			self._levels.append(level)
+			message_id = self._ids_by_name[name] = len(self._formats) - 1
+		else:
+			self._formats[message_id] = format
+			self._levels[message_id] = level
+		return message_id
+
+	def enabled(self, message_id):
+		return self._levels[message_id] <= self.level
+
+	def log(self, message_id, port=0, data=b"", a=0, b=0):
+		if self._levels[message_id] > self.level:
+			return
+		length = len(data)
+		with self._lock:
+			head = self._head
+			if head - self._tail >= self._size:
+				self.dropped += 1
+				return
+			i = head & self._mask
+			self._times[i] = time()
+			self._ids[i] = message_id
+			self._ports[i] = port
+			self._a[i] = a
+			self._b[i] = b
+			self._lengths[i] = length
+			if length:
+				offset = i * RECORD_DATA_SIZE
+				if length <= RECORD_DATA_SIZE:
+					self._data[offset:offset + length] = data
+				else:
+					self._data[offset:offset + RECORD_DATA_SIZE] = memoryview(data)[:RECORD_DATA_SIZE]
+			self._head = head + 1
+
+	def _format(self, i):
+		length = self._lengths[i]
+		offset = i * RECORD_DATA_SIZE
+		record = Record(self._times[i], self._ports[i], bytes(self._data[offset:offset + min(length, RECORD_DATA_SIZE)]), length, self._a[i], self._b[i])
+		format = self._formats[self._ids[i]]
+		# A format failing on a record only costs that record, not the writer thread.
+		try:
+			if callable(format):
+				text = format(record)
+			else:
+				text = format.format(port=record.port, data=record.hex(), a=record.a, b=record.b)
+		except Exception as e:
+			text = "Failed to format log message {}: {!r}".format(self._ids[i], e)
+		return "{}.{:06d} {}".format(strftime("%H:%M:%S", localtime(record.time)), int(record.time % 1 * 1000000), text)
+
+	# Formats and writes out everything logged so far.
+	def flush(self):
+		with self._write_lock:
+			head = self._head
+			tail = self._tail
+			lines = [ self._format(i & self._mask) for i in range(tail, head) ]
+			# The slots can only be reused once they've been formatted.
+			self._tail = head
+			dropped = self.dropped
+			if dropped != self._reported_dropped:
+				lines.append("{} log records dropped, {} in total".format(dropped - self._reported_dropped, dropped))
+				self._reported_dropped = dropped
+			if lines:
+				lines.append("")
+				self.stream.write("\n".join(lines))
+				self.stream.flush()
+
+	def _run(self):
+		while True:
+			sleep(self.interval)
+			try:
+				self.flush()
+			except Exception as e:
+				# The records were consumed, keep going with the next ones.
+				sys.stderr.write("Failed to write the log: {!r}\n".format(e))
@@ -0,0 +1,259 @@
+# Metrics of a running script, to find out which script, port or event type is to blame when a
+# rig stutters.
+#
+# The callbacks wrapped with Metrics.wrap() count the events by port and type and time every
+# PIMIDIPY_METRICS_SAMPLE-th callback of each into a histogram, the outputs wrapped with
+# Metrics.wrap_output() do the same for their writes. All of it goes into counters preallocated at
+# startup, so most events only pay for a dict lookup and a list increment: reading the clock twice
+# costs about as much as all the rest, hence the sampling. Script specific values, such as the
+# number of SysEx messages sent by dx7.py or the queue depths of thru.py, are registered with
+# Metrics.gauge() and only read when someone asks.
+#
+# The metrics are served as JSON over a UNIX socket, PIMIDIPY_METRICS_DIR/pimidipy-<script>-<pid>.sock,
+# to whoever connects to it, and can also be written to a file periodically. 'python3 tools/top.py'
+# shows them for all the running scripts. The process id keeps several instances of the same script
+# from taking over each other's socket. Anyone able to connect can read the metrics, so point
+# PIMIDIPY_METRICS_DIR to a private directory on shared machines.
+#
+# The following can be set in /etc/pimidipy.conf:
+#
+# PIMIDIPY_METRICS=0             # Set to 1 to collect the metrics.
+# PIMIDIPY_METRICS_DIR=/tmp      # Where to create the socket.
+# PIMIDIPY_METRICS_FILE=         # If set, the metrics are also written to this file every PIMIDIPY_METRICS_INTERVAL seconds.
+# PIMIDIPY_METRICS_INTERVAL=5
+# PIMIDIPY_METRICS_SAMPLE=16     # Time every n-th callback and write, a power of 2.
+
+import atexit
+import os
+from os import getenv, path
+from threading import Thread
+from time import perf_counter_ns, sleep, time
+
+import pimidipy
+
+PIMIDIPY_METRICS = int(getenv("PIMIDIPY_METRICS", 0)) != 0
+PIMIDIPY_METRICS_DIR = getenv("PIMIDIPY_METRICS_DIR", "/tmp")
+PIMIDIPY_METRICS_FILE = getenv("PIMIDIPY_METRICS_FILE", "")
+PIMIDIPY_METRICS_INTERVAL = float(getenv("PIMIDIPY_METRICS_INTERVAL", 5))
+PIMIDIPY_METRICS_SAMPLE = int(getenv("PIMIDIPY_METRICS_SAMPLE", 16))
+
+if PIMIDIPY_METRICS_SAMPLE < 1 or PIMIDIPY_METRICS_SAMPLE & (PIMIDIPY_METRICS_SAMPLE - 1):
+	raise ValueError(f"Invalid PIMIDIPY_METRICS_SAMPLE '{PIMIDIPY_METRICS_SAMPLE}', use a power of 2")
+
+EVENT_TYPES = [
+	"NoteOnEvent",
+	"NoteOffEvent",
+	"ControlChangeEvent",
+	"AftertouchEvent",
+	"ProgramChangeEvent",
+	"ChannelPressureEvent",
+	"PitchBendEvent",
+	"Control14BitChangeEvent",
+	"NRPNChangeEvent",
+	"RPNChangeEvent",
+	"SongPositionPointerEvent",
+	"SongSelectEvent",
+	"StartEvent",
+	"ContinueEvent",
+	"StopEvent",
+	"ClockEvent",
+	"TuneRequestEvent",
+	"ResetEvent",
+	"ActiveSensingEvent",
+	"SysExEvent",
+	"MidiBytesEvent",
+	"other",
+]
+OTHER = len(EVENT_TYPES) - 1
+
+MAX_PORTS = 16
+
+# Bucket i of the histograms counts the durations of 2^(i-1) to 2^i - 1 nanoseconds.
+HISTOGRAM_SIZE = 40
+
+def socket_path(name):
+	return path.join(PIMIDIPY_METRICS_DIR, "pimidipy-{}-{}.sock".format(name, os.getpid()))
+
+def histogram_json(counts, maximum, count=None):
+	histogram = { "buckets": list(counts), "max_ns": maximum }
+	if count is not None:
+		histogram["count"] = count
+	return histogram
+
+# Takes the place of an output port, counting its writes and timing a sample of them.
+class OutputMetrics:
+	def __init__(self, output):
+		self.output = output
+		# Writes counted, the durations histogram and the longest one.
+		self.write_stats = [ 0 ] * (HISTOGRAM_SIZE + 2)
+		self.write = self._measure(output.write, self.write_stats)
+
+	def __getattr__(self, name):
+		return getattr(self.output, name)
+
+	@property
+	def writes(self):
+		return self.write_stats[-2]
+
+	@property
+	def write_counts(self):
+		return self.write_stats[:HISTOGRAM_SIZE]
+
+	@property
+	def write_max(self):
+		return self.write_stats[-1]
+
+	# A closure rather than a method, attribute lookups on self aren't cached by the interpreter
+	# because of __getattr__.
+	@staticmethod
+	def _measure(write, stats):
+		mask = PIMIDIPY_METRICS_SAMPLE - 1
+		COUNT = HISTOGRAM_SIZE
+		MAX = HISTOGRAM_SIZE + 1
+		def measured(data, drain=True):
+			stats[COUNT] += 1
+			if stats[COUNT] & mask:
+				return write(data, drain)
+			start = perf_counter_ns()
+			result = write(data, drain)
+			duration = perf_counter_ns() - start
+			stats[duration.bit_length()] += 1
+			if duration > stats[MAX]:
+				stats[MAX] = duration
+			return result
+		return measured
+
+class Metrics:
+	def __init__(self, name):
+		self.name = name
+		self.enabled = PIMIDIPY_METRICS
+		self.started = time()
+		self.ports = []
+		self.outputs = []
+		self.gauges = {}
+		# Plain lists, incrementing their small ints is cheaper than going through an array.
+		self.events = [ 0 ] * (MAX_PORTS * len(EVENT_TYPES))
+		self.callback_counts = [ 0 ] * HISTOGRAM_SIZE
+		self.callback_max = [ 0 ]
+		self.type_index = { getattr(pimidipy, name): i for i, name in enumerate(EVENT_TYPES) if hasattr(pimidipy, name) }
+		self._socket = None
+		if self.enabled:
+			# Set up from a thread, to not hold up the start of the script.
+			Thread(target=self._serve, name="metrics-socket", daemon=True).start()
+			if PIMIDIPY_METRICS_FILE:
+				Thread(target=self._write_loop, name="metrics-file", daemon=True).start()
+
+	def port_index(self, port_name):
+		if port_name not in self.ports:
+			if len(self.ports) >= MAX_PORTS:
+				raise ValueError("At most {} ports can be counted".format(MAX_PORTS))
+			self.ports.append(port_name)
+		return self.ports.index(port_name)
+
+	# Returns the callback counting the events of the port and timing a sample of them, or as it is
+	# when the metrics are off.
+	def wrap(self, callback, port_name):
+		if not self.enabled:
+			return callback
+		base = self.port_index(port_name) * len(EVENT_TYPES)
+		events = self.events
+		type_index = self.type_index
+		counts = self.callback_counts
+		maximum = self.callback_max
+		mask = PIMIDIPY_METRICS_SAMPLE - 1
+		def measured(event):
+			i = base + type_index.get(type(event), OTHER)
+			events[i] += 1
+			if events[i] & mask:
+				return callback(event)
+			start = perf_counter_ns()
+			callback(event)
+			duration = perf_counter_ns() - start
+			counts[duration.bit_length()] += 1
+			if duration > maximum[0]:
+				maximum[0] = duration
+		return measured
+
+	def wrap_output(self, output):
+		if not self.enabled:
+			return output
+		for wrapped in self.outputs:
+			if wrapped.output is output:
+				return wrapped
+		wrapped = OutputMetrics(output)
+		self.outputs.append(wrapped)
+		return wrapped
+
+	# Registers a value to report, 'read' is called when the metrics are requested.
+	def gauge(self, name, read):
+		self.gauges[name] = read
+
+	def snapshot(self):
+		events = {}
+		for port_id, port_name in enumerate(self.ports):
+			base = port_id * len(EVENT_TYPES)
+			events[port_name] = { name: self.events[base + i] for i, name in enumerate(EVENT_TYPES) if self.events[base + i] }
+		gauges = {}
+		for name, read in self.gauges.items():
+			try:
+				gauges[name] = read()
+			except Exception as e:
+				gauges[name] = str(e)
+		return {
+			"script": self.name,
+			"pid": os.getpid(),
+			"time": time(),
+			"started": self.started,
+			"events": events,
+			"callback": histogram_json(self.callback_counts, self.callback_max[0]),
+			"sample": PIMIDIPY_METRICS_SAMPLE,
+			"writes": { str(output.name): histogram_json(output.write_counts, output.write_max, output.writes) for output in self.outputs },
+			"gauges": gauges,
+		}
+
+	# socket and json are imported by the serving threads, they take a while to load.
+	def _serve(self):
+		import socket
+		socket_file = socket_path(self.name)
+		try:
+			try:
+				os.unlink(socket_file)
+			except FileNotFoundError:
+				pass
+			self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self._socket.bind(socket_file)
+			self._socket.listen(4)
+		except OSError as e:
+			print("Not serving the metrics on {}: {}".format(socket_file, e.strerror))
+			return
+		atexit.register(self._close, socket_file)
+		self._accept_loop()
+
+	def _close(self, socket_file):
+		self._socket.close()
+		try:
+			os.unlink(socket_file)
+		except OSError:
+			pass
+
+	def _accept_loop(self):
+		import json
+		while True:
+			try:
+				connection, address = self._socket.accept()
+			except OSError:
+				return
+			with connection:
+				try:
+					connection.sendall(json.dumps(self.snapshot()).encode())
+				except OSError:
+					pass
+
+	def _write_loop(self):
+		import json
+		while True:
+			sleep(PIMIDIPY_METRICS_INTERVAL)
+			temporary = PIMIDIPY_METRICS_FILE + ".tmp"
+			with open(temporary, "w") as f:
+				json.dump(self.snapshot(), f)
+			os.replace(temporary, PIMIDIPY_METRICS_FILE)
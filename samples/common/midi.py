@@ -0,0 +1,134 @@
+# The MIDI bytes of pimidipy events and back, and the copy of the pimidipy module given to the
+# scripts run by a host (see common/reload.py and common/pipeline.py).
+#
+# The functions take the pimidipy module the events belong to, so the real pimidipy and the
+# stand-in used by the benchmarks and the tests share them.
+
+import types
+
+def encode_14bit_cc(channel, msb_control, lsb_control, value):
+	return bytes([ 0xb0 | channel, msb_control, (value >> 7) & 0x7f, 0xb0 | channel, lsb_control, value & 0x7f ])
+
+def encode_parameter(channel, msb_param, lsb_param, param, value):
+	return encode_14bit_cc(channel, msb_param, lsb_param, param) + encode_14bit_cc(channel, 0x06, 0x26, value)
+
+# Event class name -> function returning the MIDI bytes of the event.
+ENCODERS = {
+	"NoteOnEvent":              lambda e: bytes([ 0x90 | e.channel, e.note, e.velocity ]),
+	"NoteOffEvent":             lambda e: bytes([ 0x80 | e.channel, e.note, e.velocity ]),
+	"ControlChangeEvent":       lambda e: bytes([ 0xb0 | e.channel, e.control, e.value ]),
+	"AftertouchEvent":          lambda e: bytes([ 0xa0 | e.channel, e.note, e.value ]),
+	"ProgramChangeEvent":       lambda e: bytes([ 0xc0 | e.channel, e.value ]),
+	"ChannelPressureEvent":     lambda e: bytes([ 0xd0 | e.channel, e.value ]),
+	"PitchBendEvent":           lambda e: bytes([ 0xe0 | e.channel, (e.value + 8192) & 0x7f, ((e.value + 8192) >> 7) & 0x7f ]),
+	"Control14BitChangeEvent":  lambda e: encode_14bit_cc(e.channel, e.control, e.control + 32, e.value),
+	"NRPNChangeEvent":          lambda e: encode_parameter(e.channel, 0x63, 0x62, e.param, e.value),
+	"RPNChangeEvent":           lambda e: encode_parameter(e.channel, 0x65, 0x64, e.param, e.value),
+	"SongPositionPointerEvent": lambda e: bytes([ 0xf2, e.position & 0x7f, (e.position >> 7) & 0x7f ]),
+	"SongSelectEvent":          lambda e: bytes([ 0xf3, e.song ]),
+	"TuneRequestEvent":         lambda e: b"\xf6",
+	"ClockEvent":               lambda e: b"\xf8",
+	"StartEvent":               lambda e: b"\xfa",
+	"ContinueEvent":            lambda e: b"\xfb",
+	"StopEvent":                lambda e: b"\xfc",
+	"ActiveSensingEvent":       lambda e: b"\xfe",
+	"ResetEvent":               lambda e: b"\xff",
+	"SysExEvent":               lambda e: bytes(e.data),
+	"MidiBytesEvent":           lambda e: bytes(e.data),
+}
+
+# Event type -> encoder, for the event classes 'module' has.
+def build_encoders(module):
+	return { getattr(module, name): encoder for name, encoder in ENCODERS.items() if hasattr(module, name) }
+
+# Decodes MIDI bytes into the events of 'module', keeping the running status from one call to the
+# next, SysEx split over several calls included.
+class Decoder:
+	def __init__(self, module):
+		self.status = 0
+		self.data = bytearray()
+		self.sysex = None
+		self.channel = [ None ] * 16
+		self.channel[0x8] = lambda channel, data: module.NoteOffEvent(channel, data[0], data[1])
+		self.channel[0x9] = lambda channel, data: module.NoteOnEvent(channel, data[0], data[1])
+		self.channel[0xa] = lambda channel, data: module.AftertouchEvent(channel, data[0], data[1])
+		self.channel[0xb] = lambda channel, data: module.ControlChangeEvent(channel, data[0], data[1])
+		self.channel[0xc] = lambda channel, data: module.ProgramChangeEvent(channel, data[0])
+		self.channel[0xd] = lambda channel, data: module.ChannelPressureEvent(channel, data[0])
+		self.channel[0xe] = lambda channel, data: module.PitchBendEvent(channel, (data[0] | data[1] << 7) - 8192)
+		self.system = {
+			0xf6: module.TuneRequestEvent,
+			0xf8: module.ClockEvent,
+			0xfa: module.StartEvent,
+			0xfb: module.ContinueEvent,
+			0xfc: module.StopEvent,
+			0xfe: module.ActiveSensingEvent,
+			0xff: module.ResetEvent,
+		}
+		self.SysExEvent = module.SysExEvent
+		self.SongPositionPointerEvent = module.SongPositionPointerEvent
+		self.SongSelectEvent = module.SongSelectEvent
+
+	def decode(self, stream, emit):
+		# A whole channel message with two data bytes, the usual case.
+		if len(stream) == 3 and 0x80 <= stream[0] < 0xf0 and stream[0] & 0xe0 != 0xc0 and self.sysex is None:
+			self.status = stream[0]
+			self.data.clear()
+			emit(self.channel[stream[0] >> 4](stream[0] & 0x0f, stream[1:]))
+			return
+		for byte in stream:
+			if byte >= 0xf8:
+				system = self.system.get(byte)
+				if system is not None:
+					emit(system())
+				continue
+			if byte == 0xf0:
+				self.sysex = bytearray(b"\xf0")
+				self.status = 0
+				continue
+			if self.sysex is not None:
+				self.sysex.append(byte)
+				if byte == 0xf7:
+					emit(self.SysExEvent(bytes(self.sysex)))
+					self.sysex = None
+				continue
+			if byte >= 0x80:
+				self.data.clear()
+				if byte >= 0xf0:
+					self.status = 0
+					system = self.system.get(byte)
+					if system is not None:
+						emit(system())
+					elif byte in (0xf2, 0xf3):
+						self.status = byte
+				else:
+					self.status = byte
+				continue
+			if not self.status:
+				continue
+			self.data.append(byte)
+			status = self.status
+			if status == 0xf2:
+				if len(self.data) == 2:
+					emit(self.SongPositionPointerEvent(self.data[0] | self.data[1] << 7))
+					self.status = 0
+			elif status == 0xf3:
+				emit(self.SongSelectEvent(self.data[0]))
+				self.status = 0
+			elif len(self.data) == (1 if status & 0xe0 == 0xc0 else 2):
+				emit(self.channel[status >> 4](status & 0x0f, self.data))
+				self.data.clear()
+
+# Decodes a whole stream of MIDI bytes, like a recording, into a list of events.
+def decode_midi_bytes(module, stream):
+	events = []
+	Decoder(module).decode(stream, events.append)
+	return events
+
+# A copy of the pimidipy module with PimidiPy() replaced by 'create_pimidipy', for the host to hand
+# out its own instance.
+def build_module(module, create_pimidipy):
+	copy = types.ModuleType("pimidipy")
+	copy.__dict__.update(module.__dict__)
+	copy.PimidiPy = create_pimidipy
+	return copy
@@ -0,0 +1,256 @@
+# Runs scripts as the stages of a pipeline, each in its own process, linked by shared memory rings
+# (see common/ring.py).
+#
+# Within one interpreter, chaining scripts would put all of them on a single core under the GIL.
+# Here each stage is forked into its own process, optionally pinned to a CPU, and runs an unchanged
+# script with a pimidipy in which:
+#
+# * Input 0 of every stage but the first one is the ring written by the previous stage.
+# * Output 0 of every stage but the last one is the ring read by the next stage.
+#
+# The other inputs and outputs are the real ports. The events written to a ring are encoded into
+# MIDI bytes, the next stage decodes them back into pimidipy events for its callbacks, with running
+# status and SysEx split over several records handled (see common/midi.py). A stage whose input is
+# a ring polls it: it keeps polling without sleeping for PIPELINE_SPIN_US after the last record, so
+# a burst passes through with the least delay, then sleeps PIPELINE_IDLE_US between polls to leave
+# the CPU alone. Stages that are not pinned to a CPU sleep right away.
+#
+# Hot reload is not available to the stages, the pipeline is restarted as a whole.
+#
+# The following can be set in /etc/pimidipy.conf:
+#
+# PIPELINE_RING_SIZE=1024  # Records in each ring, a power of 2.
+# PIPELINE_SPIN_US=2000    # How long a stage polls its idle ring before sleeping, -1 to never sleep.
+# PIPELINE_IDLE_US=200     # Sleep between the polls of an idle ring.
+
+import os
+import signal
+import sys
+import traceback
+from os import getenv, path
+from threading import Thread
+from time import perf_counter_ns, sleep
+
+from common.midi import Decoder, build_encoders, build_module
+from common.ring import Ring
+
+PIPELINE_RING_SIZE = int(getenv("PIPELINE_RING_SIZE", 1024))
+PIPELINE_SPIN_US = int(getenv("PIPELINE_SPIN_US", 2000))
+PIPELINE_IDLE_US = int(getenv("PIPELINE_IDLE_US", 200))
+
+# How long a stage whose script has ended keeps its output ring open.
+DRAIN_TIME = 0.1
+
+# The previous stage, in place of input 0.
+class RingInput:
+	def __init__(self, stage, name, ring):
+		self.stage = stage
+		self.name = name
+		self.consumer = ring.consumer()
+		self.callbacks = []
+
+	def add_callback(self, callback):
+		self.callbacks.append(callback)
+
+	def remove_callback(self, callback):
+		self.callbacks.remove(callback)
+
+	def close(self):
+		pass
+
+# The next stage, in place of output 0.
+class RingOutput:
+	def __init__(self, stage, name, ring, encoders):
+		self.stage = stage
+		self.name = name
+		self.producer = ring.producer()
+		self.producer.idle = PIPELINE_IDLE_US / 1e6
+		self.encoders = encoders
+
+	# The bytes are stamped with the time the stage's current input event entered the pipeline, or,
+	# when written from a thread of the script, the time of the latest one.
+	def write(self, event, drain=True):
+		if type(event) is bytes or type(event) is bytearray:
+			data = event
+		else:
+			data = self.encoders[type(event)](event)
+		self.producer.write(data, self.stage.timestamp)
+		return len(data)
+
+	def close(self):
+		pass
+
+# What the stage's script gets from PimidiPy().
+class StageProxy:
+	def __init__(self, stage, pimidipy):
+		self._stage = stage
+		self._pimidipy = pimidipy
+
+	def __getattr__(self, name):
+		return getattr(self._pimidipy, name)
+
+	def open_input(self, port, *args, **kwargs):
+		stage = self._stage
+		if stage.input_ring is not None and port in (0, self._pimidipy.get_input_port(0)):
+			if stage.input is None:
+				stage.input = RingInput(stage, "pipeline:" + stage.previous_name, stage.input_ring)
+			return stage.input
+		stage.real_inputs += 1
+		return self._pimidipy.open_input(port, *args, **kwargs)
+
+	def open_output(self, port, *args, **kwargs):
+		stage = self._stage
+		if stage.output_ring is not None and port in (0, self._pimidipy.get_output_port(0)):
+			if stage.output is None:
+				stage.output = RingOutput(stage, "pipeline:" + stage.name, stage.output_ring, build_encoders(stage.module))
+			return stage.output
+		return self._pimidipy.open_output(port, *args, **kwargs)
+
+	def run(self):
+		stage = self._stage
+		if stage.input is None:
+			self._pimidipy.run()
+			return
+		if stage.real_inputs:
+			Thread(target=self._pimidipy.run, name="pimidipy", daemon=True).start()
+		stage.poll()
+
+class Stage:
+	def __init__(self, script, input_ring=None, output_ring=None, previous_name=None, cpu=-1, init_globals=None):
+		self.script = path.abspath(script)
+		self.init_globals = init_globals or {}
+		self.name = path.splitext(path.basename(script))[0]
+		self.input_ring = input_ring
+		self.output_ring = output_ring
+		self.previous_name = previous_name
+		self.cpu = cpu
+		self.module = None
+		self.pimidipy = None
+		self.input = None
+		self.output = None
+		self.real_inputs = 0
+		self.pinned = False
+		self.timestamp = None
+
+	def create_pimidipy(self, *args, **kwargs):
+		if self.pimidipy is None:
+			self.pimidipy = StageProxy(self, self.module.PimidiPy(*args, **kwargs))
+		return self.pimidipy
+
+	# Runs the script in the current process, with 'module' as the real pimidipy.
+	def run(self, module):
+		self.module = module
+		if self.cpu >= 0:
+			try:
+				os.sched_setaffinity(0, { self.cpu })
+				self.pinned = True
+			except OSError as e:
+				print("Stage {} not pinned to CPU {}: {}".format(self.name, self.cpu, e.strerror))
+			# Real-time mode pins the callback thread as well, keep it on the same CPU.
+			os.environ["PIMIDIPY_RT_CPU"] = str(self.cpu)
+		os.environ["PIMIDIPY_HOT_RELOAD"] = "0"
+		script_dir = path.dirname(self.script)
+		if sys.path[0] != script_dir:
+			sys.path.insert(0, script_dir)
+		with open(self.script) as f:
+			code = compile(f.read(), self.script, "exec")
+		# PimidiPy() returns the stage's instance.
+		sys.modules["pimidipy"] = build_module(self.module, self.create_pimidipy)
+		try:
+			exec(code, { **self.init_globals, "__name__": "__main__", "__file__": self.script })
+		finally:
+			if self.output is not None:
+				# Let the script's own threads, like the paced writers of dx7.py and thru.py, write
+				# out what they have queued.
+				sleep(DRAIN_TIME)
+				self.output.producer.close()
+
+	# Feeds the records of the input ring to the callbacks until the previous stage is closed.
+	def poll(self):
+		consumer = self.input.consumer
+		decoder = Decoder(self.module)
+		emit = self._emit
+		# Polling without sleeping only pays off with a CPU of its own, otherwise it takes the CPU
+		# away from the other stages.
+		spin = PIPELINE_SPIN_US * 1000 if self.pinned else 0
+		idle = PIPELINE_IDLE_US / 1e6
+		last = perf_counter_ns()
+		while True:
+			record = consumer.read()
+			if record is not None:
+				self.timestamp = record[0]
+				decoder.decode(record[1], emit)
+				last = 0
+				continue
+			if consumer.finished():
+				return
+			if spin < 0:
+				continue
+			if not last:
+				last = perf_counter_ns()
+			elif perf_counter_ns() - last > spin:
+				sleep(idle)
+
+	def _emit(self, event):
+		for callback in self.input.callbacks:
+			callback(event)
+
+# Forks a process for each stage and waits for them. 'load_module' imports pimidipy in the stage's
+# process. Returns the exit status of the first stage to fail.
+def run_pipeline(scripts, cpus, load_module):
+	rings = [ Ring(PIPELINE_RING_SIZE) for i in range(len(scripts) - 1) ]
+	stages = []
+	for i, script in enumerate(scripts):
+		stages.append(Stage(
+			script,
+			input_ring=rings[i - 1] if i > 0 else None,
+			output_ring=rings[i] if i < len(rings) else None,
+			previous_name=stages[i - 1].name if i > 0 else None,
+			cpu=cpus[i] if i < len(cpus) else -1
+			))
+	return wait_stages(start_stages(stages, load_module))
+
+def start_stages(stages, load_module):
+	pids = {}
+	for stage in stages:
+		sys.stdout.flush()
+		pid = os.fork()
+		if pid == 0:
+			status = 0
+			try:
+				stage.run(load_module())
+			except SystemExit as e:
+				status = e.code if isinstance(e.code, int) else 1
+			except KeyboardInterrupt:
+				pass
+			except BaseException:
+				traceback.print_exc()
+				status = 1
+			sys.stdout.flush()
+			os._exit(status)
+		pids[pid] = stage
+	return pids
+
+# A stage ending normally closes its output ring, so the stages after it end too once they have
+# handled what it wrote. Once a stage fails, the others are stopped.
+def wait_stages(pids):
+	status = 0
+	try:
+		while pids:
+			pid, wait_status = os.wait()
+			stage = pids.pop(pid)
+			code = os.waitstatus_to_exitcode(wait_status)
+			if code:
+				print("Stage {} exited with {}".format(stage.name, code))
+				status = code
+				break
+	except KeyboardInterrupt:
+		pass
+	for pid in pids:
+		try:
+			os.kill(pid, signal.SIGTERM)
+		except ProcessLookupError:
+			pass
+	for pid in pids:
+		os.waitpid(pid, 0)
+	return status
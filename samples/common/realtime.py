@@ -0,0 +1,213 @@
+# Real-time mode for the MIDI event callbacks.
+#
+# On a loaded Pi the worst case latency comes from the garbage collector pausing the callback and
+# from the scheduler moving the callback thread around or preempting it. With real-time mode on, the
+# scripts call RealTime.start() right before pimidipy.run(), which applies the following from the
+# main thread, the one going on to run the callbacks:
+#
+# * The garbage collector runs once and the surviving objects (all the tables and buffers set up at
+#   startup) are frozen with gc.freeze(), so later collections don't go through them. Optionally the
+#   automatic collections are disabled altogether.
+# * The thread gets SCHED_FIFO priority and is pinned to a CPU, where permitted (root, or LimitRTPRIO
+#   in the systemd service).
+# * The process memory is locked with mlockall(), so it doesn't get paged out.
+#
+# The callbacks wrapped with RealTime.wrap() are timed, the histogram of their durations is logged
+# on exit.
+#
+# To see the effect of the settings, set PIMIDIPY_RT_COMPARE_EVENTS: start() then leaves them off,
+# and they're applied in the callback once that many events have been handled. The histograms of
+# the events before and of the same number of events after are logged side by side. The callback
+# applying them stalls for the garbage collection and the memory locking, so this is for measuring
+# only, not for a performance.
+#
+# Callbacks leaving more than PIMIDIPY_RT_ALLOC_WARN memory blocks allocated behind are reported as
+# warnings, with the garbage collector frozen or disabled that memory is the one that builds up.
+#
+# The following can be set in /etc/pimidipy.conf:
+#
+# PIMIDIPY_REALTIME=0                # Set to 1 to turn on real-time mode.
+# PIMIDIPY_RT_GC=freeze              # freeze - freeze the startup objects, disable - also disable the automatic collections, off - leave the GC alone.
+# PIMIDIPY_RT_PRIORITY=50            # SCHED_FIFO priority (1-99) of the callback thread, 0 to keep the normal scheduling.
+# PIMIDIPY_RT_CPU=-1                 # The CPU to pin the callback thread to, -1 to not pin it. Best combined with isolcpus=.
+# PIMIDIPY_RT_MLOCK=1                # Set to 0 to not lock the memory.
+# PIMIDIPY_RT_ALLOC_WARN=16          # Warn when a callback leaves more memory blocks than this allocated.
+# PIMIDIPY_RT_COMPARE_EVENTS=0       # Events timed before and after applying the settings, 0 to apply them on start.
+
+import atexit
+import gc
+import os
+import resource
+import sys
+from array import array
+from os import getenv
+from time import perf_counter_ns
+
+from common.log import INFO, WARNING
+
+PIMIDIPY_REALTIME = int(getenv("PIMIDIPY_REALTIME", 0)) != 0
+PIMIDIPY_RT_GC = getenv("PIMIDIPY_RT_GC", "freeze").lower()
+PIMIDIPY_RT_PRIORITY = int(getenv("PIMIDIPY_RT_PRIORITY", 50))
+PIMIDIPY_RT_CPU = int(getenv("PIMIDIPY_RT_CPU", -1))
+PIMIDIPY_RT_MLOCK = int(getenv("PIMIDIPY_RT_MLOCK", 1)) != 0
+PIMIDIPY_RT_ALLOC_WARN = int(getenv("PIMIDIPY_RT_ALLOC_WARN", 16))
+PIMIDIPY_RT_COMPARE_EVENTS = int(getenv("PIMIDIPY_RT_COMPARE_EVENTS", 0))
+
+if PIMIDIPY_RT_GC not in ("freeze", "disable", "off"):
+	raise ValueError(f"Invalid PIMIDIPY_RT_GC '{PIMIDIPY_RT_GC}', use one of freeze, disable or off")
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# Bucket i of a histogram counts the durations of 2^(i-1) to 2^i - 1 nanoseconds.
+HISTOGRAM_SIZE = 40
+
+class Histogram:
+	def __init__(self):
+		self.counts = array("Q", [ 0 ]) * HISTOGRAM_SIZE
+		self.count = 0
+		self.max = 0
+
+	def add(self, duration):
+		self.counts[duration.bit_length()] += 1
+		self.count += 1
+		if duration > self.max:
+			self.max = duration
+
+	def copy(self):
+		histogram = Histogram()
+		histogram.counts[:] = self.counts
+		histogram.count = self.count
+		histogram.max = self.max
+		return histogram
+
+	# Upper bound of the bucket the p-th percentile falls into, in nanoseconds.
+	def percentile(self, p):
+		target = self.count * p / 100
+		total = 0
+		for i, count in enumerate(self.counts):
+			total += count
+			if total >= target and count:
+				return (1 << i) - 1
+		return 0
+
+def format_us(ns):
+	return "{:.1f}".format(ns / 1000)
+
+def format_histograms(titles, histograms):
+	used = [ i for i in range(HISTOGRAM_SIZE) if any(histogram.counts[i] for histogram in histograms) ]
+	lines = [ "{:>18} ".format("callback us") + "".join("{:>12}".format(title) for title in titles) ]
+	for i in range(used[0], used[-1] + 1) if used else ():
+		low = (1 << i >> 1) / 1000
+		high = ((1 << i) - 1) / 1000
+		lines.append("{:>8.1f} - {:>7.1f} ".format(low, high) + "".join("{:>12}".format(histogram.counts[i]) for histogram in histograms))
+	for name, p in (("p50", 50), ("p99", 99), ("p99.9", 99.9)):
+		lines.append("{:>18} ".format(name + " <=") + "".join("{:>12}".format(format_us(histogram.percentile(p))) for histogram in histograms))
+	lines.append("{:>18} ".format("max") + "".join("{:>12}".format(format_us(histogram.max)) for histogram in histograms))
+	return "\n".join(lines)
+
+def lock_memory():
+	flags = MCL_CURRENT
+	# Locking the future allocations as well fails them once over RLIMIT_MEMLOCK, only do it when
+	# there is no limit.
+	soft, hard = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+	if soft == resource.RLIM_INFINITY or os.geteuid() == 0:
+		flags |= MCL_FUTURE
+	# Only imported when needed, ctypes takes a while to load.
+	import ctypes
+	libc = ctypes.CDLL(None, use_errno=True)
+	if libc.mlockall(flags) != 0:
+		raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+	return "all" if flags & MCL_FUTURE else "current"
+
+class RealTime:
+	def __init__(self, log):
+		self.log = log
+		self.enabled = PIMIDIPY_REALTIME
+		self.comparing = PIMIDIPY_RT_COMPARE_EVENTS > 0
+		self.applied = False
+		self.before = Histogram()
+		self.after = Histogram()
+		self.total = Histogram()
+		self.alloc_warnings = 0
+		self._applied = []
+		self._failed = []
+		self._compared = None
+		self._total = None
+		self.MSG_APPLIED = log.message("realtime_applied", lambda record: "Real-time mode: " + ", ".join(self._applied), INFO)
+		self.MSG_FAILED = log.message("realtime_failed", lambda record: "Real-time mode, not applied: " + ", ".join(self._failed), WARNING)
+		self.MSG_COMPARE = log.message("realtime_compare", lambda record: "Callback durations before and after real-time mode:\n" + format_histograms([ "before", "after" ], self._compared), INFO)
+		self.MSG_TOTAL = log.message("realtime_total", lambda record: "Callback durations with real-time mode:\n" + format_histograms([ "total" ], [ self._total ]), INFO)
+		self.MSG_ALLOC = log.message("realtime_alloc", "Callback left {a} memory blocks allocated ({b} times so far)", WARNING)
+		if self.enabled:
+			atexit.register(self.report)
+
+	# Returns the callback timed and checked for allocations, or as it is when real-time mode is off.
+	def wrap(self, callback):
+		if not self.enabled:
+			return callback
+		def timed(event):
+			if self.comparing and not self.applied and self.before.count >= PIMIDIPY_RT_COMPARE_EVENTS:
+				self.apply()
+			blocks = sys.getallocatedblocks()
+			start = perf_counter_ns()
+			callback(event)
+			duration = perf_counter_ns() - start
+			blocks = sys.getallocatedblocks() - blocks
+			if blocks > PIMIDIPY_RT_ALLOC_WARN:
+				self.alloc_warnings += 1
+				# Only report the 1st, 2nd, 4th, 8th, ... time.
+				if self.alloc_warnings & (self.alloc_warnings - 1) == 0:
+					self.log.log(self.MSG_ALLOC, 0, b"", blocks, self.alloc_warnings)
+			if not self.applied:
+				self.before.add(duration)
+				return
+			if self.after.count < self.before.count:
+				self.after.add(duration)
+				if self.after.count == self.before.count:
+					self._compared = [ self.before.copy(), self.after.copy() ]
+					self.log.log(self.MSG_COMPARE)
+			self.total.add(duration)
+		return timed
+
+	# Applies the settings before the event loop starts, unless they're to be compared. A hot
+	# reloaded script gets the instance they were already applied with.
+	def start(self):
+		if self.enabled and not self.comparing and not self.applied:
+			self.apply()
+
+	# Applies the settings, called from the thread running the callbacks.
+	def apply(self):
+		self.applied = True
+		if PIMIDIPY_RT_GC != "off":
+			gc.collect()
+			gc.freeze()
+			if PIMIDIPY_RT_GC == "disable":
+				gc.disable()
+			self._applied.append("gc " + PIMIDIPY_RT_GC)
+		if PIMIDIPY_RT_PRIORITY > 0:
+			try:
+				os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(PIMIDIPY_RT_PRIORITY))
+				self._applied.append("SCHED_FIFO {}".format(PIMIDIPY_RT_PRIORITY))
+			except OSError as e:
+				self._failed.append("SCHED_FIFO ({})".format(e.strerror))
+		if PIMIDIPY_RT_CPU >= 0:
+			try:
+				os.sched_setaffinity(0, { PIMIDIPY_RT_CPU })
+				self._applied.append("pinned to CPU {}".format(PIMIDIPY_RT_CPU))
+			except OSError as e:
+				self._failed.append("CPU pin ({})".format(e.strerror))
+		if PIMIDIPY_RT_MLOCK:
+			try:
+				self._applied.append("locked {} memory".format(lock_memory()))
+			except OSError as e:
+				self._failed.append("mlockall ({})".format(e.strerror))
+		if self._applied:
+			self.log.log(self.MSG_APPLIED)
+		if self._failed:
+			self.log.log(self.MSG_FAILED)
+
+	def report(self):
+		if self.total.count:
+			self._total = self.total.copy()
+			self.log.log(self.MSG_TOTAL)
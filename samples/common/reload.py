@@ -0,0 +1,185 @@
+# Hot reload of a running script, in place of restarting it.
+#
+# A restart re-imports pimidipy and reopens every port, which leaves an audible gap, and whatever
+# the script tracked (the selected DX7 bank, the notes being held, ...) is lost. With hot reload on,
+# the script is run by a host that keeps the PimidiPy instance and the opened ports alive. When the
+# script file changes, it is executed again: PimidiPy() and open_input()/open_output() return the
+# instance and the ports that are already open, the callbacks passed to add_callback() are staged,
+# and pimidipy.run() ends the execution instead of running the event loop again. The staged
+# callbacks are then swapped in for the old ones between two events.
+#
+# State is carried over in two ways:
+#
+# keep(name, factory) - returns the object the previous execution bound to 'name', or a new one made
+#                       by 'factory' on the first run. For objects that own threads, queues or
+#                       buffers, like the output schedulers. They keep running the code they were
+#                       created with, so changes to their classes still need a restart.
+# on_reload(previous) - if the script defines this function, it is called right before the swap
+#                       with the previous globals, to copy plain values such as the selected bank.
+#
+# The swap time, during which no events are processed, is printed after every reload. If the
+# changed script fails to run, the error is printed and the previous callbacks stay in place.
+#
+# The scripts opt in by calling hot_reload(__file__) before anything else, it is enabled by setting
+# the following in /etc/pimidipy.conf:
+#
+# PIMIDIPY_HOT_RELOAD=0           # Set to 1 to reload the script when its file changes.
+# PIMIDIPY_HOT_RELOAD_INTERVAL=1  # How often to check the file for changes, in seconds.
+#
+# Turn off Patchbox's automatic restart of the script when using it, as the restart would still
+# happen on every change.
+
+import builtins
+import sys
+from os import getenv, stat
+from threading import Lock, Thread
+from time import perf_counter, sleep
+
+import pimidipy
+
+from common.midi import build_module
+
+PIMIDIPY_HOT_RELOAD = int(getenv("PIMIDIPY_HOT_RELOAD", 0)) != 0
+PIMIDIPY_HOT_RELOAD_INTERVAL = float(getenv("PIMIDIPY_HOT_RELOAD_INTERVAL", 1))
+
+# Ends the execution of the changed script at its pimidipy.run() call. Not an Exception, so the
+# script's own error handling doesn't catch it.
+class ReloadDone(BaseException):
+	pass
+
+# Takes the place of the input port, registered with pimidipy once. The script's callbacks are
+# called through it, so they can be replaced without touching the port.
+class InputSlot:
+	def __init__(self, port, lock):
+		self.port = port
+		self.callbacks = ()
+		self.staged = []
+		self._lock = lock
+		port.add_callback(self)
+
+	def __call__(self, event):
+		with self._lock:
+			for callback in self.callbacks:
+				callback(event)
+
+	def __getattr__(self, name):
+		return getattr(self.port, name)
+
+	def add_callback(self, callback):
+		self.staged.append(callback)
+
+	def remove_callback(self, callback):
+		self.staged.remove(callback)
+
+# What the script gets from PimidiPy(), the real instance with the ports cached.
+class PimidiPyProxy:
+	def __init__(self, host, pimidipy):
+		self._host = host
+		self._pimidipy = pimidipy
+
+	def __getattr__(self, name):
+		return getattr(self._pimidipy, name)
+
+	def open_input(self, port, *args, **kwargs):
+		slot = self._host.inputs.get(port)
+		if slot is None:
+			slot = self._host.inputs[port] = InputSlot(self._pimidipy.open_input(port, *args, **kwargs), self._host.lock)
+		return slot
+
+	def open_output(self, port, *args, **kwargs):
+		output = self._host.outputs.get(port)
+		if output is None:
+			output = self._host.outputs[port] = self._pimidipy.open_output(port, *args, **kwargs)
+		return output
+
+	def run(self):
+		if self._host.namespace is None:
+			self._host.swap(self._host.loading)
+			Thread(target=self._host.watch, name="hot-reload", daemon=True).start()
+			self._pimidipy.run()
+		else:
+			raise ReloadDone()
+
+class Host:
+	def __init__(self, path):
+		self.path = path
+		self.module = pimidipy
+		self.pimidipy = None
+		self.inputs = {}
+		self.outputs = {}
+		self.lock = Lock()
+		# The globals of the script whose callbacks are in place, and of the one being executed.
+		self.namespace = None
+		self.loading = None
+
+	def create_pimidipy(self, *args, **kwargs):
+		if self.pimidipy is None:
+			self.pimidipy = PimidiPyProxy(self, self.module.PimidiPy(*args, **kwargs))
+		return self.pimidipy
+
+	def execute(self):
+		with open(self.path) as f:
+			code = compile(f.read(), self.path, "exec")
+		self.loading = { "__name__": "__main__", "__file__": self.path, "__builtins__": builtins }
+		for slot in self.inputs.values():
+			slot.staged = []
+		# PimidiPy() returns the shared instance.
+		sys.modules["pimidipy"] = build_module(self.module, self.create_pimidipy)
+		try:
+			exec(code, self.loading)
+		finally:
+			sys.modules["pimidipy"] = self.module
+
+	def swap(self, namespace):
+		with self.lock:
+			start = perf_counter()
+			on_reload = namespace.get("on_reload")
+			if self.namespace is not None and on_reload is not None:
+				on_reload(self.namespace)
+			for slot in self.inputs.values():
+				slot.callbacks = tuple(slot.staged)
+			self.namespace = namespace
+			return perf_counter() - start
+
+	def reload(self):
+		start = perf_counter()
+		try:
+			self.execute()
+		except ReloadDone:
+			pass
+		except Exception:
+			import traceback
+			traceback.print_exc()
+			print("Reloading {} failed, keeping the running version".format(self.path))
+			return
+		swap_time = self.swap(self.loading)
+		print("Reloaded {} in {:.1f} ms, callbacks swapped in {:.1f} us".format(self.path, 1000 * (perf_counter() - start), 1e6 * swap_time))
+
+	def watch(self):
+		modified = stat(self.path).st_mtime_ns
+		while True:
+			sleep(PIMIDIPY_HOT_RELOAD_INTERVAL)
+			try:
+				current = stat(self.path).st_mtime_ns
+			except OSError:
+				continue
+			if current != modified:
+				modified = current
+				self.reload()
+
+host = None
+
+# Runs the script at 'path' under the host and exits once its event loop ends. Returns right away
+# if hot reload is off, or when called from the script executed by the host.
+def hot_reload(path):
+	global host
+	if not PIMIDIPY_HOT_RELOAD or host is not None:
+		return
+	host = Host(path)
+	host.execute()
+	sys.exit(0)
+
+def keep(name, factory):
+	if host is not None and host.namespace is not None and name in host.namespace:
+		return host.namespace[name]
+	return factory()
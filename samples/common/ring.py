@@ -0,0 +1,142 @@
+# Lock-free single producer, single consumer ring buffer of MIDI records in shared memory, linking
+# the stages of a pipeline running in separate processes (see common/pipeline.py).
+#
+# The ring is an anonymous shared mmap created before the stage processes are forked, so nothing
+# gets pickled or sent through a pipe. Each write() of MIDI bytes becomes one or more fixed-size
+# records:
+#
+# seq       u32  - position of the record in the stream, modulo 2^32.
+# crc       u32  - CRC-32 of the rest of the record, seeded with seq.
+# timestamp u64  - perf_counter_ns() of the event the bytes originate from, for latency measurements.
+# length    u8   - number of data bytes used.
+# flags     u8   - MORE when the bytes continue in the next record (SysEx longer than RECORD_DATA_SIZE).
+# data           - RECORD_DATA_SIZE bytes.
+#
+# The consumer takes a record once its seq matches the position it expects to read, and publishes
+# the position it has read up to in the header, which the producer checks before reusing a slot.
+# Python gives no memory barriers, and the Pi's ARM cores may make the stores of a record visible
+# to the other core in any order. So rather than trusting the seq alone, the consumer checks the
+# CRC of its copy of the record and, on a mismatch, retries on the next poll, when the rest of the
+# record has arrived.
+
+import struct
+import zlib
+from mmap import mmap
+from time import perf_counter_ns, sleep
+
+RECORD_SIZE = 64
+RECORD_HEADER = struct.Struct("<IIQBB")
+RECORD_DATA_SIZE = RECORD_SIZE - RECORD_HEADER.size
+
+# Continuation flag of a record.
+MORE = 1
+
+# Cache line aligned header: the consumer's read position, and the producer's end position + 1
+# once it is closed.
+TAIL = 0
+END = 8
+HEADER_SIZE = 128
+
+SEQ = struct.Struct("<II")
+BODY = struct.Struct("<QBB")
+
+class Ring:
+	def __init__(self, size=1024):
+		if size < 2 or size & (size - 1):
+			raise ValueError("The ring size must be a power of 2")
+		self.size = size
+		self.memory = mmap(-1, HEADER_SIZE + size * RECORD_SIZE)
+		seqs = memoryview(self.memory).cast("I")
+		# Slot i first expects position i, mark each slot as written a lap earlier.
+		for i in range(size):
+			seqs[(HEADER_SIZE + i * RECORD_SIZE) >> 2] = (i - size) & 0xffffffff
+
+	def producer(self):
+		return Producer(self)
+
+	def consumer(self):
+		return Consumer(self)
+
+class Producer:
+	def __init__(self, ring, idle=0.0002):
+		self.memory = ring.memory
+		self.size = ring.size
+		self.mask = ring.size - 1
+		self.idle = idle
+		self.position = 0
+		self.full_waits = 0
+		self._header = memoryview(ring.memory).cast("Q")
+		self._tail = 0
+
+	# Blocks while the ring is full, as the consumer being behind means the events would be late
+	# anyway, and dropping them could leave notes hanging.
+	def _wait_for_space(self):
+		self._tail = self._header[TAIL >> 3]
+		while self.position - self._tail >= self.size:
+			self.full_waits += 1
+			sleep(self.idle)
+			self._tail = self._header[TAIL >> 3]
+
+	def write(self, data, timestamp=None):
+		if timestamp is None:
+			timestamp = perf_counter_ns()
+		if len(data) > RECORD_DATA_SIZE:
+			for start in range(0, len(data), RECORD_DATA_SIZE):
+				chunk = data[start:start + RECORD_DATA_SIZE]
+				self._write_record(chunk, timestamp, MORE if start + RECORD_DATA_SIZE < len(data) else 0)
+		else:
+			self._write_record(data, timestamp, 0)
+
+	def _write_record(self, data, timestamp, flags):
+		if self.position - self._tail >= self.size:
+			self._wait_for_space()
+		seq = self.position & 0xffffffff
+		body = BODY.pack(timestamp, len(data), flags) + data
+		offset = HEADER_SIZE + (self.position & self.mask) * RECORD_SIZE + 8
+		self.memory[offset:offset + len(body)] = body
+		SEQ.pack_into(self.memory, offset - 8, seq, zlib.crc32(body, seq))
+		self.position += 1
+
+	# Tells the consumer that nothing gets written after the records written so far.
+	def close(self):
+		self._header[END >> 3] = self.position + 1
+
+class Consumer:
+	def __init__(self, ring):
+		self.memory = ring.memory
+		self.mask = ring.size - 1
+		self.position = 0
+		self.torn = 0
+		self._header = memoryview(ring.memory).cast("Q")
+		self._seqs = memoryview(ring.memory).cast("I")
+		self._pending = None
+
+	# Returns the timestamp and the bytes of the next complete write, or None if there is none yet.
+	def read(self):
+		while True:
+			position = self.position
+			offset = HEADER_SIZE + (position & self.mask) * RECORD_SIZE
+			seq = position & 0xffffffff
+			if self._seqs[offset >> 2] != seq:
+				return None
+			record = self.memory[offset:offset + RECORD_SIZE]
+			stored_seq, crc, timestamp, length, flags = RECORD_HEADER.unpack_from(record)
+			end = RECORD_HEADER.size + length
+			if stored_seq != seq or length > RECORD_DATA_SIZE or zlib.crc32(record[8:end], seq) != crc:
+				self.torn += 1
+				return None
+			self.position = position + 1
+			self._header[TAIL >> 3] = position + 1
+			data = record[RECORD_HEADER.size:end]
+			if flags & MORE:
+				self._pending = data if self._pending is None else self._pending + data
+				continue
+			if self._pending is not None:
+				data = self._pending + data
+				self._pending = None
+			return timestamp, data
+
+	# True once the producer is closed and everything it wrote has been read.
+	def finished(self):
+		end = self._header[END >> 3]
+		return end != 0 and self.position >= end - 1
@@ -0,0 +1,162 @@
+# Startup of the scripts: profiling it, and opening the outputs without holding it up.
+#
+# Patchbox restarts the script on every change of its file and the Pi may boot straight into the
+# rig, so the time it takes until the first event gets through counts. The scripts import this
+# module first, and mark the end of each phase of their startup:
+#
+# process - from the start of the process until the script's first line: starting the interpreter
+#           and compiling the script.
+# import  - importing pimidipy and the common modules.
+# config  - reading the configuration and compiling the script's tables from it.
+# ports   - opening the ports.
+# setup   - whatever the script does after that, until it calls pimidipy.run().
+#
+# With PIMIDIPY_STARTUP_PROFILE=1, the time taken by each phase is printed once the first event has
+# been handled, along with how long the handling took. The callbacks wrapped with first_event() are
+# only wrapped when profiling.
+#
+# When the output ports returned by open_output() get opened depends on PIMIDIPY_OPEN_OUTPUTS:
+#
+# startup    - right away, before the script goes on. The default.
+# write      - each output is opened on its first write, the outputs that are never written to
+#              are never opened.
+# background - the outputs are opened one after the other by a thread, while the script already
+#              handles events. A write to an output that isn't open yet opens it right away.
+#              Opening a port goes through pimidipy's ALSA client, which isn't made for being used
+#              from several threads at once, and here it runs alongside pimidipy.run() and the
+#              callbacks. Only use it when measurements show the startup gain is worth that risk.
+#
+# The following can be set in /etc/pimidipy.conf:
+#
+# PIMIDIPY_STARTUP_PROFILE=0            # Set to 1 to print how long the startup took.
+# PIMIDIPY_OPEN_OUTPUTS=startup         # When to open the outputs: startup, write or background.
+
+import os
+from collections import deque
+from os import getenv
+from threading import Lock, Thread
+from time import clock_gettime, perf_counter, CLOCK_BOOTTIME
+
+PIMIDIPY_STARTUP_PROFILE = int(getenv("PIMIDIPY_STARTUP_PROFILE", 0)) != 0
+PIMIDIPY_OPEN_OUTPUTS = getenv("PIMIDIPY_OPEN_OUTPUTS", "startup")
+
+if PIMIDIPY_OPEN_OUTPUTS not in ("startup", "background", "write"):
+	raise ValueError(f"Invalid PIMIDIPY_OPEN_OUTPUTS '{PIMIDIPY_OPEN_OUTPUTS}', use one of startup, background or write")
+
+# How long the process has been running, in seconds, from its start time in /proc.
+def process_age():
+	try:
+		with open("/proc/self/stat") as f:
+			# The fields following the command name, starting with the 3rd one, the start time is the 22nd.
+			fields = f.read().rpartition(")")[2].split()
+		return clock_gettime(CLOCK_BOOTTIME) - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+	except (OSError, ValueError, IndexError):
+		return None
+
+STARTED = perf_counter()
+PROCESS_AGE = process_age() if PIMIDIPY_STARTUP_PROFILE else None
+
+marks = []
+reported = False
+
+# Marks the end of a startup phase.
+def mark(phase):
+	if PIMIDIPY_STARTUP_PROFILE and not reported:
+		marks.append((phase, perf_counter()))
+
+def format_report(received, handled):
+	phases = []
+	if PROCESS_AGE is not None:
+		phases.append("process {:.1f} ms".format(1000 * PROCESS_AGE))
+	previous = STARTED
+	for phase, time in marks:
+		phases.append("{} {:.1f} ms".format(phase, 1000 * (time - previous)))
+		previous = time
+	return "Startup: {}, ready after {:.1f} ms. First event received after {:.1f} ms, handled in {:.1f} ms".format(
+		", ".join(phases),
+		1000 * (previous - STARTED + (PROCESS_AGE or 0)),
+		1000 * (received - STARTED + (PROCESS_AGE or 0)),
+		1000 * (handled - received)
+		)
+
+# Returns the callback reporting the startup times once the first event is handled, or as it is
+# when not profiling.
+def first_event(callback):
+	if not PIMIDIPY_STARTUP_PROFILE:
+		return callback
+	def profiled(event):
+		global reported
+		if reported:
+			return callback(event)
+		received = perf_counter()
+		result = callback(event)
+		reported = True
+		# Printed from a thread, to not hold up the callback.
+		Thread(target=print, args=(format_report(received, perf_counter()),), name="startup-report", daemon=True).start()
+		return result
+	return profiled
+
+class LazyOutput:
+	def __init__(self, pimidipy, port):
+		self.pimidipy = pimidipy
+		self.port = port
+		self.name = pimidipy.get_output_port(port) if isinstance(port, int) else port
+		self.output = None
+		self._lock = Lock()
+
+	def open(self):
+		with self._lock:
+			if self.output is None:
+				output = self.pimidipy.open_output(self.port)
+				self.name = output.name
+				# The writes made through the instance go straight to the port from now on.
+				self.write = output.write
+				self.output = output
+		return self.output
+
+	def write(self, event, drain=True):
+		output = self.output
+		if output is None:
+			output = self.open()
+		return output.write(event, drain)
+
+	def close(self):
+		if self.output is not None:
+			self.output.close()
+
+# Per pimidipy instance and port, a hot reloaded script gets the same outputs back, like from
+# pimidipy.open_output().
+lazy_outputs = {}
+pending = deque()
+opener = None
+opener_lock = Lock()
+
+def open_pending():
+	global opener
+	while True:
+		with opener_lock:
+			if not pending:
+				opener = None
+				return
+			output = pending.popleft()
+		try:
+			output.open()
+		except Exception as e:
+			print("Failed to open output port {}: {}".format(output.name, e))
+
+# Returns the output port, opened according to PIMIDIPY_OPEN_OUTPUTS.
+def open_output(pimidipy, port):
+	global opener
+	if PIMIDIPY_OPEN_OUTPUTS == "startup":
+		return pimidipy.open_output(port)
+	output = lazy_outputs.get((pimidipy, port))
+	if output is not None:
+		return output
+	output = lazy_outputs[(pimidipy, port)] = LazyOutput(pimidipy, port)
+	if PIMIDIPY_OPEN_OUTPUTS == "background":
+		with opener_lock:
+			pending.append(output)
+			if opener is None:
+				opener = Thread(target=open_pending, name="open-outputs", daemon=True)
+				opener.start()
+	return output
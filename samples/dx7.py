@@ -34,6 +34,65 @@
 #
 # It's also possible to provide more than one CC ID for a parameter by separating them with a comma.
 #
+# Parameter changes are not written out immediately, they are queued and paced to fit the DX7's
+# 31.25 kbaud MIDI input. Changes that would not alter the last value sent are dropped, and a newer
+# value for a parameter that is still waiting to be sent replaces the older one. Note and other
+# non-CC events bypass the queue and are sent right away. The byte budget can be set in
+# /etc/pimidipy.conf:
+#
+# DX7_OUTPUT_BYTES_PER_SEC=3125  # 31250 baud / 10 bits per byte, lower it if the DX7 still lags.
+#
+# The script keeps a copy of the whole voice in memory. When many parameters change at once (a bank
+# recall, a controller snapshot, ...) and DX7_BULK_DUMP_THRESHOLD (24 by default) or more changes are
+# waiting to be sent, a single 163 byte VCED voice dump is sent instead of the individual changes.
+# That's only done once the whole voice is known, after a snapshot or library recall, as the dump
+# would otherwise reset the parameters that were never set to their INIT VOICE values.
+#
+# The voice can be saved to and recalled from named snapshots, stored as .syx files in
+# DX7_SNAPSHOT_DIR (~/.pimidipy/dx7 by default). The snapshots can be triggered using CC controls,
+# the CC value selects the snapshot slot (000-127), so buttons or program-style selectors work best.
+# The slots are named after their number unless given a name, which is also the name of their file:
+#
+# DX7_SNAPSHOT_SAVE_CC=ch:cc_id
+# DX7_SNAPSHOT_RECALL_CC=ch:cc_id
+# DX7_SNAPSHOT_NAMES=slot:name,...  # For example 0:Brass,1:E.Piano, the other slots keep their number.
+#
+# The snapshot files are written and read by a thread of their own, so a slow SD card doesn't hold
+# up the events. A recalled voice is sent once its file has been read.
+#
+# Voices can also be recalled from a library of 32-voice cartridges (.syx files) using Bank Select and
+# Program Change. Program Change n recalls voice n % 32 of cartridge bank * 4 + n // 32, the
+# cartridges being numbered in the order of their paths. The cartridges are indexed once and the
+# voices sent as VCED voice dumps (see common/dx7_library.py), the index gets updated on start when
+# cartridges are added or changed. Program Changes are passed through while the library is off.
+#
+# DX7_LIBRARY_DIR=                                 # Folder with the cartridges, the library is off if not set.
+# DX7_LIBRARY_INDEX_DIR=~/.pimidipy/dx7/library   # Where the index is stored.
+# DX7_LIBRARY_BANK_CC=32                           # Bank Select LSB, on the device's channel (see below).
+# DX7_LIBRARY_BANK_MSB_CC=                         # Bank Select MSB, CC 0 is taken by DX7_BANK_CONTROL_0 by default.
+#
+# Up to 16 DX7s (or TX802s, TX7s, ...) can be driven at once, each with its own device ID, output
+# port, selected bank and CC mapping:
+#
+# DX7_DEVICES=1  # Number of devices.
+#
+# Device n (0 to DX7_DEVICES-1) is configured by the variables above with DX7_n_ in place of the DX7_
+# prefix, for example DX7_1_DEVICE_ID, DX7_1_BANK_CONTROL_0, DX7_1_PARAM_137 or DX7_1_LIBRARY_BANK_CC.
+# Device 0 also reads the unprefixed ones, so a single device setup stays as it is. Two more can be
+# set per device:
+#
+# DX7_n_OUTPUT=n   # The output port of the device, devices sharing a port need different device IDs.
+# DX7_n_CHANNEL=n  # The MIDI channel (0-15) of the device, -1 for all, the default with a single device.
+#
+# The bank controls, the library Bank Select and the Program Changes of a device are taken from its
+# channel, and the channel events that aren't mapped are passed through to the outputs of the
+# devices on their channel. DX7_n_PARAM_m and the snapshot CCs without a 'ch:' use the device's
+# channel. Device n defaults to device ID n, which matches its channel, so the DX7 is set to receive
+# on MIDI channel n+1 for both. Each output is paced on its own to DX7_OUTPUT_BYTES_PER_SEC, the
+# snapshots and the library are shared by all the devices. The queued changes of all the outputs are
+# sent by a single thread, taking turns between the outputs, so the writes to the ALSA client never
+# happen at the same time.
+#
 
 # Based on information from https://github.com/asb2m10/dexed/blob/master/Documentation/sysex-format.txt
 #
@@ -97,13 +156,34 @@
 #155        OPERATOR ON/OFF
 #              bit6 = 0 / bit 5: OP1 / ... / bit 0: OP6
 
-from collections import defaultdict
+from common.startup import first_event, mark, open_output
+from common.reload import hot_reload, keep
+hot_reload(__file__)
+
 from pimidipy import *
 pimidipy = PimidiPy()
 
-from os import getenv
+from collections import deque
+from os import getenv, makedirs, path, strerror
+from threading import Condition, RLock, Thread
+from time import monotonic
+
+from common.config import cached
+from common.log import Log, DEBUG, INFO, WARNING
+from common.metrics import Metrics
+from common.realtime import RealTime
+
+mark("import")
+
+log = keep("log", Log)
+realtime = keep("realtime", lambda: RealTime(log))
+metrics = keep("metrics", lambda: Metrics("dx7"))
 
-DX7_DEVICE_ID = getenv("DX7_DEVICE_ID", 0)
+DX7_DEVICES = int(getenv("DX7_DEVICES", 1))
+if DX7_DEVICES < 1 or DX7_DEVICES > 16:
+	raise ValueError(f"Invalid DX7_DEVICES '{DX7_DEVICES}', up to 16 devices are supported")
+
+DX7_OUTPUT_BYTES_PER_SEC = int(getenv("DX7_OUTPUT_BYTES_PER_SEC", 3125))
 
 DX7_PARAMETERS = [
 	{ "id":  0,  "min": 0, "max":  99, "name": "OP6 EG rate 1" },
@@ -304,86 +384,674 @@ def build_parameter_change_event(device_id, parameter_id, value):
 		raise ValueError(f"Value '{value}' out of range for parameter '{DX7_PARAMETERS[parameter_id]['name']}'")
 	return SysExEvent([ 0xf0, 0x43, 0x10 | device_id, (parameter_id & 0x80) >> 7, (parameter_id & 0x7f), value, 0xf7 ])
 
+# Size of the messages on the wire, used for the pacing budget.
+PARAMETER_CHANGE_SIZE = 7
+CHANNEL_MESSAGE_SIZE = 3
+VOICE_DUMP_SIZE = 163
+
+# A VCED single voice dump carries parameters 0-154, OPERATOR ON/OFF (155) is only reachable
+# through a parameter change.
+VCED_SIZE = 155
+
+# Number of queued changes for a device at which a single voice dump is cheaper than sending
+# the parameter changes one by one.
+DX7_BULK_DUMP_THRESHOLD = int(getenv("DX7_BULK_DUMP_THRESHOLD", VOICE_DUMP_SIZE // PARAMETER_CHANGE_SIZE + 1))
+
+def build_voice_dump_event(device_id, voice):
+	if device_id < 0 or device_id > 15:
+		raise ValueError("Invalid device ID")
+	data = bytes(voice[:VCED_SIZE])
+	if len(data) != VCED_SIZE:
+		raise ValueError("Voice data must hold {} parameters".format(VCED_SIZE))
+	return SysExEvent(bytes([ 0xf0, 0x43, device_id, 0x00, 0x01, 0x1b ]) + data + bytes([ -sum(data) & 0x7f, 0xf7 ]))
+
+def init_operator(output_level):
+	return [ 99, 99, 99, 99, 99, 99, 99, 0, 39, 0, 0, 0, 0, 0, 0, 0, output_level, 0, 1, 0, 7 ]
+
+# The DX7 'INIT VOICE', used as the starting point of the voice shadow.
+INIT_VOICE = bytes(
+	init_operator(0) * 5 + init_operator(99) +
+	[ 99, 99, 99, 99, 50, 50, 50, 50, 0, 0, 1, 35, 0, 0, 0, 1, 0, 3, 24 ] +
+	list(b"INIT VOICE") +
+	[ 63 ]
+	)
+
+# Marks a parameter whose value on the DX7 is not known yet, never equal to a valid value.
+UNKNOWN_VALUE = 0xff
+
+ALL_OPERATORS_ON = 63
+
+class VoiceState:
+	def __init__(self, device_id):
+		# The voice as it should be on the DX7, updated as soon as a change is requested.
+		self.shadow = bytearray(INIT_VOICE)
+		# Which parameters of the shadow were set, a voice dump would reset the others to INIT VOICE
+		# on the DX7, so it's only sent once none of the VCED parameters is left.
+		self.known = bytearray(len(DX7_PARAMETERS))
+		self.unknown = VCED_SIZE
+		# The values that were actually sent to the DX7.
+		self.sent = bytearray([ UNKNOWN_VALUE ]) * len(DX7_PARAMETERS)
+		self.pending = 0
+		# Prebuilt messages, only the value (and the checksum of the dump) gets filled in when sending.
+		# The parameter change events are kept per parameter and value once built, and reused.
+		if device_id < 0 or device_id > 15:
+			raise ValueError(f"Invalid device ID '{device_id}', use 0-15 for device IDs 1-16")
+		self.messages = [ bytearray([ 0xf0, 0x43, 0x10 | device_id, param_id >> 7, param_id & 0x7f, 0x00, 0xf7 ]) for param_id in range(len(DX7_PARAMETERS)) ]
+		self.events = {}
+		self.dump = bytearray(build_voice_dump_event(device_id, INIT_VOICE).data)
+
+	def parameter_change(self, param_id, value):
+		event = self.events.get(param_id << 8 | value)
+		if event is None:
+			message = self.messages[param_id]
+			message[5] = value
+			event = self.events[param_id << 8 | value] = SysExEvent(bytes(message))
+		return event
+
+	def set_known(self, param_id):
+		if not self.known[param_id]:
+			self.known[param_id] = 1
+			if param_id < VCED_SIZE:
+				self.unknown -= 1
+
+	def set_all_known(self):
+		self.known[:VCED_SIZE] = bytes([ 1 ]) * VCED_SIZE
+		self.unknown = 0
+
+# The queue and the pacing clock of an output. The lock and the thread sending the queued changes
+# are shared by the schedulers of all the outputs, see SchedulerThread.
+class ParameterScheduler:
+	def __init__(self, thread, output, bytes_per_sec, bulk_dump_threshold):
+		self.output = output
+		self.bytes_per_sec = bytes_per_sec
+		self.bulk_dump_threshold = bulk_dump_threshold
+		self.sent = 0
+		self.dropped = 0
+		self.merged = 0
+		self.bulk_dumps = 0
+		self._voices = {}
+		self._pending = {}
+		self._next_free = monotonic()
+		self._lock = thread.lock
+		self._cond = thread.cond
+
+	def _voice(self, device_id):
+		voice = self._voices.get(device_id)
+		if voice is None:
+			voice = self._voices[device_id] = VoiceState(device_id)
+		return voice
+
+	def _queue(self, voice, key):
+		self._pending[key] = None
+		voice.pending += 1
+
+	# Queue a parameter change, (device_id, param_id) changes still waiting to be sent get merged,
+	# the newest value wins.
+	def set_parameter(self, device_id, param_id, value):
+		key = (device_id, param_id)
+		with self._lock:
+			voice = self._voice(device_id)
+			voice.shadow[param_id] = value
+			voice.set_known(param_id)
+			if key in self._pending:
+				self.merged += 1
+			elif voice.sent[param_id] == value:
+				self.dropped += 1
+			else:
+				self._queue(voice, key)
+				self._cond.notify()
+
+	# Replace the whole voice, the changed parameters get queued and will most likely go out
+	# as a single voice dump.
+	def load_voice(self, device_id, data):
+		with self._lock:
+			voice = self._voice(device_id)
+			for param_id, value in enumerate(data):
+				voice.shadow[param_id] = value
+				voice.set_known(param_id)
+				key = (device_id, param_id)
+				if key not in self._pending and voice.sent[param_id] != value:
+					self._queue(voice, key)
+			self._cond.notify()
+
+	# Send a complete voice dump right away, it replaces whatever is queued for the voice. The
+	# dump gets copied into the device's own dump buffer, which carries its device ID.
+	def send_dump(self, device_id, dump):
+		with self._lock:
+			voice = self._voice(device_id)
+			if voice.pending:
+				for param_id in range(VCED_SIZE):
+					if self._pending.pop((device_id, param_id), UNKNOWN_VALUE) is None:
+						voice.pending -= 1
+			voice.dump[6:] = dump[6:]
+			voice.shadow[:VCED_SIZE] = voice.dump[6:6+VCED_SIZE]
+			voice.set_all_known()
+			voice.sent[:VCED_SIZE] = voice.shadow[:VCED_SIZE]
+			self._consume(VOICE_DUMP_SIZE)
+			self.output.write(SysExEvent(bytes(voice.dump)))
+			self.bulk_dumps += 1
+			# The dump doesn't carry OPERATOR ON/OFF, have all the operators of the new voice on.
+			voice.shadow[VCED_SIZE] = ALL_OPERATORS_ON
+			key = (device_id, VCED_SIZE)
+			if key not in self._pending and voice.sent[VCED_SIZE] != ALL_OPERATORS_ON:
+				self._queue(voice, key)
+				self._cond.notify()
+
+	def get_voice(self, device_id):
+		with self._lock:
+			return bytes(self._voice(device_id).shadow)
+
+	def pending_count(self):
+		with self._lock:
+			return len(self._pending)
+
+	def has_pending(self):
+		with self._lock:
+			return bool(self._pending)
+
+	# Write an event right away, ahead of any queued parameter changes. It still uses up
+	# the byte budget, so the queued changes get delayed accordingly.
+	def write(self, event, size=CHANNEL_MESSAGE_SIZE):
+		with self._lock:
+			self._consume(size)
+			self.output.write(event)
+
+	def _consume(self, size):
+		self._next_free = max(self._next_free, monotonic()) + size / self.bytes_per_sec
+
+	def _send_parameter(self, key):
+		device_id, param_id = key
+		voice = self._voices[device_id]
+		del self._pending[key]
+		voice.pending -= 1
+		value = voice.shadow[param_id]
+		if voice.sent[param_id] == value:
+			return
+		voice.sent[param_id] = value
+		self._consume(PARAMETER_CHANGE_SIZE)
+		self.output.write(voice.parameter_change(param_id, value))
+		self.sent += 1
+
+	def _send_voice(self, device_id):
+		voice = self._voices[device_id]
+		for param_id in range(VCED_SIZE):
+			if self._pending.pop((device_id, param_id), UNKNOWN_VALUE) is None:
+				voice.pending -= 1
+		voice.sent[:VCED_SIZE] = voice.shadow[:VCED_SIZE]
+		dump = voice.dump
+		dump[6:6+VCED_SIZE] = voice.shadow[:VCED_SIZE]
+		dump[-2] = -sum(voice.shadow[:VCED_SIZE]) & 0x7f
+		self._consume(VOICE_DUMP_SIZE)
+		self.output.write(SysExEvent(bytes(dump)))
+		self.bulk_dumps += 1
+
+	# Sends the oldest queued change, or the whole voice it belongs to, called with the lock held.
+	def _send_next(self):
+		key = next(iter(self._pending))
+		device_id, param_id = key
+		voice = self._voices[device_id]
+		if param_id < VCED_SIZE and voice.pending >= self.bulk_dump_threshold and voice.unknown == 0:
+			self._send_voice(device_id)
+		else:
+			self._send_parameter(key)
+
+	def stats(self):
+		return "sent {}, dropped {}, merged {}, bulk dumps {}, pending {}".format(self.sent, self.dropped, self.merged, self.bulk_dumps, self.pending_count())
+
+# Sends the queued changes of all the outputs, one message per output whose clock allows it in
+# turn. All writes to the outputs, the ones made by the callback included, are made with the lock
+# held. The lock is reentrant, for the thread to use the schedulers' own methods while holding it.
+class SchedulerThread:
+	def __init__(self):
+		self.schedulers = []
+		self.lock = RLock()
+		self.cond = Condition(self.lock)
+		self._thread = Thread(target=self._run, name="dx7-scheduler", daemon=True)
+		self._thread.start()
+
+	def add(self, output, bytes_per_sec, bulk_dump_threshold):
+		scheduler = ParameterScheduler(self, output, bytes_per_sec, bulk_dump_threshold)
+		with self.lock:
+			self.schedulers.append(scheduler)
+		return scheduler
+
+	def _run(self):
+		while True:
+			# The lock is let go of after every round, for the callback to get its turn.
+			with self.lock:
+				now = monotonic()
+				wait = None
+				sent = False
+				for scheduler in self.schedulers:
+					if not scheduler.has_pending():
+						continue
+					delay = scheduler._next_free - now
+					if delay > 0:
+						if wait is None or delay < wait:
+							wait = delay
+						continue
+					scheduler._send_next()
+					sent = True
+				if not sent:
+					# Until the next output is free again, or until changes get queued.
+					self.cond.wait(wait)
+
 def remap_cc_value(cc_value, min_value, max_value):
 	return int(min_value + (cc_value / 127.0) * (max_value - min_value))
 
-bank_cc_controls = {}
-direct_cc_mappings = defaultdict(list)
-
-for i in range(8):
-	id = getenv(f"DX7_BANK_CONTROL_{i}", i)
-	if id is not None:
-		bank_cc_controls[int(id)] = i
+def check_cc(channel, cc):
+	if channel < 0 or channel > 15:
+		raise ValueError(f"Invalid MIDI channel '{channel}'")
+	if cc < 0 or cc > 127:
+		raise ValueError(f"Invalid CC ID '{cc}'")
 
-def parse_param_mappings(mappings):
+def parse_param_mappings(mappings, default_channel=0):
 	result = []
 	mapping = mappings.split(",")
 	for m in mapping:
 		if ":" in m:
 			channel, cc = m.split(":")
 		else:
-			channel, cc = (0, m)
+			channel, cc = (default_channel, m)
+		check_cc(int(channel), int(cc))
 		result.append((int(channel), int(cc)))
 	return result
 
-for i in range(len(DX7_PARAMETERS)):
-	mappings = getenv(f"DX7_PARAM_{i}", None)
-	if mappings is not None:
-		m = parse_param_mappings(mappings)
-		for channel, cc in m:
-			direct_cc_mappings[(channel, cc)].append(i)
-
-current_bank = 0
-
-def switch_bank(bank_id):
-	global current_bank
-	if current_bank != bank_id:
-		current_bank = bank_id
-		print(" ")
-		print(f"Switched to bank {CONTROL_BANKS[current_bank]['name']}, controls:")
-		print("[{}]".format("Bank select".ljust(LONGEST_PARAMETER_NAME_LEN)), end=" ")
-		for i, param_id in enumerate(CONTROL_BANKS[current_bank]["parameters"]):
-			print("[{}]".format(DX7_PARAMETERS[param_id]["name"].ljust(LONGEST_PARAMETER_NAME_LEN)), end=" " if i % 7 != 2 else "\n")
-		if i != 2:
-			print()
-
-def set_parameter(device_id, param_id, value):
-	print(f"Setting {DX7_PARAMETERS[param_id]['name']} to {value}")
-	output.write(build_parameter_change_event(device_id, param_id, value))
+# Device n reads its settings from DX7_n_..., device 0 falls back to the unprefixed DX7_...
+def device_getenv(index, name, default):
+	value = getenv(f"DX7_{index}_{name}", None)
+	if value is None and index == 0:
+		value = getenv(f"DX7_{name}", None)
+	return default if value is None else value
+
+DX7_SNAPSHOT_DIR = path.expanduser(getenv("DX7_SNAPSHOT_DIR", "~/.pimidipy/dx7"))
+
+# The name of every snapshot slot, the slots without one are named after their number.
+def parse_snapshot_names(value):
+	names = [ f"{slot:03}" for slot in range(128) ]
+	for item in value.split(","):
+		if not item:
+			continue
+		slot, _, name = item.partition(":")
+		slot = int(slot)
+		if slot < 0 or slot > 127:
+			raise ValueError(f"Invalid snapshot slot '{slot}' in DX7_SNAPSHOT_NAMES, use 0-127")
+		if not name or "/" in name or name.startswith("."):
+			raise ValueError(f"Invalid snapshot name '{name}' in DX7_SNAPSHOT_NAMES")
+		if name in names and names.index(name) != slot:
+			raise ValueError(f"Snapshot name '{name}' used twice in DX7_SNAPSHOT_NAMES")
+		names[slot] = name
+	return names
+
+SNAPSHOT_NAMES = parse_snapshot_names(getenv("DX7_SNAPSHOT_NAMES", ""))
+
+DX7_LIBRARY_DIR = path.expanduser(getenv("DX7_LIBRARY_DIR", ""))
+DX7_LIBRARY_INDEX_DIR = path.expanduser(getenv("DX7_LIBRARY_INDEX_DIR", "~/.pimidipy/dx7/library"))
+
+# The CC handling is compiled into flat tables at startup, so that handling a CC is just a couple
+# of array lookups:
+#
+# CC_VALUE_TABLES[param_id][cc_value]  - the parameter value to send for the CC value.
+# cc_dispatch[channel << 7 | cc]       - the devices the CC is mapped for.
+# device.dispatch[channel << 7 | cc]   - the parameter IDs the CC controls on the device in the bank
+#                                        it has selected, negative IDs are the ACTION_... below.
+#
+# cc_dispatch is shared by all the devices, so a CC only costs a lookup per device it's actually
+# mapped for, however many devices there are. Each device has its tables compiled for every bank
+# up front, switching banks just swaps them.
+
+ACTION_BANK_SELECT = -1
+ACTION_SNAPSHOT_SAVE = -2
+ACTION_SNAPSHOT_RECALL = -3
+ACTION_LIBRARY_BANK = -4
+ACTION_LIBRARY_BANK_MSB = -5
+
+# Built once per value range, most of the parameters share one.
+VALUE_RANGE_TABLES = { (min_value, max_value): bytes(remap_cc_value(v, min_value, max_value) for v in range(128)) for min_value, max_value in set((parameter["min"], parameter["max"]) for parameter in DX7_PARAMETERS) }
+CC_VALUE_TABLES = [ VALUE_RANGE_TABLES[(parameter["min"], parameter["max"])] for parameter in DX7_PARAMETERS ]
+BANK_SELECT_TABLE = bytes(remap_cc_value(v, 0, len(CONTROL_BANKS) - 1) for v in range(128))
+
+def device_channels(channel):
+	return range(16) if channel < 0 else range(channel, channel + 1)
+
+# Parses the settings of device 'index' and compiles its CC tables, as plain data so they can be
+# cached (see common/config.py).
+def compile_device(index):
+	device_id = int(device_getenv(index, "DEVICE_ID", index))
+	if device_id < 0 or device_id > 15:
+		raise ValueError(f"Invalid device ID '{device_id}' for DX7 {index}, use 0-15 for device IDs 1-16")
+	channel = int(device_getenv(index, "CHANNEL", -1 if DX7_DEVICES == 1 else index))
+	if channel < -1 or channel > 15:
+		raise ValueError(f"Invalid MIDI channel '{channel}' for DX7 {index}")
+	device = {
+		"device_id": device_id,
+		"port": int(device_getenv(index, "OUTPUT", index)),
+		"channel": channel,
+		"bank_cc_controls": {},
+		"direct_cc_mappings": {},
+		"snapshot_cc_controls": {},
+		"library_cc_controls": {},
+	}
+	default_channel = device_channels(channel)[0]
+
+	for i in range(8):
+		id = device_getenv(index, f"BANK_CONTROL_{i}", i)
+		if id is not None:
+			check_cc(0, int(id))
+			device["bank_cc_controls"][int(id)] = i
+
+	for i in range(len(DX7_PARAMETERS)):
+		mappings = device_getenv(index, f"PARAM_{i}", None)
+		if mappings is not None:
+			for channel, cc in parse_param_mappings(mappings, default_channel):
+				device["direct_cc_mappings"].setdefault((channel, cc), []).append(i)
+
+	for action in ("SAVE", "RECALL"):
+		mappings = device_getenv(index, f"SNAPSHOT_{action}_CC", None)
+		if mappings is not None:
+			for channel, cc in parse_param_mappings(mappings, default_channel):
+				device["snapshot_cc_controls"][(channel, cc)] = action
+
+	if DX7_LIBRARY_DIR:
+		for action, default in (("BANK", 32), ("BANK_MSB", None)):
+			cc = device_getenv(index, f"LIBRARY_{action}_CC", default)
+			if cc is not None and cc != "":
+				check_cc(0, int(cc))
+				device["library_cc_controls"][int(cc)] = action
+
+	# Per bank: channel << 7 | cc -> the parameter IDs and actions of the CC. Every table holds
+	# all the CCs the device maps in any bank.
+	banks = [ compile_bank(device, bank_id) for bank_id in range(len(CONTROL_BANKS)) ]
+	keys = set(key for bank in banks for key in bank)
+	for bank in banks:
+		for key in keys:
+			bank.setdefault(key, ())
+	device["banks"] = banks
+	return device
+
+def compile_bank(device, bank_id):
+	channels = device_channels(device["channel"])
+	dispatch = {}
+	for (channel, cc), action in device["snapshot_cc_controls"].items():
+		dispatch.setdefault(channel << 7 | cc, []).append(ACTION_SNAPSHOT_SAVE if action == "SAVE" else ACTION_SNAPSHOT_RECALL)
+	for cc, action in device["library_cc_controls"].items():
+		for channel in channels:
+			dispatch.setdefault(channel << 7 | cc, []).append(ACTION_LIBRARY_BANK if action == "BANK" else ACTION_LIBRARY_BANK_MSB)
+	parameters = CONTROL_BANKS[bank_id]["parameters"]
+	for cc, id in device["bank_cc_controls"].items():
+		for channel in channels:
+			if id == 0:
+				dispatch.setdefault(channel << 7 | cc, []).append(ACTION_BANK_SELECT)
+			elif id - 1 < len(parameters):
+				dispatch.setdefault(channel << 7 | cc, []).append(parameters[id - 1])
+	for (channel, cc), param_ids in device["direct_cc_mappings"].items():
+		dispatch.setdefault(channel << 7 | cc, []).extend(param_ids)
+	return { key: tuple(entry) for key, entry in dispatch.items() }
+
+class Device:
+	def __init__(self, index, compiled):
+		self.index = index
+		self.device_id = compiled["device_id"]
+		self.port = compiled["port"]
+		self.channel = compiled["channel"]
+		self.channels = device_channels(self.channel)
+		self.bank_cc_controls = compiled["bank_cc_controls"]
+		self.direct_cc_mappings = compiled["direct_cc_mappings"]
+		self.snapshot_cc_controls = compiled["snapshot_cc_controls"]
+		self.library_cc_controls = compiled["library_cc_controls"]
+		self.banks = compiled["banks"]
+		self.bank = 0
+		self.library_bank = 0
+		self.dispatch = self.banks[self.bank]
+		self.scheduler = None
+
+	def name(self):
+		return f"DX7 {self.index}" if DX7_DEVICES > 1 else "DX7"
+
+# Compiled again only when a DX7_ variable or this file changes.
+devices = [ Device(index, compiled) for index, compiled in enumerate(cached(__file__, "DX7_", lambda: [ compile_device(index) for index in range(DX7_DEVICES) ])) ]
+
+targets = {}
+for device in devices:
+	other = targets.setdefault((device.port, device.device_id), device)
+	if other is not device:
+		raise ValueError(f"DX7 {other.index} and DX7 {device.index} both use device ID {device.device_id} on output {device.port}")
+
+# Unmapped entries all share the same empty tuple.
+cc_dispatch = [ () ] * (16 << 7)
+for key in set(key for device in devices for key in device.dispatch):
+	cc_dispatch[key] = tuple(device for device in devices if key in device.dispatch)
+
+def snapshot_path(name):
+	return path.join(DX7_SNAPSHOT_DIR, name + ".syx")
+
+# Runs the snapshot file accesses one after the other, off the MIDI callback.
+class SnapshotWorker:
+	def __init__(self):
+		self._jobs = deque()
+		self._condition = Condition()
+		self._thread = Thread(target=self._run, name="dx7-snapshots", daemon=True)
+		self._thread.start()
+
+	def submit(self, job, *args):
+		with self._condition:
+			self._jobs.append((job, args))
+			self._condition.notify()
+
+	def _run(self):
+		while True:
+			with self._condition:
+				while not self._jobs:
+					self._condition.wait()
+				job, args = self._jobs.popleft()
+			job(*args)
+
+snapshot_worker = keep("snapshot_worker", SnapshotWorker)
+
+# The snapshot slot is passed as a, the errno of a failed file access as b.
+MSG_SNAPSHOT_SAVED = log.message("snapshot_saved", lambda record: f"{devices[record.port].name()}: saved snapshot '{SNAPSHOT_NAMES[record.a]}'", INFO)
+MSG_SNAPSHOT_SAVE_FAILED = log.message("snapshot_save_failed", lambda record: f"{devices[record.port].name()}: failed to save snapshot '{SNAPSHOT_NAMES[record.a]}': {strerror(record.b)}", WARNING)
+MSG_SNAPSHOT_RECALLED = log.message("snapshot_recalled", lambda record: f"{devices[record.port].name()}: recalled snapshot '{SNAPSHOT_NAMES[record.a]}'", INFO)
+MSG_SNAPSHOT_RECALL_FAILED = log.message("snapshot_recall_failed", lambda record: f"{devices[record.port].name()}: failed to recall snapshot '{SNAPSHOT_NAMES[record.a]}': {strerror(record.b)}", WARNING)
+MSG_SNAPSHOT_INVALID = log.message("snapshot_invalid", lambda record: f"{devices[record.port].name()}: failed to recall snapshot '{SNAPSHOT_NAMES[record.a]}': no valid voice dump in it", WARNING)
+
+# The snapshot is stored as a VCED voice dump followed by the OPERATOR ON/OFF parameter change,
+# so it can be loaded by other DX7 tools as well.
+def write_snapshot(device, slot, voice):
+	try:
+		makedirs(DX7_SNAPSHOT_DIR, exist_ok=True)
+		with open(snapshot_path(SNAPSHOT_NAMES[slot]), "wb") as f:
+			f.write(build_voice_dump_event(device.device_id, voice).data)
+			f.write(build_parameter_change_event(device.device_id, VCED_SIZE, voice[VCED_SIZE]).data)
+	except OSError as e:
+		log.log(MSG_SNAPSHOT_SAVE_FAILED, device.index, b"", slot, e.errno or 0)
+		return
+	log.log(MSG_SNAPSHOT_SAVED, device.index, b"", slot)
+
+# The voice is taken as it is when the save is triggered, the file is written by the worker.
+def save_snapshot(device, slot):
+	snapshot_worker.submit(write_snapshot, device, slot, device.scheduler.get_voice(device.device_id))
+
+def parse_voice_file(data):
+	voice = bytearray(INIT_VOICE)
+	found = False
+	start = data.find(0xf0)
+	while start >= 0:
+		end = data.find(0xf7, start)
+		if end < 0:
+			break
+		message = data[start:end+1]
+		if len(message) == VOICE_DUMP_SIZE and message[1] == 0x43 and message[2] & 0xf0 == 0x00 and message[3:6] == bytes([ 0x00, 0x01, 0x1b ]):
+			body = message[6:6+VCED_SIZE]
+			if -sum(body) & 0x7f != message[-2]:
+				raise ValueError("Voice dump checksum mismatch")
+			voice[:VCED_SIZE] = body
+			found = True
+		elif len(message) == PARAMETER_CHANGE_SIZE and message[1] == 0x43 and message[2] & 0xf0 == 0x10:
+			param_id = (message[3] & 0x03) << 7 | message[4]
+			if param_id < len(DX7_PARAMETERS):
+				voice[param_id] = message[5]
+		start = data.find(0xf0, end)
+	if not found:
+		raise ValueError("No voice dump found")
+	return voice
+
+def read_snapshot(device, slot):
+	try:
+		with open(snapshot_path(SNAPSHOT_NAMES[slot]), "rb") as f:
+			voice = parse_voice_file(f.read())
+	except OSError as e:
+		log.log(MSG_SNAPSHOT_RECALL_FAILED, device.index, b"", slot, e.errno or 0)
+		return
+	except ValueError:
+		log.log(MSG_SNAPSHOT_INVALID, device.index, b"", slot)
+		return
+	device.scheduler.load_voice(device.device_id, voice)
+	log.log(MSG_SNAPSHOT_RECALLED, device.index, b"", slot)
+
+def recall_snapshot(device, slot):
+	snapshot_worker.submit(read_snapshot, device, slot)
+
+# Lays out the controls of the bank the same way as the suggested 4 by 2 knob layout.
+def format_bank_switch(record):
+	bank = CONTROL_BANKS[record.a]
+	controls = [ "Bank select" ] + [ DX7_PARAMETERS[param_id]["name"] for param_id in bank["parameters"] ]
+	controls = [ "[{}]".format(name.ljust(LONGEST_PARAMETER_NAME_LEN)) for name in controls ]
+	lines = [ f"{devices[record.port].name()}: switched to bank {bank['name']}, controls:", " ".join(controls[:4]) ]
+	if len(controls) > 4:
+		lines.append(" ".join(controls[4:]))
+	return "\n".join(lines)
+
+MSG_BANK_SWITCH = log.message("bank_switch", format_bank_switch, INFO)
+MSG_SET_PARAMETER = log.message("set_parameter", lambda record: f"{devices[record.port].name()}: setting {DX7_PARAMETERS[record.a]['name']} to {record.b}", DEBUG)
+
+def switch_bank(device, bank_id):
+	if device.bank != bank_id:
+		device.bank = bank_id
+		device.dispatch = device.banks[bank_id]
+		log.log(MSG_BANK_SWITCH, device.index, b"", bank_id)
+
+def set_parameter(device, param_id, value):
+	log.log(MSG_SET_PARAMETER, device.index, b"", param_id, value)
+	device.scheduler.set_parameter(device.device_id, param_id, value)
 
 def handle_cc(cc_channel, cc_id, cc_value):
-	global current_bank
-	if cc_id in bank_cc_controls:
-		id = bank_cc_controls[cc_id]
-		if id == 0:
-			switch_bank(remap_cc_value(cc_value, 0, len(CONTROL_BANKS) - 1))
-		else:
-			bank = CONTROL_BANKS[current_bank]
-			id -= 1
-			if id < len(bank["parameters"]):
-				param_id = bank["parameters"][id]
-				param_value = remap_cc_value(cc_value, DX7_PARAMETERS[param_id]["min"], DX7_PARAMETERS[param_id]["max"])
-				set_parameter(DX7_DEVICE_ID, param_id, param_value)
+	key = cc_channel << 7 | cc_id
+	for device in cc_dispatch[key]:
+		for param_id in device.dispatch[key]:
+			if param_id >= 0:
+				set_parameter(device, param_id, CC_VALUE_TABLES[param_id][cc_value])
+			elif param_id == ACTION_BANK_SELECT:
+				switch_bank(device, BANK_SELECT_TABLE[cc_value])
+			elif param_id == ACTION_SNAPSHOT_SAVE:
+				save_snapshot(device, cc_value)
+			elif param_id == ACTION_SNAPSHOT_RECALL:
+				recall_snapshot(device, cc_value)
+			elif param_id == ACTION_LIBRARY_BANK:
+				device.library_bank = device.library_bank & 0x3f80 | cc_value
+			elif param_id == ACTION_LIBRARY_BANK_MSB:
+				device.library_bank = cc_value << 7 | device.library_bank & 0x7f
 
-	for param_id in direct_cc_mappings[(cc_channel, cc_id)]:
-		param_value = remap_cc_value(cc_value, DX7_PARAMETERS[param_id]["min"], DX7_PARAMETERS[param_id]["max"])
-		set_parameter(DX7_DEVICE_ID, param_id, param_value)
+CARTRIDGES_PER_BANK = 128 // 32
+
+def open_library():
+	from common.dx7_library import Library
+	library = Library(DX7_LIBRARY_DIR, DX7_LIBRARY_INDEX_DIR, bytes(parameter["max"] for parameter in DX7_PARAMETERS[:VCED_SIZE]))
+	start = monotonic()
+	library.open()
+	print(f"DX7 library: {len(library.cartridges)} cartridges, {library.voice_count()} distinct voices, {library.duplicate_count()} duplicates, {library.indexed} cartridges indexed in {1000 * (monotonic() - start):.0f} ms")
+	if library.skipped:
+		print(f"DX7 library: {library.skipped} files in {DX7_LIBRARY_DIR} are not 32-voice cartridges")
+	return library
+
+# On hot reload, the library stays open, new cartridges get indexed on the next start.
+library = keep("library", open_library) if DX7_LIBRARY_DIR else None
+
+MSG_RECALL = log.message("recall", lambda record: f"{devices[record.port].name()}: recalled '{library.name(record.a)}', cartridge {library.names[record.b]}", INFO)
+MSG_NO_CARTRIDGE = log.message("no_cartridge", lambda record: f"{devices[record.port].name()}: no cartridge {record.a} in the library", WARNING)
+
+def recall_program(device, program):
+	cartridge = device.library_bank * CARTRIDGES_PER_BANK + program // 32
+	voice_id = library.voice_id(cartridge, program)
+	if voice_id is None:
+		log.log(MSG_NO_CARTRIDGE, device.index, b"", cartridge)
+		return
+	device.scheduler.send_dump(device.device_id, library.dump(voice_id))
+	log.log(MSG_RECALL, device.index, b"", voice_id, cartridge)
+
+mark("config")
 
 print("DX7 MIDI controller started")
 
 input = pimidipy.open_input(0)
-output = pimidipy.open_output(0)
+outputs = { port: metrics.wrap_output(open_output(pimidipy, port)) for port in sorted(set(device.port for device in devices)) }
 
 print("Using input port:", input.name)
-print("Using output port:", output.name)
+for port, output in outputs.items():
+	print("Using output port:", output.name)
+
+mark("ports")
+
+# One scheduler per output, so each output is paced on its own, all served by the same thread. On
+# hot reload, the schedulers and their thread are kept along with the voice shadows and the queued
+# changes.
+scheduler_thread = keep("scheduler_thread", SchedulerThread)
+schedulers = keep("schedulers", dict)
+for port, output in outputs.items():
+	if port not in schedulers:
+		schedulers[port] = scheduler_thread.add(output, DX7_OUTPUT_BYTES_PER_SEC, DX7_BULK_DUMP_THRESHOLD)
+for device in devices:
+	device.scheduler = schedulers[device.port]
+
+# The schedulers events are passed through to: channel_targets[channel] for channel events, those of
+# the devices listening on the channel, and system_targets for the others.
+channel_targets = [ tuple(schedulers[port] for port in outputs if any(channel in device.channels for device in devices if device.port == port)) for channel in range(16) ]
+system_targets = tuple(schedulers[port] for port in outputs)
+# The devices Program Changes go to, per channel.
+channel_devices = [ tuple(device for device in devices if channel in device.channels) for channel in range(16) ]
 
 def process_midi_message(message):
 	if isinstance(message, ControlChangeEvent):
 		handle_cc(message.channel, message.control, message.value)
+	elif isinstance(message, SysExEvent):
+		for scheduler in system_targets:
+			scheduler.write(message, len(message.data))
+	elif library is not None and isinstance(message, ProgramChangeEvent):
+		for device in channel_devices[message.channel]:
+			recall_program(device, message.value)
 	else:
 		# Pass the message through.
-		output.write(message)
+		channel = getattr(message, "channel", None)
+		for scheduler in system_targets if channel is None else channel_targets[channel]:
+			scheduler.write(message)
+
+# On hot reload, the banks selected in the previous version stay selected.
+def on_reload(previous):
+	for device, old in zip(devices, previous.get("devices", [])):
+		switch_bank(device, old.bank)
+		device.library_bank = old.library_bank
+
+for port in outputs:
+	scheduler = schedulers[port]
+	suffix = f" ({outputs[port].name})" if len(outputs) > 1 else ""
+	metrics.gauge("parameter changes sent" + suffix, lambda scheduler=scheduler: scheduler.sent)
+	metrics.gauge("voice dumps sent" + suffix, lambda scheduler=scheduler: scheduler.bulk_dumps)
+	metrics.gauge("parameter changes dropped" + suffix, lambda scheduler=scheduler: scheduler.dropped)
+	metrics.gauge("parameter changes merged" + suffix, lambda scheduler=scheduler: scheduler.merged)
+	metrics.gauge("parameter changes pending" + suffix, lambda scheduler=scheduler: scheduler.pending_count())
+for device in devices:
+	suffix = f" ({device.name()})" if len(devices) > 1 else ""
+	metrics.gauge("bank" + suffix, lambda device=device: CONTROL_BANKS[device.bank]["name"])
+	if library is not None:
+		metrics.gauge("library bank" + suffix, lambda device=device: device.library_bank)
 
-input.add_callback(process_midi_message)
+input.add_callback(first_event(realtime.wrap(metrics.wrap(process_midi_message, input.name))))
+
+realtime.start()
+
+mark("setup")
 
 pimidipy.run()
+
+for port, output in outputs.items():
+	print(f"Parameter changes ({output.name}):", schedulers[port].stats())
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+# Chains scripts into a pipeline, each running in its own process on its own CPU, for example
+# chord.py into dx7.py: the chords produced by chord.py are sent to the DX7 along with dx7.py's CC
+# mapping. Output 0 of a stage feeds input 0 of the next one through a shared memory ring, the
+# scripts themselves run unchanged. See common/pipeline.py for how the stages are linked.
+#
+# The pipeline is configured in /etc/pimidipy.conf:
+#
+# PIPELINE_STAGES=chord.py,dx7.py  # The scripts to chain, relative to this folder or absolute paths.
+# PIPELINE_CPUS=1,2,3              # The CPU to pin each stage to, -1 to not pin it.
+# PIPELINE_RING_SIZE=1024          # Records in each ring, a power of 2.
+# PIPELINE_SPIN_US=2000            # How long a stage polls its idle ring before sleeping, -1 to never sleep.
+# PIPELINE_IDLE_US=200             # Sleep between the polls of an idle ring.
+#
+# Leave CPU 0 to the system and the pimidipy input, the stages are best pinned to the other cores,
+# one each.
+
+import importlib
+import sys
+from os import getenv, path
+
+from common.pipeline import run_pipeline
+
+SAMPLES_DIR = path.dirname(path.abspath(__file__))
+
+PIPELINE_STAGES = [ stage.strip() for stage in getenv("PIPELINE_STAGES", "chord.py,dx7.py").split(",") if stage.strip() ]
+PIPELINE_CPUS = [ int(cpu) for cpu in getenv("PIPELINE_CPUS", "1,2,3").split(",") if cpu.strip() ]
+
+if len(PIPELINE_STAGES) < 2:
+	raise ValueError("PIPELINE_STAGES needs at least 2 scripts")
+
+scripts = [ path.join(SAMPLES_DIR, stage) for stage in PIPELINE_STAGES ]
+print("Pipeline: {}".format(" -> ".join(path.basename(script) for script in scripts)))
+
+sys.exit(run_pipeline(scripts, PIPELINE_CPUS, lambda: importlib.import_module("pimidipy")))
@@ -1,24 +1,367 @@
 #!/usr/bin/env python3
 
+# Merges the events received on the inputs of a Pimidi stack and forwards them to the outputs.
+#
+# By default, every input is forwarded to every output. The routing can be configured per input in
+# /etc/pimidipy.conf:
+#
+# THRU_ROUTE_i=o[:channels],...
+#
+# where 'i' is the input id, 'o' the output id and 'channels' an optional channel or range of channels
+# (0-15 for channels 1-16) to forward to the output, all channels are forwarded if omitted. For example:
+#
+# THRU_ROUTE_0=0,1:0-3,1:9  # Input 0 to output 0, channels 1-4 and 10 of input 0 also to output 1.
+# THRU_ROUTE_1=2            # Input 1 to output 2.
+#
+# Channel-less events, like clock and SysEx, are forwarded to every output the input is routed to.
+# Once any THRU_ROUTE_i is set, the inputs without one are not used. The routing gets compiled into a
+# lookup table at startup. All the inputs are served by the single pimidipy event loop.
+#
+# Every event is encoded into a MidiBytesEvent once and the same event is queued for each of the
+# outputs. A background thread drains the queues, pacing each output to the speed of a DIN MIDI
+# link, so a busy output does not hold back the input or the other outputs. Clock and active sensing
+# are sent ahead of the other events, which stay in the order they were received in. A newer value
+# of continuous data (modulation, volume, pan and expression CCs, aftertouch, channel pressure and
+# pitch bend) replaces an older one that is still waiting in the queue. Bank select, RPN / NRPN and
+# data entry, switches, channel mode messages and Program Change are never merged. When a queue is
+# full, new events are dropped, except for note offs, sustain pedal releases, channel mode messages,
+# transport and reset, which take the place of the oldest queued continuous value instead, or are
+# queued past the queue size when there is none.
+#
+# The following variables can be set in /etc/pimidipy.conf:
+#
+# THRU_OUTPUT_BYTES_PER_SEC=3125  # The pacing rate of each output, 31250 baud / 10 bits per byte.
+# THRU_QUEUE_SIZE=256             # Number of events each of the queues of an output can hold.
+# THRU_STATS_INTERVAL=0           # Print the queue depths and drop counts every n seconds, 0 to only print them on exit.
+
+from common.startup import first_event, mark, open_output
+from common.reload import hot_reload, keep
+hot_reload(__file__)
+
+import pimidipy as pimidipy_module
 from pimidipy import *
 pimidipy = PimidiPy()
 
+from collections import deque
+from functools import partial
+from os import getenv
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+
+from common.log import Log, DEBUG
+from common.metrics import Metrics
+from common.midi import build_encoders
+from common.realtime import RealTime
+
+mark('import')
+
+log = keep('log', Log)
+realtime = keep('realtime', lambda: RealTime(log))
+metrics = keep('metrics', lambda: Metrics('thru'))
+MSG_FORWARD = log.message('forward', 'Forwarding {data} from input {port}', DEBUG)
+
 MAX_PORT = 8
 
-input = pimidipy.open_input(0)
-print('Using input port {}'.format(input.name))
+THRU_OUTPUT_BYTES_PER_SEC = int(getenv('THRU_OUTPUT_BYTES_PER_SEC', 3125))
+THRU_QUEUE_SIZE = int(getenv('THRU_QUEUE_SIZE', 256))
+THRU_STATS_INTERVAL = float(getenv('THRU_STATS_INTERVAL', 0))
+
+# How far ahead of the wire an output may be written to, the rest stays in the queue where it can
+# still be prioritized and merged.
+MAX_LEAD = 0.01
+
+# Queue classes of the encoded events. Non negative values are keys of continuous data, for which
+# only the latest queued value is kept.
+PRIORITY_REALTIME = -1
+PRIORITY_ORDERED = -2
+# Queued in order, but never dropped.
+PRIORITY_KEEP = -3
+
+# Modulation, volume, pan and expression, the controllers only the latest value matters for.
+CONTINUOUS_CONTROLS = frozenset((1, 7, 10, 11))
+
+def control_change_kind(e):
+	if e.control in CONTINUOUS_CONTROLS:
+		return 0xb000 | e.channel << 7 | e.control
+	if e.control >= 120 or e.control == 64 and e.value < 64:
+		return PRIORITY_KEEP
+	return PRIORITY_ORDERED
+
+# Event type -> queue class of the event, or function returning it.
+KINDS = {
+	NoteOnEvent:              lambda e: PRIORITY_ORDERED if e.velocity else PRIORITY_KEEP,
+	NoteOffEvent:             PRIORITY_KEEP,
+	ControlChangeEvent:       control_change_kind,
+	AftertouchEvent:          lambda e: 0xa000 | e.channel << 7 | e.note,
+	ProgramChangeEvent:       PRIORITY_ORDERED,
+	ChannelPressureEvent:     lambda e: 0xd000 | e.channel,
+	PitchBendEvent:           lambda e: 0xe000 | e.channel,
+	Control14BitChangeEvent:  PRIORITY_ORDERED,
+	NRPNChangeEvent:          PRIORITY_ORDERED,
+	RPNChangeEvent:           PRIORITY_ORDERED,
+	SongPositionPointerEvent: PRIORITY_ORDERED,
+	SongSelectEvent:          PRIORITY_ORDERED,
+	TuneRequestEvent:         PRIORITY_ORDERED,
+	ClockEvent:               PRIORITY_REALTIME,
+	StartEvent:               PRIORITY_KEEP,
+	ContinueEvent:            PRIORITY_KEEP,
+	StopEvent:                PRIORITY_KEEP,
+	ActiveSensingEvent:       PRIORITY_REALTIME,
+	ResetEvent:               PRIORITY_KEEP,
+	SysExEvent:               PRIORITY_ORDERED,
+}
+
+# Event type -> the function returning the encoded bytes of the event and its queue class.
+ENCODERS = { event_type: (encoder, KINDS[event_type]) for event_type, encoder in build_encoders(pimidipy_module).items() if event_type in KINDS }
+
+# Returns the event to queue for the outputs and its queue class. Events that can't be encoded are
+# queued as they are.
+def encode_event(event):
+	encoder = ENCODERS.get(type(event))
+	if encoder is None:
+		return event, PRIORITY_ORDERED
+	encode, kind = encoder
+	if type(kind) is not int:
+		kind = kind(event)
+	return MidiBytesEvent(encode(event)), kind
+
+class OutputQueue:
+	def __init__(self, output, capacity):
+		self.output = output
+		self.capacity = capacity
+		self.realtime = deque()
+		# Holds the other encoded events in the order they were received in, and the keys of the
+		# queued continuous data, where their first value was received.
+		self.ordered = deque()
+		self.continuous = {}
+		self.next_free = 0.0
+		self.dropped = 0
+		self.replaced = 0
+		self.evicted = 0
+
+	def push(self, event, kind):
+		if kind == PRIORITY_REALTIME:
+			queue = self.realtime
+		elif kind == PRIORITY_ORDERED:
+			queue = self.ordered
+		elif kind == PRIORITY_KEEP:
+			if len(self.ordered) >= self.capacity:
+				self.evict()
+			self.ordered.append(event)
+			return
+		elif kind in self.continuous:
+			self.continuous[kind] = event
+			self.replaced += 1
+			return
+		else:
+			if len(self.ordered) >= self.capacity:
+				self.dropped += 1
+				return
+			self.continuous[kind] = event
+			self.ordered.append(kind)
+			return
+
+		if len(queue) >= self.capacity:
+			self.dropped += 1
+			return
+		queue.append(event)
+
+	# Makes room by dropping the oldest queued continuous value, if any.
+	def evict(self):
+		if not self.continuous:
+			return
+		for item in self.ordered:
+			if type(item) is int:
+				self.ordered.remove(item)
+				del self.continuous[item]
+				self.evicted += 1
+				return
+
+	def pop(self):
+		if self.realtime:
+			return self.realtime.popleft()
+		item = self.ordered.popleft()
+		if type(item) is int:
+			return self.continuous.pop(item)
+		return item
+
+	def __len__(self):
+		return len(self.realtime) + len(self.ordered)
+
+	def stats(self):
+		return '{}: queued {}+{}, dropped {}, replaced {}, evicted {}'.format(self.output.name, len(self.realtime), len(self.ordered), self.dropped, self.replaced, self.evicted)
+
+def parse_routes(input_id, value):
+	routes = []
+	for item in value.split(','):
+		if ':' in item:
+			output_id, channels = item.split(':')
+			first, _, last = channels.partition('-')
+			channels = range(int(first), int(last or first) + 1)
+		else:
+			output_id, channels = item, range(16)
+		output_id = int(output_id)
+		if output_id < 0 or output_id >= MAX_PORT:
+			raise ValueError(f"Invalid output id '{output_id}' in THRU_ROUTE_{input_id}")
+		if channels.start < 0 or channels.stop > 16 or not channels:
+			raise ValueError(f"Invalid channels '{item}' in THRU_ROUTE_{input_id}")
+		routes.append((input_id, output_id, channels))
+	return routes
+
+# Returns a list of (input_id, output_id, channels) tuples.
+def load_routes():
+	routes = []
+	for i in range(MAX_PORT):
+		value = getenv(f'THRU_ROUTE_{i}', None)
+		if value is not None:
+			routes.extend(parse_routes(i, value))
+	if not routes:
+		routes = [ (i, o, range(16)) for i in range(MAX_PORT) for o in range(MAX_PORT) ]
+	return routes
+
+class FanOut:
+	def __init__(self, outputs, routes, bytes_per_sec, capacity):
+		self.queues = [ OutputQueue(output, capacity) for output in outputs ]
+		self.set_routes(self.compile_routes(routes))
+		self.bytes_per_sec = bytes_per_sec
+		self.unrouted = 0
+		self._lock = Lock()
+		self._cond = Condition(self._lock)
+		self._idle = False
+		self._thread = Thread(target=self._run, name='thru-fan-out', daemon=True)
+		self._thread.start()
+
+	# Compiles the routes into tables of the output queues to push to:
+	#
+	# channel_routes[input_id << 4 | channel] - for channel events.
+	# system_routes[input_id]                 - for channel-less events, the union of the input's outputs.
+	def compile_routes(self, routes):
+		channel_routes = [ [] for i in range(MAX_PORT << 4) ]
+		system_routes = [ [] for i in range(MAX_PORT) ]
+		for input_id, output_id, channels in routes:
+			queue = self.queues[output_id]
+			for channel in channels:
+				if queue not in channel_routes[input_id << 4 | channel]:
+					channel_routes[input_id << 4 | channel].append(queue)
+			if queue not in system_routes[input_id]:
+				system_routes[input_id].append(queue)
+		return [ tuple(queues) for queues in channel_routes ], [ tuple(queues) for queues in system_routes ]
+
+	def set_routes(self, compiled):
+		self.channel_routes, self.system_routes = compiled
+
+	def write(self, input_id, event, kind):
+		status = event.data[0] if type(event) is MidiBytesEvent else 0xf0
+		if status < 0xf0:
+			queues = self.channel_routes[input_id << 4 | status & 0x0f]
+		else:
+			queues = self.system_routes[input_id]
+		if not queues:
+			self.unrouted += 1
+			return
+		with self._lock:
+			for queue in queues:
+				queue.push(event, kind)
+			if self._idle:
+				self._idle = False
+				self._cond.notify()
+
+	# Takes an event from each output that is not too far ahead of its wire yet.
+	def _collect(self, now, ready):
+		wait = None
+		for queue in self.queues:
+			if not queue:
+				continue
+			lead = queue.next_free - now
+			if lead > MAX_LEAD:
+				if wait is None or lead - MAX_LEAD < wait:
+					wait = lead - MAX_LEAD
+				continue
+			event = queue.pop()
+			size = len(event.data) if type(event) is MidiBytesEvent else 3
+			queue.next_free = max(queue.next_free, now) + size / self.bytes_per_sec
+			ready.append((queue.output, event))
+		return wait
+
+	def _run(self):
+		ready = []
+		while True:
+			with self._lock:
+				wait = self._collect(monotonic(), ready)
+				if not ready:
+					# Sleep until an output is ready again, or until new events arrive.
+					self._idle = True
+					self._cond.wait(wait)
+					self._idle = False
+					continue
+			for output, event in ready:
+				output.write(event, False)
+			pimidipy.drain_output()
+			ready.clear()
+
+	def stats(self):
+		with self._lock:
+			return [ queue.stats() for queue in self.queues ]
+
+routes = load_routes()
+
+mark('config')
 
 outputs = []
 for i in range(MAX_PORT):
 	port_out = pimidipy.get_output_port(i)
 	print('Using output port {}'.format(port_out))
-	outputs.append(pimidipy.open_output(port_out))
+	outputs.append(metrics.wrap_output(open_output(pimidipy, port_out)))
 
-def output_to_all(event):
-	print('Forwarding event {} to all outputs'.format(event))
-	for output in outputs:
-		output.write(event)
+# On hot reload, the queues and their writer thread are kept, the routes are compiled again and
+# put in place by on_reload(), along with the new callbacks.
+fan_out = keep('fan_out', lambda: FanOut(outputs, routes, THRU_OUTPUT_BYTES_PER_SEC, THRU_QUEUE_SIZE))
+compiled_routes = fan_out.compile_routes(routes)
 
-input.add_callback(output_to_all)
+def on_reload(previous):
+	fan_out.set_routes(compiled_routes)
+
+def print_stats():
+	for line in fan_out.stats():
+		print(line)
+	print('Unrouted events: {}'.format(fan_out.unrouted))
+
+def stats_loop():
+	while True:
+		sleep(THRU_STATS_INTERVAL)
+		print_stats()
+
+for queue in fan_out.queues:
+	metrics.gauge('queued {}'.format(queue.output.name), lambda queue=queue: len(queue))
+	metrics.gauge('dropped {}'.format(queue.output.name), lambda queue=queue: queue.dropped)
+metrics.gauge('unrouted', lambda: fan_out.unrouted)
+
+def start_stats_thread():
+	thread = Thread(target=stats_loop, name='thru-stats', daemon=True)
+	thread.start()
+	return thread
+
+if THRU_STATS_INTERVAL > 0:
+	stats_thread = keep('stats_thread', start_stats_thread)
+
+def output_to_all(event, input_id=0):
+	encoded, kind = encode_event(event)
+	fan_out.write(input_id, encoded, kind)
+	log.log(MSG_FORWARD, input_id, encoded.data if type(encoded) is MidiBytesEvent else b'')
+
+# pimidipy delivers the events of all the opened inputs from its single event loop, the input id
+# is bound to each input's callback so the event can be looked up in the routing tables.
+inputs = []
+for input_id in sorted(set(route[0] for route in routes)):
+	input = pimidipy.open_input(input_id)
+	print('Using input port {}'.format(input.name))
+	input.add_callback(first_event(realtime.wrap(metrics.wrap(partial(output_to_all, input_id=input_id), input.name))))
+	inputs.append(input)
+
+mark('ports')
+
+realtime.start()
 
 pimidipy.run()
+
+print_stats()
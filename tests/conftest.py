@@ -0,0 +1,55 @@
+import os
+import sys
+from time import monotonic, sleep
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SAMPLES_DIR = os.path.join(ROOT, "samples")
+
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+sys.path.insert(0, SAMPLES_DIR)
+
+# Read by the common modules when they are first imported: no sockets, no cache files, and the
+# outputs are open once the script is loaded.
+os.environ.update({
+	"PIMIDIPY_CACHE_DIR": "",
+	"PIMIDIPY_METRICS": "0",
+	"PIMIDIPY_OPEN_OUTPUTS": "startup",
+	"PIMIDIPY_LOG_LEVEL": "error",
+})
+
+from fake_pimidipy import Event, load_script
+
+def quiet_print(*args, **kwargs):
+	pass
+
+# Loads a sample with the stand-in pimidipy, returns its globals and the PimidiPy instance.
+@pytest.fixture
+def load_sample(monkeypatch):
+	def load(name, env={}):
+		for key, value in env.items():
+			monkeypatch.setenv(key, value)
+		return load_script(os.path.join(SAMPLES_DIR, name + ".py"), None, { "print": quiet_print })
+	return load
+
+# Waits for a background thread to get something done.
+def wait_until(condition, timeout=2):
+	deadline = monotonic() + timeout
+	while not condition():
+		if monotonic() > deadline:
+			raise AssertionError("Timed out")
+		sleep(0.001)
+
+# Replaces the write method of a stand-in output port, returns the list the written events get
+# recorded to, as tuples of their type name and fields since the scripts reuse their events.
+def record_writes(port):
+	written = []
+	def write(event, drain=True):
+		if not isinstance(event, Event):
+			raise TypeError("Not a pimidipy event: {!r}".format(event))
+		written.append((type(event).__name__,) + tuple(getattr(event, name) for name in event.__slots__))
+		return 0
+	port.write = write
+	return written
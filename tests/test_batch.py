@@ -0,0 +1,41 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from batch import ChordTransform, DX7Transform, load
+from smf import MidiFile, from_messages
+
+def messages(track):
+	return [ (tick, bytes(raw[:length])) for tick, raw, length in zip(track.ticks.tolist(), track.raw, track.length.tolist()) ]
+
+# The chords of both tracks share the voice table, like chord.py's live: E is already sounding when
+# the second chord starts, and the pedal on the second track holds the first track's chord too.
+def test_chord_transform_uses_voice_table():
+	midi_file = MidiFile(1, 480, [
+		from_messages([ 0, 20 ], [ bytes([ 0x90, 60, 100 ]), bytes([ 0x80, 60, 0 ]) ]),
+		from_messages([ 0, 10, 15, 30 ], [ bytes([ 0xb0, 64, 127 ]), bytes([ 0x90, 64, 90 ]), bytes([ 0x90, 64, 0 ]), bytes([ 0xb0, 64, 0 ]) ]),
+		])
+	result = ChordTransform(load("chord")).apply(midi_file)
+	assert messages(result.tracks[0]) == [ (0, bytes([ 0x90, 60, 100 ])), (0, bytes([ 0x90, 64, 100 ])), (0, bytes([ 0x90, 67, 100 ])) ]
+	assert messages(result.tracks[1]) == [
+		(0, bytes([ 0xb0, 64, 127 ])),
+		(10, bytes([ 0x90, 68, 90 ])), (10, bytes([ 0x90, 71, 90 ])),
+		(30, bytes([ 0xb0, 64, 0 ])),
+		] + [ (30, bytes([ 0x80, tone, 0 ])) for tone in [ 60, 64, 67, 68, 71 ] ]
+
+# Mapped CCs become parameter changes, the ones repeating the value last sent are dropped. Unmapped
+# CCs are dropped as well, like dx7.py does, the other events stay where they were.
+def test_dx7_transform_replaces_ccs(monkeypatch):
+	monkeypatch.setenv("DX7_PARAM_0", "20")
+	dx7 = load("dx7")
+	values = [ dx7["CC_VALUE_TABLES"][0][value] for value in [ 0, 127 ] ]
+	midi_file = MidiFile(1, 480, [
+		from_messages([ 0, 5 ], [ bytes([ 0x90, 60, 100 ]), bytes([ 0x80, 60, 0 ]) ]),
+		from_messages([ 1, 2, 3, 4 ], [ bytes([ 0xb0, 20, 0 ]), bytes([ 0xb0, 20, 0 ]), bytes([ 0xb0, 21, 9 ]), bytes([ 0xb0, 20, 127 ]) ]),
+		])
+	result = DX7Transform(dx7).apply(midi_file)
+	assert messages(result.tracks[0]) == messages(midi_file.tracks[0])
+	assert messages(result.tracks[1]) == [
+		(1, bytes([ 0xf0, 0x06, 0x43, 0x10, 0x00, 0x00, values[0], 0xf7 ])),
+		(4, bytes([ 0xf0, 0x06, 0x43, 0x10, 0x00, 0x00, values[1], 0xf7 ])),
+		]
@@ -0,0 +1,79 @@
+from conftest import record_writes
+from fake_pimidipy import ControlChangeEvent, NoteOffEvent, NoteOnEvent
+
+def load_chord(load_sample, env={}):
+	chord, pimidipy = load_sample("chord", env)
+	callback = pimidipy.inputs[pimidipy.get_input_port(0)].callbacks[0]
+	written = record_writes(pimidipy.outputs[pimidipy.get_output_port(0)])
+	return callback, written
+
+def test_chord_note_events(load_sample):
+	callback, written = load_chord(load_sample)
+	callback(NoteOnEvent(2, 60, 100))
+	callback(NoteOffEvent(2, 60, 10))
+	assert written == [
+		("NoteOnEvent", 2, 60, 100), ("NoteOnEvent", 2, 64, 100), ("NoteOnEvent", 2, 67, 100),
+		("NoteOffEvent", 2, 60, 10), ("NoteOffEvent", 2, 64, 10), ("NoteOffEvent", 2, 67, 10),
+	]
+
+def test_out_of_range_notes_discarded(load_sample):
+	callback, written = load_chord(load_sample)
+	callback(NoteOnEvent(0, 124, 100))
+	assert written == [ ("NoteOnEvent", 0, 124, 100) ]
+
+# The C and E major chords share E, which only ends with the last chord holding it.
+def test_overlapping_chords_share_tones(load_sample):
+	callback, written = load_chord(load_sample)
+	callback(NoteOnEvent(0, 60, 100))
+	callback(NoteOnEvent(0, 64, 90))
+	callback(NoteOffEvent(0, 60, 0))
+	callback(NoteOffEvent(0, 64, 0))
+	assert written == [
+		("NoteOnEvent", 0, 60, 100), ("NoteOnEvent", 0, 64, 100), ("NoteOnEvent", 0, 67, 100),
+		("NoteOnEvent", 0, 68, 90), ("NoteOnEvent", 0, 71, 90),
+		("NoteOffEvent", 0, 60, 0), ("NoteOffEvent", 0, 67, 0),
+		("NoteOffEvent", 0, 64, 0), ("NoteOffEvent", 0, 68, 0), ("NoteOffEvent", 0, 71, 0),
+	]
+
+def test_sustain_holds_released_tones(load_sample):
+	callback, written = load_chord(load_sample, { "CHORD_SEMITONES": "0,12" })
+	callback(ControlChangeEvent(0, 64, 127))
+	callback(NoteOnEvent(0, 60, 100))
+	callback(NoteOffEvent(0, 60, 0))
+	# Striking a sustained tone again ends it and starts it over.
+	callback(NoteOnEvent(0, 60, 80))
+	callback(ControlChangeEvent(0, 64, 0))
+	# Held by the chord, the tones don't end with the pedal.
+	callback(NoteOffEvent(0, 60, 0))
+	assert written == [
+		("ControlChangeEvent", 0, 64, 127),
+		("NoteOnEvent", 0, 60, 100), ("NoteOnEvent", 0, 72, 100),
+		("NoteOffEvent", 0, 60, 0), ("NoteOffEvent", 0, 72, 0),
+		("NoteOnEvent", 0, 60, 80), ("NoteOnEvent", 0, 72, 80),
+		("ControlChangeEvent", 0, 64, 0),
+		("NoteOffEvent", 0, 60, 0), ("NoteOffEvent", 0, 72, 0),
+	]
+
+# Sent as note ons with velocity 0, the note offs repeat the status of the note ons before them.
+def test_note_offs_as_note_ons(load_sample):
+	chord, pimidipy = load_sample("chord", { "CHORD_NOTE_OFF_VELOCITY_0": "1" })
+	callback = pimidipy.inputs[pimidipy.get_input_port(0)].callbacks[0]
+	written = record_writes(pimidipy.outputs[pimidipy.get_output_port(0)])
+	callback(NoteOnEvent(2, 60, 100))
+	callback(NoteOffEvent(2, 60, 10))
+	assert written == [
+		("NoteOnEvent", 2, 60, 100), ("NoteOnEvent", 2, 64, 100), ("NoteOnEvent", 2, 67, 100),
+		("NoteOnEvent", 2, 60, 0), ("NoteOnEvent", 2, 64, 0), ("NoteOnEvent", 2, 67, 0),
+	]
+	assert (chord["stats"].bursts, chord["stats"].messages, chord["stats"].repeated_status) == (2, 6, 5)
+
+def test_repeated_status_counted(load_sample):
+	chord, pimidipy = load_sample("chord")
+	callback = pimidipy.inputs[pimidipy.get_input_port(0)].callbacks[0]
+	callback(NoteOnEvent(2, 60, 100))
+	callback(NoteOffEvent(2, 60, 10))
+	# A passed through event in between sends its own status.
+	callback(ControlChangeEvent(2, 1, 64))
+	callback(NoteOnEvent(2, 62, 100))
+	assert (chord["stats"].bursts, chord["stats"].messages, chord["stats"].repeated_status) == (3, 9, 6)
+	assert chord["stats"].report().startswith("3 chords, 9 note messages, 6 with the status")
@@ -0,0 +1,180 @@
+from time import monotonic
+
+from conftest import record_writes, wait_until
+from fake_pimidipy import ControlChangeEvent, ProgramChangeEvent
+
+FAST = { "DX7_OUTPUT_BYTES_PER_SEC": "1000000000" }
+
+def feed(pimidipy, events):
+	callback = pimidipy.inputs[pimidipy.get_input_port(0)].callbacks[0]
+	for event in events:
+		callback(event)
+
+def map_parameters(count):
+	return { "DX7_PARAM_{}".format(i): "0:{}".format(20 + i) for i in range(count) }
+
+def test_voice_dump_checksum(load_sample):
+	dx7, pimidipy = load_sample("dx7")
+	voice = bytes(dx7["INIT_VOICE"])
+	data = dx7["build_voice_dump_event"](2, voice).data
+	assert len(data) == dx7["VOICE_DUMP_SIZE"]
+	assert data[:6] == bytes([ 0xf0, 0x43, 0x02, 0x00, 0x01, 0x1b ])
+	assert data[6:-2] == voice[:dx7["VCED_SIZE"]]
+	assert (sum(data[6:-2]) + data[-2]) & 0x7f == 0
+	assert data[-1] == 0xf7
+
+def test_voice_file_round_trip(load_sample):
+	dx7, pimidipy = load_sample("dx7")
+	voice = bytearray(dx7["INIT_VOICE"])
+	voice[0] = 12
+	voice[155] = 21
+	data = dx7["build_voice_dump_event"](0, voice).data + dx7["build_parameter_change_event"](0, 155, voice[155]).data
+	assert dx7["parse_voice_file"](data) == voice
+	corrupted = bytearray(data)
+	corrupted[10] ^= 1
+	try:
+		dx7["parse_voice_file"](corrupted)
+	except ValueError:
+		pass
+	else:
+		raise AssertionError("Checksum mismatch not detected")
+
+# Holds the scheduler back for a moment, so the changes fed meanwhile are all queued together.
+def hold(scheduler):
+	scheduler._next_free = monotonic() + 0.1
+
+# A newer value for a queued change replaces the older one, a value already sent is not sent again.
+def test_changes_merged_and_dropped(load_sample):
+	dx7, pimidipy = load_sample("dx7", dict(FAST, **map_parameters(1)))
+	scheduler = dx7["devices"][0].scheduler
+	hold(scheduler)
+	feed(pimidipy, [ ControlChangeEvent(0, 20, value) for value in [ 10, 60, 127 ] ])
+	wait_until(lambda: not scheduler.has_pending())
+	assert (scheduler.sent, scheduler.merged, scheduler.dropped) == (1, 2, 0)
+	feed(pimidipy, [ ControlChangeEvent(0, 20, 127) ])
+	assert (scheduler.sent, scheduler.dropped) == (1, 1)
+
+# The DX7's voice is unknown, a dump would reset every parameter that wasn't set.
+def test_no_voice_dump_of_unknown_parameters(load_sample):
+	dx7, pimidipy = load_sample("dx7", dict(FAST, **map_parameters(30)))
+	scheduler = dx7["devices"][0].scheduler
+	hold(scheduler)
+	feed(pimidipy, [ ControlChangeEvent(0, 20 + i, 100) for i in range(30) ])
+	wait_until(lambda: not scheduler.has_pending())
+	assert scheduler.bulk_dumps == 0
+	assert scheduler.sent == 30
+
+def test_voice_dump_once_voice_is_known(load_sample):
+	dx7, pimidipy = load_sample("dx7", dict(FAST, **map_parameters(30)))
+	device = dx7["devices"][0]
+	scheduler = device.scheduler
+	scheduler.load_voice(device.device_id, dx7["INIT_VOICE"])
+	wait_until(lambda: not scheduler.has_pending())
+	assert scheduler.bulk_dumps == 1
+	hold(scheduler)
+	feed(pimidipy, [ ControlChangeEvent(0, 20 + i, 100) for i in range(30) ])
+	wait_until(lambda: not scheduler.has_pending())
+	assert scheduler.bulk_dumps == 2
+	assert scheduler.get_voice(device.device_id)[:30] == bytes(dx7["CC_VALUE_TABLES"][i][100] for i in range(30))
+
+def test_writes_sysex_events(load_sample):
+	dx7, pimidipy = load_sample("dx7", dict(FAST, **map_parameters(1)))
+	device = dx7["devices"][0]
+	scheduler = device.scheduler
+	written = record_writes(scheduler.output)
+	for value in [ 100, 0, 100 ]:
+		feed(pimidipy, [ ControlChangeEvent(0, 20, value) ])
+		wait_until(lambda: not scheduler.has_pending())
+	scheduler.load_voice(device.device_id, dx7["INIT_VOICE"])
+	# The dump is followed by OPERATOR ON/OFF, which it doesn't carry.
+	wait_until(lambda: len(written) == 5)
+	assert [ name for name, data in written ] == [ "SysExEvent" ] * 5
+	change = dx7["build_parameter_change_event"]
+	assert [ data for name, data in written[:3] ] == [ change(device.device_id, 0, dx7["CC_VALUE_TABLES"][0][value]).data for value in [ 100, 0, 100 ] ]
+	assert written[3][1] == dx7["build_voice_dump_event"](device.device_id, dx7["INIT_VOICE"]).data
+	assert written[4][1] == change(device.device_id, dx7["VCED_SIZE"], dx7["ALL_OPERATORS_ON"]).data
+
+def test_snapshot_round_trip(load_sample, tmp_path):
+	env = dict(FAST, DX7_SNAPSHOT_DIR=str(tmp_path / "snapshots"), DX7_SNAPSHOT_SAVE_CC="0:100", DX7_SNAPSHOT_RECALL_CC="0:101", **map_parameters(1))
+	dx7, pimidipy = load_sample("dx7", env)
+	device = dx7["devices"][0]
+	scheduler = device.scheduler
+	feed(pimidipy, [ ControlChangeEvent(0, 20, 100), ControlChangeEvent(0, 100, 5) ])
+	wait_until(lambda: (tmp_path / "snapshots" / "005.syx").exists() and not dx7["snapshot_worker"]._jobs)
+	voice = scheduler.get_voice(device.device_id)
+	feed(pimidipy, [ ControlChangeEvent(0, 20, 0), ControlChangeEvent(0, 101, 5) ])
+	wait_until(lambda: scheduler.bulk_dumps == 1)
+	assert scheduler.get_voice(device.device_id) == voice
+
+def test_named_snapshot(load_sample, tmp_path):
+	env = dict(FAST, DX7_SNAPSHOT_DIR=str(tmp_path), DX7_SNAPSHOT_SAVE_CC="0:100", DX7_SNAPSHOT_NAMES="3:Brass,4:E.Piano", **map_parameters(1))
+	dx7, pimidipy = load_sample("dx7", env)
+	assert dx7["SNAPSHOT_NAMES"][2:5] == [ "002", "Brass", "E.Piano" ]
+	feed(pimidipy, [ ControlChangeEvent(0, 20, 100), ControlChangeEvent(0, 100, 3) ])
+	wait_until(lambda: (tmp_path / "Brass.syx").exists())
+
+def test_invalid_snapshot_names(load_sample):
+	parse = load_sample("dx7")[0]["parse_snapshot_names"]
+	for value in [ "128:Brass", "1:", "1:../Brass", "1:Brass,2:Brass", "1:002" ]:
+		try:
+			parse(value)
+		except ValueError:
+			pass
+		else:
+			raise AssertionError("'{}' accepted".format(value))
+
+def test_invalid_device_id(load_sample):
+	voice_state = load_sample("dx7")[0]["VoiceState"]
+	try:
+		voice_state(16)
+	except ValueError as e:
+		assert "device ID '16'" in str(e)
+	else:
+		raise AssertionError("Device ID 16 accepted")
+
+# A missing snapshot is logged, and leaves the voice as it is.
+def test_missing_snapshot(load_sample, tmp_path):
+	dx7, pimidipy = load_sample("dx7", dict(FAST, DX7_SNAPSHOT_DIR=str(tmp_path), DX7_SNAPSHOT_RECALL_CC="0:101"))
+	device = dx7["devices"][0]
+	voice = device.scheduler.get_voice(device.device_id)
+	feed(pimidipy, [ ControlChangeEvent(0, 101, 7) ])
+	wait_until(lambda: not dx7["snapshot_worker"]._jobs)
+	assert device.scheduler.get_voice(device.device_id) == voice
+
+# The outputs are paced on their own but sent to by the same thread, taking turns.
+def test_outputs_take_turns(load_sample):
+	env = dict(FAST, DX7_DEVICES="2", **{ "DX7_{}PARAM_{}".format(prefix, i): str(20 + i) for prefix in [ "", "1_" ] for i in range(3) })
+	dx7, pimidipy = load_sample("dx7", env)
+	first, second = [ device.scheduler for device in dx7["devices"] ]
+	assert first is not second and first._lock is second._lock
+	written = []
+	for scheduler in [ first, second ]:
+		scheduler.output.write = lambda event, drain=True, name=scheduler.output.name: written.append(name)
+	start = monotonic() + 0.1
+	first._next_free = second._next_free = start
+	feed(pimidipy, [ ControlChangeEvent(channel, 20 + i, 100) for channel in [ 0, 1 ] for i in range(3) ])
+	wait_until(lambda: len(written) == 6)
+	assert written == [ first.output.name, second.output.name ] * 3
+
+def test_program_change_recalls_library_voice(load_sample, tmp_path):
+	(tmp_path / "cartridges").mkdir()
+	(tmp_path / "cartridges" / "names.syx").write_bytes(b"".join(bytes(118) + "VOICE {:02}".format(i).ljust(10).encode() for i in range(32)))
+	env = dict(FAST, DX7_LIBRARY_DIR=str(tmp_path / "cartridges"), DX7_LIBRARY_INDEX_DIR=str(tmp_path / "index"))
+	dx7, pimidipy = load_sample("dx7", env)
+	device = dx7["devices"][0]
+	written = record_writes(device.scheduler.output)
+	feed(pimidipy, [ ProgramChangeEvent(0, 1) ])
+	wait_until(lambda: written)
+	dump = written[0][1]
+	assert dump == bytes(dx7["library"].dump(dx7["library"].voice_id(0, 1)))
+	assert dump[2] == device.device_id
+	assert dump[6 + 145:6 + 155] == b"VOICE 01  "
+
+def test_pending_changes_counted(load_sample):
+	dx7, pimidipy = load_sample("dx7", dict(FAST, **map_parameters(3)))
+	scheduler = dx7["devices"][0].scheduler
+	hold(scheduler)
+	feed(pimidipy, [ ControlChangeEvent(0, 20 + i, 100) for i in range(3) ])
+	assert (scheduler.has_pending(), scheduler.pending_count()) == (True, 3)
+	wait_until(lambda: not scheduler.has_pending())
+	assert scheduler.pending_count() == 0
@@ -0,0 +1,91 @@
+from common.dx7_library import Library, VOICE_DUMP_SIZE
+
+LIMITS = bytes([ 127 ] * 155)
+
+# A packed operator with every bit field set to a value of its own, and its VCED parameters.
+PACKED_OPERATOR = bytes([ 10, 20, 30, 40, 99, 98, 97, 0, 39, 50, 60, 3 << 2 | 1, 7 << 3 | 5, 6 << 2 | 2, 90, 17 << 1 | 1, 42 ])
+VCED_OPERATOR = bytes([ 10, 20, 30, 40, 99, 98, 97, 0, 39, 50, 60, 1, 3, 5, 2, 6, 90, 1, 17, 42, 7 ])
+
+# Pitch EG, algorithm, feedback and key sync, LFO, LFO sync, wave and pitch modulation sensitivity,
+# transpose.
+PACKED_GLOBALS = bytes([ 50, 51, 52, 53, 54, 55, 56, 57, 31, 1 << 3 | 7, 35, 1, 2, 3, 3 << 4 | 4 << 1 | 1, 24 ])
+VCED_GLOBALS = bytes([ 50, 51, 52, 53, 54, 55, 56, 57, 31, 7, 1, 35, 1, 2, 3, 1, 4, 3, 24 ])
+
+def packed_voice(name):
+	return PACKED_OPERATOR + bytes(5 * 17) + PACKED_GLOBALS + name.ljust(10).encode()
+
+# Voice 31 is the same as voice 30.
+def cartridge(prefix):
+	return b"".join(packed_voice("{} {:02}".format(prefix, min(i, 30))) for i in range(32))
+
+def open_library(tmp_path):
+	library = Library(str(tmp_path / "cartridges"), str(tmp_path / "index"), LIMITS)
+	library.open()
+	return library
+
+def add_cartridge(tmp_path, name, data):
+	(tmp_path / "cartridges").mkdir(exist_ok=True)
+	(tmp_path / "cartridges" / name).write_bytes(data)
+
+def test_cartridge_voices(tmp_path):
+	add_cartridge(tmp_path, "a.syx", cartridge("A"))
+	library = open_library(tmp_path)
+	assert (library.indexed, library.skipped, library.names) == (1, 0, [ "a.syx" ])
+	dump = bytes(library.dump(library.voice_id(0, 5)))
+	assert len(dump) == VOICE_DUMP_SIZE
+	assert dump[:6] == bytes([ 0xf0, 0x43, 0x00, 0x00, 0x01, 0x1b ])
+	assert dump[6:-2] == VCED_OPERATOR + bytes(5 * 21) + VCED_GLOBALS + b"A 05      "
+	assert (sum(dump[6:-2]) + dump[-2]) & 0x7f == 0
+	assert dump[-1] == 0xf7
+	assert library.name(library.voice_id(0, 37)) == "A 05"
+
+def test_voices_clamped_to_limits(tmp_path):
+	add_cartridge(tmp_path, "a.syx", cartridge("A"))
+	library = Library(str(tmp_path / "cartridges"), str(tmp_path / "index"), bytes([ 99 ] * 16 + [ 127 ] * 139))
+	library.open()
+	assert bytes(library.dump(0))[6:6 + 17] == bytes([ 10, 20, 30, 40, 99, 98, 97, 0, 39, 50, 60, 1, 3, 5, 2, 6, 90 ])
+
+def test_duplicate_voices_stored_once(tmp_path):
+	add_cartridge(tmp_path, "a.syx", cartridge("A"))
+	# The same voices as a bulk dump.
+	add_cartridge(tmp_path, "b.syx", bytes([ 0xf0, 0x43, 0x00, 0x09, 0x20, 0x00 ]) + cartridge("A") + bytes([ 0x00, 0xf7 ]))
+	add_cartridge(tmp_path, "notes.syx", bytes([ 0xf0, 0x7e, 0xf7 ]))
+	library = open_library(tmp_path)
+	assert (library.indexed, library.skipped) == (2, 1)
+	assert library.cartridges[0] == library.cartridges[1]
+	assert library.cartridges[0][30] == library.cartridges[0][31]
+	assert (library.voice_count(), library.duplicate_count()) == (31, 33)
+	assert (tmp_path / "index" / "voices.syx").stat().st_size == 31 * VOICE_DUMP_SIZE
+
+def test_added_cartridge_indexed(tmp_path):
+	add_cartridge(tmp_path, "b.syx", cartridge("B"))
+	open_library(tmp_path)
+	add_cartridge(tmp_path, "a.syx", cartridge("A"))
+	library = open_library(tmp_path)
+	# Only the new cartridge is parsed, and it's selected in name order.
+	assert (library.indexed, library.names, library.voice_count()) == (1, [ "a.syx", "b.syx" ], 62)
+	assert library.name(library.voice_id(0, 1)) == "A 01"
+	assert library.name(library.voice_id(1, 1)) == "B 01"
+	assert open_library(tmp_path).indexed == 0
+
+def test_truncated_index_rebuilt(tmp_path):
+	add_cartridge(tmp_path, "a.syx", cartridge("A"))
+	open_library(tmp_path)
+	index_file = tmp_path / "index" / "index.json"
+	index = index_file.read_bytes()
+	index_file.write_bytes(index[:len(index) // 2])
+	library = open_library(tmp_path)
+	assert (library.indexed, library.voice_count()) == (1, 31)
+	assert library.name(library.voice_id(0, 7)) == "A 07"
+	assert index_file.read_bytes() == index
+
+def test_truncated_voices_rebuilt(tmp_path):
+	add_cartridge(tmp_path, "a.syx", cartridge("A"))
+	open_library(tmp_path)
+	voices_file = tmp_path / "index" / "voices.syx"
+	voices = voices_file.read_bytes()
+	voices_file.write_bytes(voices[:10 * VOICE_DUMP_SIZE + 20])
+	library = open_library(tmp_path)
+	assert (library.indexed, library.voice_count()) == (1, 31)
+	assert voices_file.read_bytes() == voices
+	assert library.name(library.voice_id(0, 20)) == "A 20"
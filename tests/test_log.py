@@ -0,0 +1,25 @@
+import io
+
+from conftest import wait_until
+from common.log import Log, INFO
+
+def test_failing_format_keeps_writer_alive():
+	stream = io.StringIO()
+	log = Log(size=16, level=INFO, stream=stream, interval=0.001)
+	broken = log.message("broken", lambda record: 1 / record.a, INFO)
+	fine = log.message("fine", "port {port}, {data}, {a} {b}", INFO)
+	log.log(broken, 0, b"", 0)
+	wait_until(lambda: "Failed to format log message" in stream.getvalue())
+	log.log(fine, 2, b"\x90\x3c\x64", 1, 2)
+	wait_until(lambda: "port 2, 90 3c 64, 1 2" in stream.getvalue())
+	assert log._thread.is_alive()
+
+def test_full_ring_drops_records():
+	stream = io.StringIO()
+	log = Log(size=4, level=INFO, stream=stream, interval=60)
+	message = log.message("count", "{a}", INFO)
+	for a in range(6):
+		log.log(message, a=a)
+	assert log.dropped == 2
+	log.flush()
+	assert stream.getvalue().endswith("3\n2 log records dropped, 2 in total\n")
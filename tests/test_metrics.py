@@ -0,0 +1,29 @@
+import os
+import sys
+
+from conftest import wait_until
+from fake_pimidipy import build_module
+
+sys.modules.setdefault("pimidipy", build_module())
+from common import metrics
+from top import read_metrics
+
+# Two instances of a script each get a socket of their own.
+def test_socket_per_process(monkeypatch, tmp_path):
+	monkeypatch.setattr(metrics, "PIMIDIPY_METRICS", True)
+	monkeypatch.setattr(metrics, "PIMIDIPY_METRICS_DIR", str(tmp_path))
+	served = metrics.Metrics("chord")
+	socket_file = tmp_path / "pimidipy-chord-{}.sock".format(os.getpid())
+	assert metrics.socket_path("chord") == str(socket_file)
+	snapshots = []
+	def connected():
+		try:
+			snapshots.append(read_metrics(str(socket_file)))
+		except OSError:
+			return False
+		return True
+	wait_until(connected)
+	snapshot = snapshots[0]
+	assert snapshot["script"] == "chord"
+	assert snapshot["pid"] == os.getpid()
+	served._close(str(socket_file))
@@ -0,0 +1,53 @@
+from fake_pimidipy import build_module
+from common.midi import Decoder, build_encoders, build_module as build_host_module, decode_midi_bytes
+
+module = build_module()
+
+def decode(*writes):
+	decoder = Decoder(module)
+	events = []
+	for data in writes:
+		decoder.decode(bytes(data), events.append)
+	return [ (type(event).__name__,) + tuple(getattr(event, name) for name in event.__slots__) for event in events ]
+
+def test_running_status_across_writes():
+	assert decode([ 0x90, 60, 100, 64, 100 ], [ 67, 0 ], [ 0xc1, 5, 6 ]) == [
+		("NoteOnEvent", 0, 60, 100), ("NoteOnEvent", 0, 64, 100), ("NoteOnEvent", 0, 67, 0),
+		("ProgramChangeEvent", 1, 5), ("ProgramChangeEvent", 1, 6),
+	]
+
+# Real-time bytes may come in the middle of a message or a SysEx, without ending it.
+def test_real_time_bytes_interleaved():
+	assert decode([ 0xb2, 7, 0xf8, 90 ], [ 0xf0, 0x43, 0xfe, 0x10 ], [ 0xf7 ]) == [
+		("ClockEvent",), ("ControlChangeEvent", 2, 7, 90), ("ActiveSensingEvent",), ("SysExEvent", bytes([ 0xf0, 0x43, 0x10, 0xf7 ])),
+	]
+
+# A SysEx or a system common message cancels the running status.
+def test_running_status_cancelled():
+	assert decode([ 0x90, 60, 100 ], [ 0xf0, 0x7e, 0xf7 ], [ 61, 100 ], [ 0xf2, 0x10, 0x01, 0x20 ]) == [
+		("NoteOnEvent", 0, 60, 100), ("SysExEvent", bytes([ 0xf0, 0x7e, 0xf7 ])), ("SongPositionPointerEvent", 0x90),
+	]
+
+def test_encoders_round_trip():
+	encoders = build_encoders(module)
+	events = [
+		module.NoteOnEvent(3, 60, 100), module.NoteOffEvent(3, 60, 0), module.ControlChangeEvent(0, 1, 2),
+		module.PitchBendEvent(15, -8192), module.PitchBendEvent(15, 8191), module.ChannelPressureEvent(4, 9),
+		module.SongPositionPointerEvent(1000), module.SongSelectEvent(3), module.StartEvent(),
+		module.SysExEvent(bytes([ 0xf0, 0x43, 0x10, 0x01, 0x1b, 0x3f, 0xf7 ])),
+	]
+	decoded = decode(*[ encoders[type(event)](event) for event in events ])
+	assert decoded == [ (type(event).__name__,) + tuple(getattr(event, name) for name in event.__slots__) for event in events ]
+
+def test_decode_recording():
+	events = decode_midi_bytes(module, bytes([ 0xfa, 0x99, 36, 100, 36, 0, 0xf8, 0xfc ]))
+	assert [ (type(event).__name__,) + tuple(getattr(event, name) for name in event.__slots__) for event in events ] == [
+		("StartEvent",), ("NoteOnEvent", 9, 36, 100), ("NoteOnEvent", 9, 36, 0), ("ClockEvent",), ("StopEvent",),
+	]
+
+def test_host_module_replaces_pimidipy():
+	instance = object()
+	copy = build_host_module(module, lambda: instance)
+	assert copy.PimidiPy() is instance
+	assert copy.NoteOnEvent is module.NoteOnEvent
+	assert module.PimidiPy is not copy.PimidiPy
@@ -0,0 +1,38 @@
+import gc
+
+from common import realtime
+from common.log import Log, ERROR
+
+def test_applied_on_start(monkeypatch):
+	monkeypatch.setattr(realtime, "PIMIDIPY_REALTIME", True)
+	monkeypatch.setattr(realtime, "PIMIDIPY_RT_PRIORITY", 0)
+	monkeypatch.setattr(realtime, "PIMIDIPY_RT_MLOCK", False)
+	rt = realtime.RealTime(Log(level=ERROR))
+	events = []
+	callback = rt.wrap(events.append)
+	try:
+		rt.start()
+		assert rt.applied
+		assert gc.get_freeze_count() > 0
+		callback(1)
+		assert events == [ 1 ]
+		assert rt.before.count == 0 and rt.total.count == 1
+	finally:
+		gc.unfreeze()
+
+def test_compare_applies_after_events(monkeypatch):
+	monkeypatch.setattr(realtime, "PIMIDIPY_REALTIME", True)
+	monkeypatch.setattr(realtime, "PIMIDIPY_RT_PRIORITY", 0)
+	monkeypatch.setattr(realtime, "PIMIDIPY_RT_MLOCK", False)
+	monkeypatch.setattr(realtime, "PIMIDIPY_RT_COMPARE_EVENTS", 3)
+	rt = realtime.RealTime(Log(level=ERROR))
+	callback = rt.wrap(lambda event: None)
+	try:
+		rt.start()
+		assert not rt.applied
+		for i in range(6):
+			callback(i)
+		assert rt.applied
+		assert rt.before.count == 3 and rt.after.count == 3
+	finally:
+		gc.unfreeze()
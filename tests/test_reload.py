@@ -0,0 +1,47 @@
+import os
+import sys
+
+from conftest import SAMPLES_DIR
+from fake_pimidipy import build_module
+
+# common.reload wraps whichever pimidipy it imports first.
+sys.modules["pimidipy"] = build_module()
+from common import reload
+
+def start_host(monkeypatch, name):
+	host = reload.Host(os.path.join(SAMPLES_DIR, name + ".py"))
+	monkeypatch.setattr(reload, "host", host)
+	monkeypatch.setattr(reload, "PIMIDIPY_HOT_RELOAD_INTERVAL", 3600)
+	monkeypatch.setattr("builtins.print", lambda *args, **kwargs: None)
+	host.execute()
+	return host
+
+def execute_again(host):
+	try:
+		host.execute()
+	except reload.ReloadDone:
+		pass
+
+def test_reload_keeps_log_messages(monkeypatch):
+	host = start_host(monkeypatch, "chord")
+	log = host.namespace["log"]
+	count = len(log._formats)
+	for i in range(3):
+		execute_again(host)
+		host.swap(host.loading)
+	assert host.namespace["log"] is log
+	assert len(log._formats) == count
+
+# The new routes only take effect with the new callbacks.
+def test_reload_stages_thru_routes(monkeypatch):
+	monkeypatch.setenv("THRU_ROUTE_0", "1")
+	monkeypatch.setenv("THRU_STATS_INTERVAL", "0")
+	host = start_host(monkeypatch, "thru")
+	fan_out = host.namespace["fan_out"]
+	routes = fan_out.channel_routes
+	monkeypatch.setenv("THRU_ROUTE_0", "2")
+	execute_again(host)
+	assert host.loading["fan_out"] is fan_out
+	assert fan_out.channel_routes is routes
+	host.swap(host.loading)
+	assert fan_out.channel_routes[0] == (fan_out.queues[2],)
@@ -0,0 +1,41 @@
+from common.ring import HEADER_SIZE, RECORD_DATA_SIZE, Ring
+
+def test_round_trip():
+	ring = Ring(4)
+	producer, consumer = ring.producer(), ring.consumer()
+	assert consumer.read() is None
+	# More writes than slots, the consumer keeps up.
+	for i in range(10):
+		producer.write(bytes([ 0x90, i, 100 ]), i)
+		assert consumer.read() == (i, bytes([ 0x90, i, 100 ]))
+	assert consumer.read() is None
+
+def test_long_sysex_split_over_records():
+	ring = Ring(8)
+	producer, consumer = ring.producer(), ring.consumer()
+	sysex = bytes([ 0xf0 ]) + bytes(range(3 * RECORD_DATA_SIZE))[:3 * RECORD_DATA_SIZE - 2] + bytes([ 0xf7 ])
+	producer.write(sysex, 7)
+	assert producer.position == 3
+	assert consumer.read() == (7, sysex)
+
+# A record whose bytes don't match its CRC yet is left for the next poll.
+def test_torn_record_retried():
+	ring = Ring(4)
+	producer, consumer = ring.producer(), ring.consumer()
+	producer.write(b"\x90\x3c\x64", 1)
+	offset = HEADER_SIZE + 8 + 10
+	original = ring.memory[offset]
+	ring.memory[offset] = original ^ 0xff
+	assert consumer.read() is None
+	assert consumer.torn == 1
+	ring.memory[offset] = original
+	assert consumer.read() == (1, b"\x90\x3c\x64")
+
+def test_finished_once_everything_is_read():
+	ring = Ring(4)
+	producer, consumer = ring.producer(), ring.consumer()
+	producer.write(b"\xf8", 0)
+	producer.close()
+	assert not consumer.finished()
+	assert consumer.read() == (0, b"\xf8")
+	assert consumer.finished()
@@ -0,0 +1,24 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from smf import END_OF_TRACK, MidiFile, from_messages, parse_track, read_midi_file, write_midi_file
+
+def messages(track):
+	return [ (tick, bytes(raw[:length]) if payload < 0 else track.payloads[payload]) for tick, raw, length, payload in zip(track.ticks.tolist(), track.raw, track.length.tolist(), track.payload.tolist()) ]
+
+def test_round_trip(tmp_path):
+	notes = [ (0, bytes([ 0x90, 60, 100 ])), (200, bytes([ 0x80, 60, 0 ])), (20200, bytes([ 0xc3, 5 ])), (2100000, bytes([ 0xe1, 0x00, 0x40 ])) ]
+	# A meta event fitting in the raw bytes, a longer one and a SysEx stored as payloads.
+	others = [ (0, bytes([ 0xff, 0x51, 0x03, 0x07, 0xa1, 0x20 ])), (10, bytes([ 0xff, 0x03, 0x0c ]) + b"Chord track!"), (30, bytes([ 0xf0, 0x07, 0x43, 0x10, 0x01, 0x1b, 0x3f, 0x00, 0xf7 ])) ]
+	midi_file = MidiFile(1, 96, [ from_messages(*zip(*track)) for track in [ notes, others ] ])
+	path = str(tmp_path / "round_trip.mid")
+	write_midi_file(path, midi_file)
+	result = read_midi_file(path)
+	assert (result.format, result.division, len(result.tracks)) == (1, 96, 2)
+	assert messages(result.tracks[0]) == notes + [ (2100000, END_OF_TRACK) ]
+	assert messages(result.tracks[1]) == others + [ (30, END_OF_TRACK) ]
+
+def test_running_status():
+	data = bytes([ 0x00, 0x90, 60, 100, 0x10, 64, 100, 0x00, 0xff, 0x2f, 0x00 ])
+	assert messages(parse_track(data)) == [ (0, bytes([ 0x90, 60, 100 ])), (16, bytes([ 0x90, 64, 100 ])), (16, END_OF_TRACK) ]
@@ -0,0 +1,80 @@
+from conftest import record_writes, wait_until
+from fake_pimidipy import ClockEvent, ControlChangeEvent, NoteOffEvent, NoteOnEvent, ProgramChangeEvent, SysExEvent
+
+FAST = { "THRU_OUTPUT_BYTES_PER_SEC": "1000000000" }
+
+def load_thru(load_sample, env):
+	thru, pimidipy = load_sample("thru", dict(FAST, **env))
+	written = [ record_writes(pimidipy.outputs[pimidipy.get_output_port(i)]) for i in range(thru["MAX_PORT"]) ]
+	return thru, pimidipy, written
+
+def feed(pimidipy, input_id, events):
+	callback = pimidipy.inputs[pimidipy.get_input_port(input_id)].callbacks[0]
+	for event in events:
+		callback(event)
+
+def test_routing_matrix(load_sample):
+	thru, pimidipy, written = load_thru(load_sample, { "THRU_ROUTE_0": "0,1:0-3", "THRU_ROUTE_2": "2:9" })
+	assert sorted(pimidipy.inputs) == [ pimidipy.get_input_port(0), pimidipy.get_input_port(2) ]
+	feed(pimidipy, 0, [ NoteOnEvent(2, 60, 100), NoteOnEvent(9, 61, 100), ClockEvent() ])
+	feed(pimidipy, 2, [ NoteOnEvent(9, 62, 100), NoteOnEvent(2, 63, 100) ])
+	wait_until(lambda: sum(map(len, written)) == 6)
+	# The clock may overtake the notes still queued.
+	assert sorted(written[0]) == [ ("MidiBytesEvent", bytes([ 0x92, 60, 100 ])), ("MidiBytesEvent", bytes([ 0x99, 61, 100 ])), ("MidiBytesEvent", b"\xf8") ]
+	assert sorted(written[1]) == [ ("MidiBytesEvent", bytes([ 0x92, 60, 100 ])), ("MidiBytesEvent", b"\xf8") ]
+	assert written[2] == [ ("MidiBytesEvent", bytes([ 0x99, 62, 100 ])) ]
+	assert not any(written[3:])
+	assert thru["fan_out"].unrouted == 1
+
+def test_encodes_once_for_every_output(load_sample):
+	thru, pimidipy, written = load_thru(load_sample, {})
+	event, kind = thru["encode_event"](SysExEvent(b"\xf0\x43\x10\x01\x02\x03\xf7"))
+	assert event.data == b"\xf0\x43\x10\x01\x02\x03\xf7"
+	feed(pimidipy, 0, [ ControlChangeEvent(0, 7, 100) ])
+	wait_until(lambda: all(written))
+	assert all(output == [ ("MidiBytesEvent", bytes([ 0xb0, 7, 100 ])) ] for output in written)
+
+# A newer value of a controller replaces the one still waiting in the queue.
+def test_continuous_controllers_merged(load_sample):
+	thru, pimidipy, written = load_thru(load_sample, { "THRU_ROUTE_0": "0" })
+	queue = thru["fan_out"].queues[0]
+	for value in range(3):
+		queue.push(*thru["encode_event"](ControlChangeEvent(0, 1, value)))
+	queue.push(*thru["encode_event"](NoteOnEvent(0, 60, 1)))
+	assert queue.replaced == 2
+	assert [ queue.pop().data for i in range(len(queue)) ] == [ bytes([ 0xb0, 1, 2 ]), bytes([ 0x90, 60, 1 ]) ]
+
+# Parameter selection, data entry and Program Change stay in order with the notes, only clock goes
+# ahead.
+def test_non_continuous_events_kept_in_order(load_sample):
+	thru, pimidipy, written = load_thru(load_sample, { "THRU_ROUTE_0": "0" })
+	queue = thru["fan_out"].queues[0]
+	events = [
+		ControlChangeEvent(0, 101, 0), ControlChangeEvent(0, 100, 1), ControlChangeEvent(0, 6, 64),
+		ControlChangeEvent(0, 101, 0), ControlChangeEvent(0, 100, 2), ControlChangeEvent(0, 6, 65),
+		ProgramChangeEvent(0, 5), NoteOnEvent(0, 60, 100), ClockEvent(),
+	]
+	for event in events:
+		queue.push(*thru["encode_event"](event))
+	assert queue.replaced == 0
+	assert [ queue.pop().data.hex(" ") for i in range(len(queue)) ] == [
+		"f8", "b0 65 00", "b0 64 01", "b0 06 40", "b0 65 00", "b0 64 02", "b0 06 41", "c0 05", "90 3c 64",
+	]
+
+# Note offs are never dropped, they take the place of a queued controller value if there is one.
+def test_note_offs_never_dropped(load_sample):
+	thru, pimidipy, written = load_thru(load_sample, { "THRU_ROUTE_0": "0", "THRU_QUEUE_SIZE": "2" })
+	queue = thru["fan_out"].queues[0]
+	events = [
+		NoteOnEvent(0, 60, 100), NoteOnEvent(0, 61, 100), ControlChangeEvent(0, 7, 100),
+		NoteOffEvent(0, 60, 0), ControlChangeEvent(0, 1, 10), NoteOffEvent(0, 61, 0),
+	]
+	for event in events:
+		queue.push(*thru["encode_event"](event))
+	assert (queue.dropped, queue.evicted) == (2, 0)
+	assert [ queue.pop().data.hex(" ") for i in range(len(queue)) ] == [ "90 3c 64", "90 3d 64", "80 3c 00", "80 3d 00" ]
+	queue.push(*thru["encode_event"](ControlChangeEvent(0, 7, 100)))
+	queue.push(*thru["encode_event"](NoteOnEvent(0, 60, 100)))
+	queue.push(*thru["encode_event"](NoteOffEvent(0, 60, 0)))
+	assert (queue.dropped, queue.evicted) == (2, 1)
+	assert [ queue.pop().data.hex(" ") for i in range(len(queue)) ] == [ "90 3c 64", "80 3c 00" ]
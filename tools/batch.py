@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Offline batch mode: runs the transforms of chord.py and dx7.py over a Standard MIDI File and
+# writes the result to a new file, for pre-rendering chord voicings and DX7 CC automation, or for
+# producing regression input from large files.
+#
+# The scripts are loaded with the stand-in pimidipy from the benchmarks, so the transforms use
+# exactly the tables the scripts build from their environment variables (CHORD_SEMITONES,
+# DX7_BANK_CONTROL_n, DX7_PARAM_n, DX7_DEVICE_ID, DX7_DEVICES, ...):
+#
+# chord - the notes, the sustain pedal and the channel mode CCs of all tracks are fed in the order
+#         they'd be played to chord.py's own handlers, so overlapping chords share their tones and
+#         sustained tones are held the same way as live, through its voice table. The note events
+#         it writes take the place of the fed ones, in the track they came from, everything else
+#         is kept as it is.
+# dx7   - whole tracks are transformed at once with NumPy. The bank in effect for each CC is found by a forward fill of the bank selects, then the
+#         parameter IDs and values are gathered from the compiled dispatch and value tables in one
+#         go. The CCs are replaced with the parameter change SysEx, the ones that would not alter
+#         the value last sent for the parameter are dropped, like dx7.py does. Snapshot save and
+#         recall CCs are dropped as well, offline they'd only touch the snapshot files.
+#
+# The output isn't paced, the player of the file has to keep the SysEx within the DX7's 31.25 kbaud.
+#
+# Usage: python3 tools/batch.py [--transform chord,dx7] input.mid output.mid
+#
+# Requires NumPy: sudo apt install python3-numpy
+
+import argparse
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from smf import RAW_SIZE, EventTable, MidiFile, concatenate, read_midi_file, write_midi_file
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SAMPLES_DIR = os.path.join(ROOT_DIR, "samples")
+
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+from fake_pimidipy import load_script
+
+os.environ.setdefault("PIMIDIPY_LOG_LEVEL", "error")
+
+TRANSFORMS = [ "chord", "dx7" ]
+
+# Marks an unused slot of the dispatch table rows.
+NO_TARGET = -128
+
+def quiet_print(*args, **kwargs):
+	pass
+
+def load(script):
+	namespace, pimidipy = load_script(os.path.join(SAMPLES_DIR, script + ".py"), init_globals={ "print": quiet_print })
+	return namespace
+
+# Takes the place of chord.py's output port, the events it's given are reused by the script so
+# only their bytes are kept.
+class ChordWrites:
+	def __init__(self, namespace):
+		self.note_on = namespace["NoteOnEvent"]
+		self.note_off = namespace["NoteOffEvent"]
+		self.fed = None
+		self.row = -1
+		self.rows = []
+		self.messages = []
+
+	def write(self, event, drain=True):
+		kind = type(event)
+		if kind is self.note_on:
+			self.messages.append((0x90 | event.channel, event.note, event.velocity))
+		elif kind is self.note_off:
+			self.messages.append((0x80 | event.channel, event.note, event.velocity))
+		elif event is self.fed:
+			# Passed through as it is.
+			self.messages.append(None)
+		else:
+			raise ValueError("Unexpected event written by chord.py: {!r}".format(event))
+		self.rows.append(self.row)
+
+class ChordTransform:
+	def __init__(self, namespace):
+		# The globals the script's functions run with, the namespace is a copy of them.
+		self.script = namespace["produce_chord"].__globals__
+		self.handle = namespace["produce_chord"]
+		self.events = { 0x80: namespace["NoteOffEvent"], 0x90: namespace["NoteOnEvent"], 0xb0: namespace["ControlChangeEvent"] }
+		# The CCs that change the voice table, the others are kept without going through the script.
+		self.controls = np.frombuffer(namespace["ENDS_ALL_NOTES"], np.uint8).astype(bool)
+		self.controls[namespace["SUSTAIN_PEDAL"]] = True
+
+	# Every file starts with no notes sounding and the pedal up.
+	def reset(self):
+		for name in [ "tone_refs", "tone_sustained", "sustain" ]:
+			self.script[name][:] = bytes(len(self.script[name]))
+		self.script["held_chords"][:] = self.script["NO_CHORDS"] * 16
+
+	def apply(self, midi_file):
+		merged = concatenate(midi_file.tracks)
+		track_ids = np.repeat(np.arange(len(midi_file.tracks)), [ len(track) for track in midi_file.tracks ])
+		status = merged.raw[:, 0] & 0xf0
+		channel = merged.channel_mask()
+		notes = (status == 0x80) | (status == 0x90)
+		fed = channel & (notes | (status == 0xb0) & self.controls[merged.raw[:, 1] & 0x7f])
+		order = np.argsort(merged.ticks, kind="stable")
+		fed_rows = order[fed[order]]
+
+		writes = ChordWrites(self.script)
+		self.reset()
+		self.script["output"] = writes
+		for row, (status_byte, data_1, data_2) in zip(fed_rows.tolist(), merged.raw[fed_rows, :3].tolist()):
+			event = writes.fed = self.events[status_byte & 0xf0](status_byte & 0x0f, data_1, data_2)
+			writes.row = row
+			self.handle(event)
+
+		# The written events follow the row they were written for, in the order they were written.
+		written_rows = np.array(writes.rows, np.int64)
+		kept = np.flatnonzero(~fed)
+		events = merged.select(np.concatenate([ kept, written_rows ]))
+		generated = [ i for i, message in enumerate(writes.messages) if message is not None ]
+		if generated:
+			index = len(kept) + np.array(generated)
+			events.raw[index, :3] = [ writes.messages[i] for i in generated ]
+			events.length[index] = 3
+		sources = np.concatenate([ kept, written_rows ])
+		positions = np.lexsort((np.arange(len(sources)), sources, track_ids[sources]))
+		events = events.select(positions)
+		event_tracks = track_ids[sources][positions]
+		bounds = np.searchsorted(event_tracks, np.arange(len(midi_file.tracks) + 1))
+		return MidiFile(midi_file.format, midi_file.division, [ events.select(slice(bounds[i], bounds[i + 1])) for i in range(len(midi_file.tracks)) ])
+
+class DX7Device:
+	def __init__(self, namespace, device):
+		self.device_id = device.device_id
+		self.initial_bank = device.bank
+		self.bank_select = namespace["ACTION_BANK_SELECT"]
+		self.value_table = np.frombuffer(b"".join(namespace["CC_VALUE_TABLES"]), np.uint8).reshape(len(namespace["CC_VALUE_TABLES"]), 128)
+		self.bank_table = np.frombuffer(namespace["BANK_SELECT_TABLE"], np.uint8)
+		banks = device.banks
+		width = max(1, max((len(entry) for bank in banks for entry in bank.values()), default=0))
+		self.dispatch = np.full((len(banks), 16 << 7, width), NO_TARGET, np.int16)
+		for bank_id, bank in enumerate(banks):
+			for key, entry in bank.items():
+				self.dispatch[bank_id, key, :len(entry)] = entry
+
+	# Returns the rows of the CCs that become parameter changes and the parameter changes.
+	def apply(self, merged, ccs):
+		status = merged.raw[:, 0]
+		keys = (status[ccs].astype(np.int32) & 0x0f) << 7 | merged.raw[ccs, 1]
+		values = merged.raw[ccs, 2]
+
+		# The bank select control is the same in every bank, the bank a CC applies to is the one
+		# picked by the last bank select before it.
+		selects = (self.dispatch[0, keys] == self.bank_select).any(axis=1)
+		last = np.maximum.accumulate(np.where(selects, np.arange(len(ccs)), -1))
+		previous = np.empty_like(last)
+		previous[:1] = -1
+		previous[1:] = last[:-1]
+		banks = np.where(previous >= 0, self.bank_table[values[np.maximum(previous, 0)]], self.initial_bank)
+
+		targets = self.dispatch[banks, keys]
+		parameter_values = self.value_table[np.maximum(targets, 0), values[:, None]]
+		cc_rows, columns = np.nonzero(targets >= 0)
+		param_ids = targets[cc_rows, columns]
+		param_values = parameter_values[cc_rows, columns]
+
+		# Drop the changes that would not alter the value last sent for the same parameter.
+		by_param = np.argsort(param_ids, kind="stable")
+		sorted_ids = param_ids[by_param]
+		sorted_values = param_values[by_param]
+		changed = np.ones(len(by_param), bool)
+		changed[1:] = (sorted_ids[1:] != sorted_ids[:-1]) | (sorted_values[1:] != sorted_values[:-1])
+		keep = np.empty(len(by_param), bool)
+		keep[by_param] = changed
+		cc_rows = cc_rows[keep]
+		param_ids = param_ids[keep]
+		param_values = param_values[keep]
+
+		rows = ccs[cc_rows]
+		sysex = EventTable(merged.ticks[rows], np.empty((len(rows), RAW_SIZE), np.uint8), np.full(len(rows), RAW_SIZE, np.uint8), np.full(len(rows), -1, np.int32), [])
+		sysex.raw[:] = [ 0xf0, RAW_SIZE - 2, 0x43, 0x10 | self.device_id, 0, 0, 0, 0xf7 ]
+		sysex.raw[:, 4] = param_ids >> 7
+		sysex.raw[:, 5] = param_ids & 0x7f
+		sysex.raw[:, 6] = param_values
+		return rows, sysex
+
+# Every device of dx7.py gets its CCs mapped on its own, the parameter changes of all of them
+# are merged into the output.
+class DX7Transform:
+	def __init__(self, namespace):
+		self.devices = [ DX7Device(namespace, device) for device in namespace["devices"] ]
+
+	def apply(self, midi_file):
+		merged = concatenate(midi_file.tracks)
+		track_ids = np.repeat(np.arange(len(midi_file.tracks)), [ len(track) for track in midi_file.tracks ])
+		status = merged.raw[:, 0]
+		is_cc = merged.channel_mask() & (status & 0xf0 == 0xb0)
+
+		# The CCs of all tracks in the order they'd be played.
+		order = np.argsort(merged.ticks, kind="stable")
+		ccs = order[is_cc[order]]
+
+		# The parameter changes take the place of the CCs they came from.
+		results = [ device.apply(merged, ccs) for device in self.devices ]
+		rows = np.concatenate([ rows for rows, sysex in results ])
+		others = np.flatnonzero(~is_cc)
+		events = concatenate([ merged.select(others) ] + [ sysex for rows, sysex in results ])
+		positions = np.argsort(np.concatenate([ others, rows ]), kind="stable")
+		events = events.select(positions)
+		event_tracks = np.concatenate([ track_ids[others], track_ids[rows] ])[positions]
+		bounds = np.searchsorted(event_tracks, np.arange(len(midi_file.tracks) + 1))
+		return MidiFile(midi_file.format, midi_file.division, [ events.select(slice(bounds[i], bounds[i + 1])) for i in range(len(midi_file.tracks)) ])
+
+TRANSFORM_CLASSES = {
+	"chord": ChordTransform,
+	"dx7": DX7Transform,
+}
+
+def build_transforms(names):
+	return [ TRANSFORM_CLASSES[name](load(name)) for name in names ]
+
+def run(transforms, midi_file):
+	for transform in transforms:
+		midi_file = transform.apply(midi_file)
+	return midi_file
+
+def main():
+	parser = argparse.ArgumentParser(description="Run the chord.py and dx7.py transforms over a Standard MIDI File.")
+	parser.add_argument("--transform", default=",".join(TRANSFORMS), help="comma separated transforms to apply in order, default: %(default)s")
+	parser.add_argument("input", help="the .mid file to read")
+	parser.add_argument("output", help="the .mid file to write")
+	args = parser.parse_args()
+
+	names = args.transform.split(",")
+	for name in names:
+		if name not in TRANSFORM_CLASSES:
+			parser.error("Unknown transform '{}'".format(name))
+	transforms = build_transforms(names)
+
+	start = perf_counter()
+	midi_file = read_midi_file(args.input)
+	read = perf_counter()
+	result = run(transforms, midi_file)
+	transformed = perf_counter()
+	write_midi_file(args.output, result)
+	written = perf_counter()
+
+	print("{} events in, {} events out".format(midi_file.event_count(), result.event_count()))
+	print("read {:.1f} ms, transform {:.1f} ms, write {:.1f} ms".format(1000 * (read - start), 1000 * (transformed - read), 1000 * (written - transformed)))
+
+if __name__ == "__main__":
+	main()
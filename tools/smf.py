@@ -0,0 +1,228 @@
+# Standard MIDI File reading and writing, with the events of each track kept in NumPy arrays so
+# they can be transformed in batches.
+#
+# A track is an EventTable:
+#
+# ticks   - int64, absolute time of every event in ticks.
+# raw     - uint8 (n, RAW_SIZE), the bytes of the event as they follow the delta time in the file,
+#           the status byte is always present (no running status).
+# length  - uint8, the number of bytes of 'raw' used.
+# payload - int32, for events that don't fit in 'raw' (meta events, long SysEx): the index of the
+#           bytes in 'payloads', -1 otherwise.
+#
+# So for channel messages raw[:, 0] is the status byte, raw[:, 1] and raw[:, 2] are the data bytes.
+
+import struct
+
+import numpy as np
+
+RAW_SIZE = 8
+
+META = 0xff
+META_END_OF_TRACK = 0x2f
+
+END_OF_TRACK = bytes([ META, META_END_OF_TRACK, 0x00 ])
+
+# Number of data bytes following the status byte, indexed by the high nibble of the status.
+CHANNEL_DATA_SIZE = [ 0 ] * 8 + [ 2, 2, 2, 2, 1, 1, 2, 0 ]
+
+class EventTable:
+	def __init__(self, ticks, raw, length, payload, payloads):
+		self.ticks = ticks
+		self.raw = raw
+		self.length = length
+		self.payload = payload
+		self.payloads = payloads
+
+	def __len__(self):
+		return len(self.ticks)
+
+	@staticmethod
+	def empty():
+		return EventTable(np.zeros(0, np.int64), np.zeros((0, RAW_SIZE), np.uint8), np.zeros(0, np.uint8), np.zeros(0, np.int32), [])
+
+	# Rows of 'raw' holding a channel message.
+	def channel_mask(self):
+		return (self.payload < 0) & (self.raw[:, 0] >= 0x80) & (self.raw[:, 0] < 0xf0)
+
+	def select(self, index):
+		return EventTable(self.ticks[index], self.raw[index], self.length[index], self.payload[index], self.payloads)
+
+class MidiFile:
+	def __init__(self, format=1, division=480, tracks=None):
+		self.format = format
+		self.division = division
+		self.tracks = tracks if tracks is not None else []
+
+	def event_count(self):
+		return sum(len(track) for track in self.tracks)
+
+def read_varlen(data, pos):
+	value = 0
+	while True:
+		byte = data[pos]
+		pos += 1
+		value = value << 7 | byte & 0x7f
+		if byte < 0x80:
+			return value, pos
+
+def parse_track(data):
+	ticks = []
+	raw = bytearray()
+	lengths = bytearray()
+	payload_ids = []
+	payloads = []
+	pad = bytes(RAW_SIZE)
+	tick = 0
+	status = 0
+	pos = 0
+	end = len(data)
+	while pos < end:
+		byte = data[pos]
+		pos += 1
+		delta = byte & 0x7f
+		while byte & 0x80:
+			byte = data[pos]
+			pos += 1
+			delta = delta << 7 | byte & 0x7f
+		tick += delta
+		byte = data[pos]
+		if byte >= 0x80:
+			pos += 1
+			if byte < 0xf0:
+				status = byte
+		elif status == 0:
+			raise ValueError("Data byte without a status at offset {}".format(pos))
+		else:
+			byte = status
+		if byte < 0xf0:
+			size = CHANNEL_DATA_SIZE[byte >> 4]
+			raw += bytes([ byte ])
+			raw += data[pos:pos + size]
+			raw += pad[:RAW_SIZE - 1 - size]
+			lengths.append(size + 1)
+			payload_ids.append(-1)
+			pos += size
+		else:
+			start = pos - 1
+			if byte == META:
+				pos += 1
+			# SysEx and meta events cancel the running status.
+			status = 0
+			size, pos = read_varlen(data, pos)
+			pos += size
+			message = data[start:pos]
+			if len(message) <= RAW_SIZE:
+				raw += message
+				raw += pad[:RAW_SIZE - len(message)]
+				lengths.append(len(message))
+				payload_ids.append(-1)
+			else:
+				raw += pad
+				lengths.append(0)
+				payload_ids.append(len(payloads))
+				payloads.append(bytes(message))
+			if byte == META and data[start + 1] == META_END_OF_TRACK:
+				ticks.append(tick)
+				break
+		ticks.append(tick)
+	return EventTable(
+		np.array(ticks, np.int64),
+		np.frombuffer(bytes(raw), np.uint8).reshape(-1, RAW_SIZE).copy(),
+		np.frombuffer(bytes(lengths), np.uint8).copy(),
+		np.array(payload_ids, np.int32),
+		payloads
+		)
+
+def read_midi_file(path):
+	with open(path, "rb") as f:
+		data = f.read()
+	if data[:4] != b"MThd":
+		raise ValueError("{} is not a Standard MIDI File".format(path))
+	size, format, track_count, division = struct.unpack(">IHHH", data[4:14])
+	midi_file = MidiFile(format, division)
+	pos = 8 + size
+	while pos + 8 <= len(data) and len(midi_file.tracks) < track_count:
+		chunk, size = struct.unpack(">4sI", data[pos:pos + 8])
+		pos += 8
+		# Unknown chunks are skipped, as the spec asks for.
+		if chunk == b"MTrk":
+			midi_file.tracks.append(parse_track(data[pos:pos + size]))
+		pos += size
+	return midi_file
+
+# Encodes the delta times as variable length quantities, returns the (n, 4) bytes and the number
+# of bytes used by each.
+def encode_varlen(values):
+	if len(values) and (values.min() < 0 or values.max() >= 1 << 28):
+		raise ValueError("Delta time out of range")
+	groups = np.stack([ values >> 21, values >> 14, values >> 7, values ], axis=1) & 0x7f
+	sizes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+	# Left align the used groups, all but the last one get the continuation bit.
+	columns = np.arange(4)
+	index = np.minimum(columns + (4 - sizes)[:, None], 3)
+	encoded = np.take_along_axis(groups, index, axis=1)
+	encoded |= (columns < (sizes - 1)[:, None]) * 0x80
+	return encoded.astype(np.uint8), sizes
+
+def ends_with_end_of_track(track):
+	return len(track) and track.payload[-1] < 0 and track.length[-1] == len(END_OF_TRACK) and bytes(track.raw[-1, :len(END_OF_TRACK)]) == END_OF_TRACK
+
+def encode_track(track):
+	if not ends_with_end_of_track(track):
+		end_tick = track.ticks[-1] if len(track) else 0
+		track = concatenate([ track, from_messages([ end_tick ], [ END_OF_TRACK ]) ])
+	deltas = np.diff(track.ticks, prepend=0)
+	varlen, sizes = encode_varlen(deltas)
+	rows = np.concatenate([ varlen, track.raw ], axis=1)
+	columns = np.arange(rows.shape[1])
+	mask = np.concatenate([ columns[:4] < sizes[:, None], columns[4:] - 4 < track.length[:, None] ], axis=1)
+	flat = rows[mask].tobytes()
+	# The events carrying a payload have it appended right after their delta time.
+	ends = np.cumsum(sizes + track.length)
+	out = bytearray()
+	previous = 0
+	for row in np.flatnonzero(track.payload >= 0):
+		end = int(ends[row])
+		out += flat[previous:end]
+		out += track.payloads[track.payload[row]]
+		previous = end
+	out += flat[previous:]
+	return bytes(out)
+
+def write_midi_file(path, midi_file):
+	with open(path, "wb") as f:
+		f.write(b"MThd" + struct.pack(">IHHH", 6, midi_file.format, len(midi_file.tracks), midi_file.division))
+		for track in midi_file.tracks:
+			data = encode_track(track)
+			f.write(b"MTrk" + struct.pack(">I", len(data)))
+			f.write(data)
+
+# Builds a table from a list of ticks and the message bytes of each event.
+def from_messages(ticks, messages):
+	table = EventTable(np.array(ticks, np.int64), np.zeros((len(messages), RAW_SIZE), np.uint8), np.zeros(len(messages), np.uint8), np.full(len(messages), -1, np.int32), [])
+	for i, message in enumerate(messages):
+		if len(message) <= RAW_SIZE:
+			table.raw[i, :len(message)] = list(message)
+			table.length[i] = len(message)
+		else:
+			table.payload[i] = len(table.payloads)
+			table.payloads.append(bytes(message))
+	return table
+
+# Joins tables one after another, the payload indices get renumbered.
+def concatenate(tables):
+	if not tables:
+		return EventTable.empty()
+	payloads = []
+	payload_ids = []
+	for table in tables:
+		payload_ids.append(np.where(table.payload >= 0, table.payload + len(payloads), -1).astype(np.int32))
+		payloads.extend(table.payloads)
+	return EventTable(
+		np.concatenate([ table.ticks for table in tables ]),
+		np.concatenate([ table.raw for table in tables ]),
+		np.concatenate([ table.length for table in tables ]),
+		np.concatenate(payload_ids),
+		payloads
+		)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Shows the metrics of the running sample scripts (see samples/common/metrics.py), refreshed like
+# 'top': the event rates per port and type, the callback and output write durations, and each
+# script's own values such as queue depths and SysEx counts.
+#
+# Usage: python3 tools/top.py [--interval seconds] [--once] [socket or stats file ...]
+#
+# Without arguments, all the pimidipy-*.sock sockets in PIMIDIPY_METRICS_DIR (/tmp by default) are read,
+# skipping the ones left behind by scripts that are no longer running.
+
+import argparse
+import glob
+import json
+import os
+import socket
+import sys
+from time import sleep
+
+PIMIDIPY_METRICS_DIR = os.getenv("PIMIDIPY_METRICS_DIR", "/tmp")
+
+def read_metrics(source):
+	if source.endswith(".sock"):
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+			s.settimeout(1)
+			s.connect(source)
+			chunks = []
+			while True:
+				chunk = s.recv(65536)
+				if not chunk:
+					break
+				chunks.append(chunk)
+		return json.loads(b"".join(chunks))
+	with open(source) as f:
+		return json.load(f)
+
+# Upper bound of the histogram bucket the p-th percentile falls into, in microseconds.
+def percentile(histogram, p):
+	buckets = histogram["buckets"]
+	target = sum(buckets) * p / 100
+	total = 0
+	for i, count in enumerate(buckets):
+		total += count
+		if count and total >= target:
+			return min((1 << i) - 1, histogram["max_ns"]) / 1000
+	return 0.0
+
+def format_histogram(name, histogram):
+	count = histogram.get("count", sum(histogram["buckets"]))
+	if not count:
+		return "  {:<28} {:>10}".format(name, "-")
+	return "  {:<28} {:>10} p50 <={:>8.1f} us  p99 <={:>8.1f} us  max {:>9.1f} us".format(
+		name,
+		count,
+		percentile(histogram, 50),
+		percentile(histogram, 99),
+		histogram["max_ns"] / 1000
+		)
+
+def rate(current, previous, key, elapsed):
+	if previous is None or elapsed <= 0:
+		return 0.0
+	return (current - previous.get(key, 0)) / elapsed
+
+def format_script(metrics, previous):
+	elapsed = metrics["time"] - previous["time"] if previous is not None else 0
+	lines = [ "{} (pid {}, up {:.0f} s)".format(metrics["script"], metrics["pid"], metrics["time"] - metrics["started"]) ]
+	for port, counts in metrics["events"].items():
+		previous_counts = previous["events"].get(port, {}) if previous is not None else None
+		total = sum(counts.values())
+		previous_total = { "total": sum(previous_counts.values()) } if previous_counts is not None else None
+		lines.append("  {:<28} {:>10} events {:>9.0f}/s".format(port, total, rate(total, previous_total, "total", elapsed)))
+		for name, count in sorted(counts.items(), key=lambda item: -item[1]):
+			lines.append("    {:<26} {:>10}        {:>9.0f}/s".format(name, count, rate(count, previous_counts, name, elapsed)))
+	sample = metrics.get("sample", 1)
+	lines.append(format_histogram("callback" if sample == 1 else "callback (1 in {})".format(sample), metrics["callback"]))
+	for output, histogram in metrics["writes"].items():
+		lines.append(format_histogram("write " + output, histogram))
+	for name, value in metrics["gauges"].items():
+		lines.append("  {:<28} {:>10}".format(name, value))
+	return lines
+
+def main():
+	parser = argparse.ArgumentParser(description="Show the metrics of the running pimidipy scripts.")
+	parser.add_argument("--interval", type=float, default=1.0, help="seconds between refreshes, default: %(default)s")
+	parser.add_argument("--once", action="store_true", help="print the metrics once and exit")
+	parser.add_argument("sources", nargs="*", help="metrics sockets or stats files, default: all sockets in {}".format(PIMIDIPY_METRICS_DIR))
+	args = parser.parse_args()
+
+	previous = {}
+	while True:
+		sources = args.sources or sorted(glob.glob(os.path.join(PIMIDIPY_METRICS_DIR, "pimidipy-*.sock")))
+		lines = []
+		for source in sources:
+			try:
+				metrics = read_metrics(source)
+			except ConnectionRefusedError as e:
+				if not args.sources:
+					continue
+				lines.append("{}: {}".format(source, e))
+				continue
+			except (OSError, ValueError) as e:
+				lines.append("{}: {}".format(source, e))
+				continue
+			lines.extend(format_script(metrics, previous.get(source)))
+			lines.append("")
+			previous[source] = metrics
+		if not sources:
+			lines.append("No running scripts found in {}".format(PIMIDIPY_METRICS_DIR))
+		if args.once:
+			print("\n".join(lines))
+			return
+		# Clear the screen and move to the top left corner.
+		sys.stdout.write("\x1b[H\x1b[2J" + "\n".join(lines) + "\n")
+		sys.stdout.flush()
+		try:
+			sleep(args.interval)
+		except KeyboardInterrupt:
+			return
+
+if __name__ == "__main__":
+	main()